@@ -0,0 +1,385 @@
+import time
+import gc
+import sys
+import ujson
+
+from ringlog import RingLog
+from compressorlogs import EventLog
+from compressorlogs import StateLog
+from compressorlogs import CompactStateLog
+import compressorlogs
+from linear_least_squares import linear_least_squares
+
+# tracemalloc is used to measure allocations on CPython, where gc.mem_alloc() isn't available
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Benchmarks for the logging and analytics code that runs on every update of the
+# controller or every request to the server. The suite runs on the board:
+#
+#    import benchmark
+#    benchmark.run()
+#
+# or on a host computer (see host/bench.py). Each benchmark is run for every ring
+# size in SIZES and, where it applies, for every layout in LAYOUTS and with both
+# thread safe and non thread safe locks. The time and the bytes allocated per
+# operation are printed and written to a json file, so the results of two commits
+# can be compared with compare().
+#
+# Allocations are measured with gc.mem_alloc() on the board, which counts every
+# byte allocated. On CPython tracemalloc only sees the peak of each operation, so
+# allocations that are freed and reused within an operation are counted once.
+
+SIZES = (10, 100, 1000, 10000)
+
+# How full the ring is: (name, entries logged as a fraction of the size). A
+# ring that has been filled more than once has wrapped, so the most recent
+# entry is in the middle of the buffer and copies are split in two.
+LAYOUTS = (
+    ('half', 0.5),
+    ('full', 1),
+    ('wrapped', 1.5)
+)
+
+STATE = 'OR_'               # A state string, as logged by the controller
+LOG_SPACING = 60            # Seconds between the logs that fill a ring
+ALLOCATION_OPS = 10         # Operations that allocations are averaged over
+
+# Discards the output of dumps
+class NullWriter:
+    def __init__(self):
+        self.length = 0
+
+    def write(self, data):
+        self.length += len(data)
+
+    async def drain(self):
+        pass
+
+# Runs a coroutine that never waits (such as a dump to a NullWriter) to completion
+def _run_coroutine(coroutine):
+    try:
+        while True:
+            coroutine.send(None)
+    except StopIteration:
+        pass
+
+# Logs count entries into log, ending at the current time
+def _fill(log, count, make_entry):
+    start = time.time() - count*LOG_SPACING
+    for i in range(count):
+        log.log(make_entry(start + i*LOG_SPACING))
+
+def _state_entry(t):
+    return (t, 100.0, 90.0, 0.5, STATE)
+
+def _event_entry(t):
+    return (t, t + LOG_SPACING//2, compressorlogs.EVENT_RUN)
+
+# Each benchmark sets up a log and returns the operation to time
+
+def _ring_log(size, count, thread_safe, columnar = False):
+    log = RingLog("<Lfff3s", ["time", "tank_pressure", "line_pressure", "duty", "state"], size, thread_safe = thread_safe, ordered_index = 0, columnar = columnar)
+    _fill(log, count, _state_entry)
+    return log
+
+# Sums a field of every log, so that iter_field() is run to completion
+def _sum_field(log, field_index):
+    total = 0
+    for value in log.iter_field(field_index):
+        total += value
+    return total
+
+def bench_ring_log_log(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe)
+    entry = _state_entry(time.time())
+    return lambda: log.log(entry)
+
+def bench_ring_log_getitem(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe)
+    index = len(log)//2
+    return lambda: log[index]
+
+def bench_ring_log_dump(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe)
+    writer = NullWriter()
+    return lambda: _run_coroutine(log.dump(writer, 0))
+
+def bench_ring_log_dump_binary(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe)
+    writer = NullWriter()
+    return lambda: _run_coroutine(log.dump_binary(writer, 0))
+
+def bench_ring_log_iter_field(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe)
+    return lambda: _sum_field(log, 1)
+
+# The same operations on columnar logs
+
+def bench_columnar_log_log(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe, columnar = True)
+    entry = _state_entry(time.time())
+    return lambda: log.log(entry)
+
+def bench_columnar_log_getitem(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe, columnar = True)
+    index = len(log)//2
+    return lambda: log[index]
+
+def bench_columnar_log_dump(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe, columnar = True)
+    writer = NullWriter()
+    return lambda: _run_coroutine(log.dump(writer, 0))
+
+def bench_columnar_log_iter_field(size, count, thread_safe):
+    log = _ring_log(size, count, thread_safe, columnar = True)
+    return lambda: _sum_field(log, 1)
+
+def bench_columnar_event_log_analyze_logs(size, count, thread_safe):
+    log = EventLog(thread_safe = thread_safe, size_limit = size, columnar = True)
+    _fill(log, count, _event_entry)
+    now = time.time()
+    query_start = now - size*LOG_SPACING
+    return lambda: log._analyze_logs(query_start, now)
+
+def bench_columnar_state_log_linear_least_squares(size, count, thread_safe):
+    log = StateLog(0, thread_safe, size_limit = size, columnar = True)
+    _fill(log, count, _state_entry)
+    return lambda: log.linear_least_squares()
+
+def bench_event_log_analyze_logs(size, count, thread_safe):
+    log = EventLog(thread_safe = thread_safe, size_limit = size)
+    _fill(log, count, _event_entry)
+    now = time.time()
+    query_start = now - size*LOG_SPACING
+    return lambda: log._analyze_logs(query_start, now)
+
+def bench_state_log_log_state(size, count, thread_safe):
+    log = StateLog(0, thread_safe, size_limit = size)
+    _fill(log, count, _state_entry)
+    return lambda: log.log_state(100.0, 90.0, 0.5, STATE)
+
+def bench_state_log_linear_least_squares(size, count, thread_safe):
+    log = StateLog(0, thread_safe, size_limit = size)
+    _fill(log, count, _state_entry)
+    return lambda: log.linear_least_squares()
+
+# Logs a state and calculates the sliding regression, as the pressure change alert
+# does on every tick. The window covers the whole ring.
+def _state_log_regression(log, count):
+    _fill(log, count, _state_entry)
+    now = [time.time()]
+    def op():
+        now[0] += LOG_SPACING
+        log.log(_state_entry(now[0]))
+        return log.regression()
+    return op
+
+def bench_state_log_regression(size, count, thread_safe):
+    return _state_log_regression(StateLog(0, thread_safe, size_limit = size, regression_window = size*LOG_SPACING), count)
+
+def bench_columnar_state_log_regression(size, count, thread_safe):
+    return _state_log_regression(StateLog(0, thread_safe, size_limit = size, regression_window = size*LOG_SPACING, columnar = True), count)
+
+def bench_compact_state_log_log_state(size, count, thread_safe):
+    log = CompactStateLog(0, thread_safe, size_limit = size)
+    _fill(log, count, _state_entry)
+    return lambda: log.log_state(100.0, 90.0, 0.5, STATE)
+
+def bench_compact_state_log_getitem(size, count, thread_safe):
+    log = CompactStateLog(0, thread_safe, size_limit = size)
+    _fill(log, count, _state_entry)
+    index = len(log)//2
+    return lambda: log[index]
+
+def bench_compact_state_log_dump(size, count, thread_safe):
+    log = CompactStateLog(0, thread_safe, size_limit = size)
+    _fill(log, count, _state_entry)
+    writer = NullWriter()
+    return lambda: _run_coroutine(log.dump(writer, 0))
+
+def bench_compact_state_log_linear_least_squares(size, count, thread_safe):
+    log = CompactStateLog(0, thread_safe, size_limit = size)
+    _fill(log, count, _state_entry)
+    return lambda: log.linear_least_squares()
+
+def bench_linear_least_squares(size, count, thread_safe):
+    start = time.time()
+    data = [[start + i*LOG_SPACING, 100.0 + (i % 7)] for i in range(size)]
+    return lambda: linear_least_squares(data)
+
+# (name, setup function, whether the benchmark depends on the layout and the lock)
+BENCHMARKS = (
+    ('RingLog.log', bench_ring_log_log, True),
+    ('RingLog.__getitem__', bench_ring_log_getitem, True),
+    ('RingLog.dump', bench_ring_log_dump, True),
+    ('RingLog.dump_binary', bench_ring_log_dump_binary, True),
+    ('RingLog.iter_field', bench_ring_log_iter_field, True),
+    ('columnar RingLog.log', bench_columnar_log_log, True),
+    ('columnar RingLog.__getitem__', bench_columnar_log_getitem, True),
+    ('columnar RingLog.dump', bench_columnar_log_dump, True),
+    ('columnar RingLog.iter_field', bench_columnar_log_iter_field, True),
+    ('EventLog._analyze_logs', bench_event_log_analyze_logs, True),
+    ('StateLog.log_state', bench_state_log_log_state, True),
+    ('StateLog.linear_least_squares', bench_state_log_linear_least_squares, True),
+    ('StateLog.regression', bench_state_log_regression, True),
+    ('CompactStateLog.log_state', bench_compact_state_log_log_state, True),
+    ('CompactStateLog.__getitem__', bench_compact_state_log_getitem, True),
+    ('CompactStateLog.dump', bench_compact_state_log_dump, True),
+    ('CompactStateLog.linear_least_squares', bench_compact_state_log_linear_least_squares, True),
+    ('columnar EventLog._analyze_logs', bench_columnar_event_log_analyze_logs, True),
+    ('columnar StateLog.linear_least_squares', bench_columnar_state_log_linear_least_squares, True),
+    ('columnar StateLog.regression', bench_columnar_state_log_regression, True),
+    ('linear_least_squares', bench_linear_least_squares, False)
+)
+
+# The layouts of the state log that capacity() compares, as (name, setup)
+STATE_LOG_LAYOUTS = (
+    ('StateLog', lambda size: StateLog(0, False, size_limit = size)),
+    ('columnar StateLog', lambda size: StateLog(0, False, size_limit = size, columnar = True)),
+    ('CompactStateLog', lambda size: CompactStateLog(0, False, size_limit = size))
+)
+
+# Returns the memory used per log by each layout of the state log, and how many
+# logs fit in 16 KB
+def capacity(size = 1000):
+    results = []
+    for (name, setup) in STATE_LOG_LAYOUTS:
+        bytes_per_log = setup(size).storage_size/size
+        results.append({"layout": name, "bytes_per_log": bytes_per_log, "logs_per_16k": int(16384/bytes_per_log)})
+        gc.collect()
+    return results
+
+# Runs op repeatedly until it has run for at least min_us microseconds, and returns
+# the number of operations and the time per operation
+def _measure_time(op, min_us):
+    count = 1
+    while True:
+        ops = range(count)
+        start = time.ticks_us()
+        for i in ops:
+            op()
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        if elapsed >= min_us:
+            return (count, elapsed/count)
+        # Aim for twice the minimum, so that the next run is very likely to be long enough
+        count = max(count*2, int(count*2*min_us/max(elapsed, 1)))
+
+# Returns the bytes allocated per operation
+def _measure_allocation(op):
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            total = 0
+            for i in range(ALLOCATION_OPS):
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                op()
+                total += tracemalloc.get_traced_memory()[1] - before
+            return total/ALLOCATION_OPS
+        finally:
+            tracemalloc.stop()
+
+    # The collector is disabled so that the difference in mem_alloc() is everything
+    # that was allocated
+    ops = range(ALLOCATION_OPS)
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        for i in ops:
+            op()
+        return (gc.mem_alloc() - before)/ALLOCATION_OPS
+    finally:
+        gc.enable()
+
+# Returns the cases to run as (name, setup, size, layout, thread_safe)
+def cases(sizes = SIZES, names = None):
+    for (name, setup, configurable) in BENCHMARKS:
+        if names is not None and name not in names:
+            continue
+        for size in sizes:
+            if not configurable:
+                yield (name, setup, size, None, False)
+                continue
+            for layout in LAYOUTS:
+                for thread_safe in (False, True):
+                    yield (name, setup, size, layout, thread_safe)
+
+# Runs a single case and returns its result
+def run_case(name, setup, size, layout, thread_safe, min_us):
+    result = {
+        "benchmark": name,
+        "size": size,
+        "layout": layout[0] if layout else None,
+        "thread_safe": thread_safe
+    }
+    try:
+        count = int(size*layout[1]) if layout else size
+        op = setup(size, count, thread_safe)
+        (result["ops"], result["us_per_op"]) = _measure_time(op, min_us)
+        result["bytes_per_op"] = _measure_allocation(op)
+    except MemoryError:
+        # The largest rings don't fit in the memory of the board
+        result["error"] = "MemoryError"
+    op = None
+    gc.collect()
+    return result
+
+def _format_result(result):
+    description = '{} size={} layout={} thread_safe={}'.format(result["benchmark"], result["size"], result["layout"], result["thread_safe"])
+    if "error" in result:
+        return '{}: {}'.format(description, result["error"])
+    return '{}: {:.2f} us/op {:.1f} bytes/op ({} ops)'.format(description, result["us_per_op"], result["bytes_per_op"], result["ops"])
+
+# Runs the benchmarks and writes the results to path as json:
+#
+#    {"label": label, "implementation": ..., "platform": ..., "time": ..., "capacity": [...], "results": [result, ...]}
+#
+# The results are written as they are produced rather than collected, so that the
+# suite doesn't need memory for all of them.
+def run(path = 'benchmark.json', sizes = SIZES, names = None, min_us = 100000, label = None):
+    with open(path, 'w') as f:
+        layouts = capacity()
+        for layout in layouts:
+            print('{} capacity: {:.2f} bytes/log, {} logs in 16 KB'.format(layout["layout"], layout["bytes_per_log"], layout["logs_per_16k"]))
+        f.write('{{"label": {}, "implementation": {}, "platform": {}, "time": {}, "capacity": {}, "results": ['.format(
+            ujson.dumps(label), ujson.dumps(sys.implementation.name), ujson.dumps(sys.platform), time.time(), ujson.dumps(layouts)))
+        first = True
+        for (name, setup, size, layout, thread_safe) in cases(sizes, names):
+            result = run_case(name, setup, size, layout, thread_safe, min_us)
+            print(_format_result(result))
+            if not first:
+                f.write(',')
+            first = False
+            f.write('\n')
+            f.write(ujson.dumps(result))
+        f.write('\n]}\n')
+
+def _result_key(result):
+    return (result["benchmark"], result["size"], result["layout"], result["thread_safe"])
+
+# Prints the change in time and allocations of each case between two result files
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = ujson.loads(f.read())
+    with open(new_path) as f:
+        new = ujson.loads(f.read())
+    old_results = {_result_key(result): result for result in old["results"]}
+
+    print('{} -> {}'.format(old["label"], new["label"]))
+    old_capacity = {layout["layout"]: layout for layout in old.get("capacity", ())}
+    for layout in new.get("capacity", ()):
+        previous = old_capacity.get(layout["layout"])
+        if previous is not None:
+            print('{} capacity: {:.2f} -> {:.2f} bytes/log'.format(layout["layout"], previous["bytes_per_log"], layout["bytes_per_log"]))
+    for result in new["results"]:
+        previous = old_results.get(_result_key(result))
+        if previous is None or "error" in result or "error" in previous:
+            continue
+        print('{} size={} layout={} thread_safe={}: {:.2f} -> {:.2f} us/op ({:+.0f}%), {:.1f} -> {:.1f} bytes/op'.format(
+            result["benchmark"], result["size"], result["layout"], result["thread_safe"],
+            previous["us_per_op"], result["us_per_op"], (result["us_per_op"]/previous["us_per_op"] - 1)*100 if previous["us_per_op"] else 0,
+            previous["bytes_per_op"], result["bytes_per_op"]))
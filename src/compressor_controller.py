@@ -7,10 +7,18 @@ import compressorlogs
 from compressorlogs import EventLog
 from compressorlogs import CommandLog
 from compressorlogs import StateLog
+from compressorlogs import CompactStateLog
+from compressorlogs import RollupLog
+from compressorlogs import CompactRollupLog
+from sensor_sampler import SensorSampler
+from log_store import LogStore
+from log_store import LogWriter
+from log_store import load_stores
 
 import time
 import sys
 import _thread
+import ujson
 
 import machine
 from machine import Pin
@@ -41,17 +49,45 @@ MOTOR_STATE_PURGE=const('purge')                # purging in progress, motor dis
 # The logs used by the compressor are only updated while a lock is held, so
 # if a caller wants to access the logs it should aquire compressor.lock first
 # to ensure that the logs aren't mutated while they are being read.
+#
+# The state of the compressor is published as a StatusSnapshot once per update,
+# and again when a command changes the state between updates. Status queries
+# share the current snapshot instead of building their own.
 class CompressorController:
     def __init__(self, settings, thread_safe = False):
-        self.activity_log = EventLog(thread_safe = thread_safe)
+        self.activity_log = EventLog(thread_safe = thread_safe, columnar = settings.columnar_logs)
         self.command_log = CommandLog(thread_safe = thread_safe)
-        self.state_log = StateLog(settings.log_interval, thread_safe = thread_safe)
-        self.fine_state_log = StateLog(0, size_limit = 10, thread_safe = thread_safe)
+        # The state history is summarized at increasing intervals (see RollupLog). Each
+        # rollup feeds the next, so they are created from the coarsest.
+        next_rollup = None
+        self.state_rollups = []
+        rollup_class = CompactRollupLog if settings.compact_state_log else RollupLog
+        for (interval, size_limit) in reversed(settings.state_rollups):
+            next_rollup = rollup_class(interval, size_limit, thread_safe = thread_safe, next_rollup = next_rollup, columnar = settings.columnar_logs)
+            self.state_rollups.insert(0, next_rollup)
+        state_log_class = CompactStateLog if settings.compact_state_log else StateLog
+        self.state_log = state_log_class(settings.log_interval, thread_safe = thread_safe, size_limit = settings.state_log_size, rollup = next_rollup, columnar = settings.columnar_logs)
+        self.fine_state_log = StateLog(0, size_limit = 10, thread_safe = thread_safe, regression_window = settings.pressure_change_duration, columnar = settings.columnar_logs)
 
         self.activity_log.console_log = settings.debug_mode & debug.DEBUG_EVENT_LOG
         self.command_log.console_log = settings.debug_mode & debug.DEBUG_ACTIVITY_LOG
         self.state_log.console_log = settings.debug_mode & debug.DEBUG_STATE_LOG
 
+        # Keep the history of the state and activity logs on flash, and restore it after a restart
+        if settings.log_directory is not None:
+            self.state_log_store = LogStore(self.state_log, settings.log_directory, 'state', settings.log_block_size, settings.log_segment_blocks, settings.log_segment_count, thread_safe)
+            self.activity_log_store = LogStore(self.activity_log, settings.log_directory, 'activity', settings.log_block_size, settings.log_segment_blocks, settings.log_segment_count, thread_safe)
+            self.state_rollup_stores = [LogStore(rollup, settings.log_directory, 'state_{}'.format(rollup.log_interval), settings.log_block_size, settings.log_segment_blocks, settings.log_segment_count, thread_safe) for rollup in self.state_rollups]
+            stores = [self.state_log_store, self.activity_log_store] + self.state_rollup_stores
+            load_stores(stores)
+            # The blocks of logs are written to flash in the background
+            self.log_writer = LogWriter(stores, settings.log_write_interval)
+        else:
+            self.state_log_store = None
+            self.activity_log_store = None
+            self.state_rollup_stores = [None]*len(self.state_rollups)
+            self.log_writer = None
+
         self.settings = settings
         self.lock = CondLock(thread_safe)
         self.thread_safe = thread_safe
@@ -78,13 +114,23 @@ class CompressorController:
         self.pressure_change_alert = None
         self.min_pressure_change = 0
         self.max_pressure_change = 0
+        self.boot_time = time.time()     # Distinguishes status versions from before a restart
+        self.sensor_time = 0             # The time the sensors were last read
+        self.sensor_ticks = 0            # ticks_ms() when the sensors were last read, to measure the age of the values
+        self.fresh_sensor_values = None  # The last reading taken for a client, see sensor_values()
+        self.fresh_sensor_ticks = 0      # ticks_ms() when fresh_sensor_values was read
+        self.status_version = 0          # The version of the most recent status snapshot
+        self._status = None              # The current StatusSnapshot, or None if it needs to be rebuilt
                 
         # Locate hardware registers
         self.tank_pressure_ADC = machine.ADC(settings.tank_pressure_pin)
+        self.tank_pressure_sampler = SensorSampler(self.tank_pressure_ADC, settings, settings.adc_max_samples)
         if settings.line_pressure_pin is not None:
             self.line_pressure_ADC = machine.ADC(settings.line_pressure_pin)
+            self.line_pressure_sampler = SensorSampler(self.line_pressure_ADC, settings, settings.adc_max_samples)
         else:
             self.line_pressure_ADC = None
+            self.line_pressure_sampler = None
             
         if settings.compressor_motor_pin is not None:
             self.compressor_motor = Pin(settings.compressor_motor_pin, Pin.OUT)
@@ -107,8 +153,27 @@ class CompressorController:
                     
         # Start an unload cycle in case the compressor was interrupted on the last run
         self._unload()
+
+        # Read the sensors so that the status is valid before the first update
+        self._read_ADC()
+
+        # Record the inputs of the controller for replay. The recorder is only
+        # imported when it is used, to save memory.
+        if settings.debug_mode & debug.DEBUG_TRACE:
+            from compressor_trace import TraceRecorder
+            self.trace = TraceRecorder(self, settings.trace_path, settings.trace_max_size)
+        else:
+            self.trace = None
     
-    def _read_ADC(self):
+    # Reads the pressure sensors. This is only done by the control loop, and everything
+    # else uses the values it cached (fresh readings for clients are separate, see
+    # sensor_values()). The sensors are scaled with the settings snapshot of the update, or
+    # the current one. Must be called with the lock held.
+    def _read_ADC(self, settings = None):
+        if settings is None:
+            settings = self.settings.snapshot
+        self.sensor_time = time.time()
+        self.sensor_ticks = time.ticks_ms()
         if self.settings.debug_mode & debug.DEBUG_ADC_SIMULATE:
             if self.tank_pressure is None:
                 self.tank_pressure = 90
@@ -118,15 +183,15 @@ class CompressorController:
                 self.tank_pressure = max(0, self.tank_pressure - 0.1)
             self.line_pressure = min(self.tank_pressure, 90)
         else:
-            self.tank_pressure = self.settings.tank_pressure_sensor.map(self.tank_pressure_ADC.read_u16())
+            self.tank_pressure = settings.tank_pressure_sensor.map(self.tank_pressure_sampler.read(settings))
             # If either sensor returns None there is an error. Record the error, and then
             # set the value to -1 so that it is a valid integer for calculations and serialization
             self.tank_sensor_error = self.tank_pressure is None
             if self.tank_pressure is None:
                 self.tank_pressure = -1
 
-            if self.line_pressure_ADC is not None:
-                self.line_pressure = self.settings.line_pressure_sensor.map(self.line_pressure_ADC.read_u16())
+            if self.line_pressure_sampler is not None:
+                self.line_pressure = settings.line_pressure_sensor.map(self.line_pressure_sampler.read(settings))
                 self.line_sensor_error = self.line_pressure is None
                 if self.line_pressure is None:
                     self.line_pressure = -1
@@ -144,6 +209,7 @@ class CompressorController:
             
             if not self.tank_sensor_error or not self.tank_sensor_error:
                 print("tank_pressure = " + str(self.tank_pressure) + " line_pressure = " + str(self.line_pressure))
+            print("tank_pressure_sampler = " + str(self.tank_pressure_sampler.stats_dictionary))
             
     @property
     def _state_string(self):
@@ -168,51 +234,153 @@ class CompressorController:
 
         return ('O' if self.compressor_is_on else '_') + short_state + ('P' if self.purge_valve_open else '_')
     
+    def _build_state_dictionary(self):
+        tank_pressure = self.tank_pressure
+        line_pressure = self.line_pressure
+        line_sensor_error = self.line_sensor_error
+        
+        settings = self.settings.snapshot
+        start_pressure = settings.start_pressure
+        min_line_pressure = settings.min_line_pressure
+        duty_duration = settings.duty_duration
+        
+        total_runtime, log_start_time = self.activity_log.calculate_runtime()
+        return {
+            "system_time": time.time(),
+            "tank_pressure": tank_pressure,
+            "line_pressure": line_pressure,
+            "tank_underpressure": tank_pressure < start_pressure,
+            "line_underpressure": (tank_pressure < min_line_pressure) if line_sensor_error else\
+                                  line_pressure < min_line_pressure,
+            "tank_sensor_error": self.tank_sensor_error,
+            "line_sensor_error": line_sensor_error,
+            "sensor_time": self.sensor_time,
+            "pressure_change_error": self.pressure_change_error,
+            "min_pressure_change": self.min_pressure_change,
+            "max_pressure_change": self.max_pressure_change,
+            "compressor_on": self.compressor_is_on,
+            "motor_state": self.motor_state,
+            "run_request": self.request_run_flag,
+            "purge_open": self.purge_valve_open,
+            "purge_pending": self.purge_pending,
+            "unload_open": self.unload_valve_open,
+            "shutdown": self.shutdown_time,
+            "duty_recovery_time": self.duty_recovery_time,
+            "duty": self.activity_log.calculate_duty(duty_duration),
+            "runtime": total_runtime,
+            "log_start_time": log_start_time
+        }
+
+    # Builds a new status snapshot from the current state. Must be called with the lock held.
+    def _publish_status(self):
+        self.status_version += 1
+        self._status = StatusSnapshot(self.status_version, '"{}-{}"'.format(self.boot_time, self.status_version), self._build_state_dictionary())
+
+    # Marks the status snapshot as stale after a command has changed the state.
+    # It is rebuilt by the next status query (or the next update). Must be called
+    # with the lock held.
+    def _invalidate_status(self):
+        self._status = None
+
+    # Returns the current StatusSnapshot. The snapshot is shared by all callers
+    # and must not be modified.
     @property
-    def state_dictionary(self):        
+    def status(self):
         with self.lock:
-            self._read_ADC()
-            
-            tank_pressure = self.tank_pressure
-            line_pressure = self.line_pressure
-            line_sensor_error = self.line_sensor_error
-            
-            with self.settings.lock:
-                start_pressure = self.settings.start_pressure
-                min_line_pressure = self.settings.min_line_pressure
-                duty_duration = self.settings.duty_duration
-            
-            total_runtime, log_start_time = self.activity_log.calculate_runtime()
+            if self._status is None:
+                self._publish_status()
+            return self._status
+
+    # The state of the compressor as of the last update or command. The
+    # dictionary is shared, so callers must not modify it.
+    @property
+    def state_dictionary(self):
+        return self.status.state
+                
+    # Returns the most recent sensor values, with their age in milliseconds. These are
+    # the values read by the control loop, unless fresh is set (see _fresh_sensor_values()).
+    def sensor_values(self, fresh = False):
+        with self.lock:
+            if fresh and not self.settings.debug_mode & debug.DEBUG_ADC_SIMULATE:
+                return self._fresh_sensor_values()
+
+            age = time.ticks_diff(time.ticks_ms(), self.sensor_ticks)
             return {
-                "system_time": time.time(),
-                "tank_pressure": tank_pressure,
-                "line_pressure": line_pressure,
-                "tank_underpressure": tank_pressure < start_pressure,
-                "line_underpressure": (tank_pressure < min_line_pressure) if line_sensor_error else\
-                                      line_pressure < min_line_pressure,
+                "tank_pressure": self.tank_pressure,
+                "line_pressure": self.line_pressure,
                 "tank_sensor_error": self.tank_sensor_error,
-                "line_sensor_error": line_sensor_error,
-                "pressure_change_error": self.pressure_change_error,
-                "min_pressure_change": self.min_pressure_change,
-                "max_pressure_change": self.max_pressure_change,
-                "compressor_on": self.compressor_is_on,
-                "motor_state": self.motor_state,
-                "run_request": self.request_run_flag,
-                "purge_open": self.purge_valve_open,
-                "purge_pending": self.purge_pending,
-                "unload_open": self.unload_valve_open,
-                "shutdown": self.shutdown_time,
-                "duty_recovery_time": self.duty_recovery_time,
-                "duty": self.activity_log.calculate_duty(duty_duration),
-                "runtime": total_runtime,
-                "log_start_time": log_start_time
+                "line_sensor_error": self.line_sensor_error,
+                "sensor_time": self.sensor_time,
+                "sensor_age": age
             }
-                
+
+    # Samples the sensors for a client, without the filter (see SensorSampler.read_raw()),
+    # and scales them. The reading doesn't change the pressures, the sensor errors or
+    # the filters of the control loop, so its decisions (and a replay of its trace)
+    # don't depend on how often clients ask for fresh values. The sensors are only
+    # sampled again once the last reading is sensor_min_read_interval ms old, so that
+    # clients can't load the ADC. Must be called with the lock held.
+    def _fresh_sensor_values(self):
+        ticks = time.ticks_ms()
+        if self.fresh_sensor_values is None or time.ticks_diff(ticks, self.fresh_sensor_ticks) >= self.settings.sensor_min_read_interval:
+            settings = self.settings.snapshot
+            tank_pressure = settings.tank_pressure_sensor.map(self.tank_pressure_sampler.read_raw(settings.adc_samples))
+            if self.line_pressure_sampler is not None:
+                line_pressure = settings.line_pressure_sensor.map(self.line_pressure_sampler.read_raw(settings.adc_samples))
+            else:
+                line_pressure = tank_pressure
+            self.fresh_sensor_values = {
+                "tank_pressure": -1 if tank_pressure is None else tank_pressure,
+                "line_pressure": -1 if line_pressure is None else line_pressure,
+                "tank_sensor_error": tank_pressure is None,
+                "line_sensor_error": line_pressure is None,
+                "sensor_time": time.time()
+            }
+            self.fresh_sensor_ticks = ticks
+
+        values = dict(self.fresh_sensor_values)
+        values["sensor_age"] = time.ticks_diff(ticks, self.fresh_sensor_ticks)
+        return values
+
+    # Returns an unfiltered reading of a sensor ('tank' or 'line') before it is
+    # scaled, for calibrating the sensor, or None if there is no such sensor. The
+    # reading is separate from the ones of the control loop (see SensorSampler.read_raw()).
+    def raw_sensor_value(self, sensor):
+        if sensor == 'tank':
+            sampler = self.tank_pressure_sampler
+        elif sensor == 'line':
+            sampler = self.line_pressure_sampler
+        else:
+            sampler = None
+        if sampler is None:
+            return None
+
+        with self.lock:
+            return sampler.read_raw()
+
+    # Returns the state history to answer a query with, as (log, store), where store is
+    # the LogStore of the log or None. The state log is followed by the rollups, from
+    # the finest. For a resolution (the most seconds that may be between logs) the
+    # coarsest log that is fine enough is chosen, otherwise for a span (the seconds of
+    # history wanted) the finest log that reaches back far enough, or the coarsest one.
+    def state_history(self, resolution = None, span = None):
+        logs = [self.state_log] + self.state_rollups
+        stores = [self.state_log_store] + self.state_rollup_stores
+        index = 0
+        if resolution is not None:
+            while index + 1 < len(logs) and logs[index + 1].log_interval <= resolution:
+                index += 1
+        elif span is not None:
+            while index + 1 < len(logs) and logs[index].max_duration < span:
+                index += 1
+        return (logs[index], stores[index])
+
     # The next time the compressor is updated it will start to run if it can
     def request_run(self):
         with self.lock:
             self.request_run_flag = True
             self.command_log.log_command(compressorlogs.COMMAND_RUN)
+            self._invalidate_status()
     
     # Toggles the on state in a thread safe way
     def toggle_on_state(self):
@@ -227,6 +395,7 @@ class CompressorController:
         with self.lock:
             if self.request_run_flag:
                 self.request_run_flag = False
+                self._invalidate_status()
             elif self.motor_state == MOTOR_STATE_RUN:
                 self.pause()
             else:
@@ -249,6 +418,8 @@ class CompressorController:
                 if shutdown_in > 0:
                     self.shutdown_time = time.time() + shutdown_in
 
+                self._invalidate_status()
+
     
     def compressor_off(self):
         with self.lock:
@@ -265,6 +436,8 @@ class CompressorController:
 
                 self.purge()
 
+            self._invalidate_status()
+
     def purge(self, duration = None, delay = None):
         self.command_log.log_command(compressorlogs.COMMAND_PURGE)
         if duration is None:
@@ -281,6 +454,7 @@ class CompressorController:
         if duration > 0 and self.drain_solenoid is not None:
             with self.lock:
                 self.purge_pending = True
+                self._invalidate_status()
             await asyncio.sleep(delay)
             with self.lock:
                 # If the motor is running, stop it
@@ -291,12 +465,14 @@ class CompressorController:
                 self.activity_log.log_start(compressorlogs.EVENT_PURGE)
                 self.purge_pending = False
                 self.purge_valve_open = True
+                self._invalidate_status()
             
             await asyncio.sleep(duration)
             with self.lock:
                 self.drain_solenoid.value(0)
                 self.activity_log.log_stop()
                 self.purge_valve_open = False
+                self._invalidate_status()
 
     def _run_motor(self):
         if self.drain_solenoid is not None:
@@ -325,7 +501,7 @@ class CompressorController:
         # (it's a feature, not a bug)
         self.duty_recovery_time = 0
                 
-    def _should_pause(self, current_time, max_duty, current_duty):
+    def _should_pause(self, current_time, max_duty, current_duty, recovery_time):
         if self.pressure_change_alert:            
             try:
                 cancel_alert = self.pressure_change_alert.update()
@@ -365,7 +541,7 @@ class CompressorController:
 
             # TODO recovery_time could be calculated by averaging (or taking the  max) of the last few
             #      run cycles. For now it's just a setting
-            self.duty_recovery_time = current_time + self.settings.recovery_time
+            self.duty_recovery_time = current_time + recovery_time
             # TODO If we have a 'next' compressor we could pass them a duty token
             #      so that they run, and disable self so that we do not. This isn't the
             #      best approach to load balancing though, so more thought is be required
@@ -377,6 +553,7 @@ class CompressorController:
         self.command_log.log_command(compressorlogs.COMMAND_PAUSE)
         with self.lock:
             self._pause(MOTOR_STATE_PAUSE)
+            self._invalidate_status()
         
     def _pause(self, reason):
         if self.compressor_motor is not None:
@@ -406,15 +583,18 @@ class CompressorController:
             self.unload_solenoid.value(0)
 
     def _update(self):
-        self._read_ADC()
+        # All of the settings of an update come from one snapshot, so they are
+        # consistent even if the settings are updated by another thread
+        settings = self.settings.snapshot
+        self._read_ADC(settings)
         
         current_time = time.time()
         # Read the current tank pressure
         current_pressure = self.tank_pressure
         # If duty control is enabled calculate the current duty percentage
-        max_duty = self.settings.max_duty
+        max_duty = settings.max_duty
         if max_duty < 1:
-            current_duty = self.activity_log.calculate_duty(self.settings.duty_duration)
+            current_duty = self.activity_log.calculate_duty(settings.duty_duration)
         else:
             current_duty = 0
 
@@ -433,22 +613,31 @@ class CompressorController:
 
         # If the pressure limit has been reached turn off request_run,
         # even if the compressor has not run.
-        if current_pressure > self.settings.stop_pressure:
+        if current_pressure > settings.stop_pressure:
             self.pressure_change_alert = None
             self.request_run_flag = False
 
         # Before controlling the motor check to see if there is a reason that the compressor should be paused
-        pause_reason = self._should_pause(current_time, max_duty, current_duty)
+        pause_reason = self._should_pause(current_time, max_duty, current_duty, settings.recovery_time)
         if pause_reason is not None:
             self._pause(pause_reason)
             return
 
-        if current_pressure > self.settings.stop_pressure:
+        if current_pressure > settings.stop_pressure:
             self._pause(MOTOR_STATE_PRESSURE)
-        elif current_pressure < self.settings.start_pressure or self.request_run_flag:
+        elif current_pressure < settings.start_pressure or self.request_run_flag:
             self.request_run_flag = False
             self._run_motor()
 
+    # Queues the logs that have become final to be written to flash (see LogWriter).
+    # Must be called with the lock held.
+    def _store_logs(self):
+        if self.state_log_store is not None:
+            self.state_log_store.update()
+            self.activity_log_store.update()
+            for store in self.state_rollup_stores:
+                store.update()
+
     def _clean_up(self):
         # Make sure the motor isn't still running and the purge valve is closed,
         # since monitoring is about to stop
@@ -461,7 +650,10 @@ class CompressorController:
         try:
             while self.running:
                 watchdog.feed()                
-                self._update()
+                with self.lock:
+                    self._update()
+                    self._publish_status()
+                    self._store_logs()
                 await asyncio.sleep(self.poll_interval)
         finally:
             self._clean_up()
@@ -480,6 +672,8 @@ class CompressorController:
                 
                 with self.lock:
                     self._update()
+                    self._publish_status()
+                    self._store_logs()
                                 
                 # Put the thread to sleep
                 time.sleep(self.poll_interval)
@@ -501,6 +695,9 @@ class CompressorController:
         else:            
             print("Compressor instance is not threadsafe. Running using coroutines.")
             self.run_task = asyncio.create_task(self._run_coroutine(watchdog))
+
+        if self.log_writer is not None:
+            self.log_writer.run()
             
         if self.settings.compressor_on_power_up:
             self.compressor_on()
@@ -511,6 +708,23 @@ class CompressorController:
         # running coroutines it may be missed, so an explicity clean up will
         # ensure that the pins are set to low.
         self._clean_up()
+        if self.trace is not None:
+            self.trace.close()
+        # Write the logs that are waiting for a full block
+        if self.log_writer is not None:
+            with self.lock:
+                self._store_logs()
+                self.log_writer.stop()
+
+# An immutable snapshot of the state of the compressor. The json serialization
+# is prepared once so that it can be sent to any number of clients, and the etag
+# identifies the version for HTTP revalidation.
+class StatusSnapshot:
+    def __init__(self, version, etag, state):
+        self.version = version
+        self.etag = etag
+        self.state = state
+        self.json = ujson.dumps(state).encode()
 
 class PressureChangeAlertError(Exception):
     pass
@@ -525,7 +739,8 @@ class PressureChangeAlert:
             self.start_time = time.time()
             self.error_time = self.start_time + duration
             # Find the pressure slope before the alert was started
-            (self.historical_slope, b, count) = self.state_log.linear_least_squares(start_time = self.start_time - duration)
+            self.state_log.track_regression(duration)
+            (self.historical_slope, b, count) = self.state_log.regression(self.start_time)
             if count >= required_number_of_samples:
                 # The target slope is the current slope (which accounts for any current load) plus the required
                 # change in value.
@@ -544,6 +759,9 @@ class PressureChangeAlert:
             # since any loss due to a load will not be included in the target)
             self.target_pressure_change = target_pressure_change
             self.historical_slope = 0
+
+        # From now on only the logs since the alert was started are of interest
+        self.state_log.track_regression(duration, self.start_time)
             
         self.max_slope = 0
         self.min_slope = 0
@@ -556,7 +774,7 @@ class PressureChangeAlert:
         
         try:
             # Find the pressure slope since the alert was created
-            (current_slope, b, count) = self.state_log.linear_least_squares(start_time = self.start_time)
+            (current_slope, b, count) = self.state_log.regression(current_time)
             if count >= self.required_number_of_samples:
                 self.max_slope = max(self.max_slope, current_slope - self.historical_slope)
                 self.min_slope = min(self.min_slope, current_slope - self.historical_slope)
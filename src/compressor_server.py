@@ -19,146 +19,293 @@ class CompressorServer(ServerController):
         else:
             self.root_document = 'status.html'
         self.log_requests = settings.debug_mode & debug.DEBUG_WEB_REQUEST
+        self._settings_substitutions = None
+        self._settings_version = None
+
+        self.add_route('GET', '/', self.get_root, {}, ('If-None-Match', 'Accept-Encoding'))
+        self.add_route('GET', '/status', self.get_status, {'fresh': int}, ('If-None-Match',))
+        self.add_route('GET', '/sensors', self.get_sensors, {'fresh': int})
+        self.add_route('GET', '/settings', self.get_settings)
+        self.add_route('POST', '/settings', self.post_settings, {}, ('Content-Type',))
+        self.add_route('GET', '/state_logs', self.get_state_logs, {'since': int, 'resolution': int, 'span': int})
+        self.add_route('GET', '/activity_logs', self.get_activity_logs, {'since': int})
+        self.add_route('GET', '/state_logs.bin', self.get_state_logs_binary, {'since': int, 'resolution': int, 'span': int})
+        self.add_route('GET', '/activity_logs.bin', self.get_activity_logs_binary, {'since': int})
+        self.add_route('GET', '/events', self.get_events, {'since': int})
+        self.add_route('GET', '/on', self.get_on, {'shutdown_in': int})
+        self.add_route('GET', '/off', self.get_off, {})
+        self.add_route('GET', '/run', self.get_run, {})
+        self.add_route('GET', '/pause', self.get_pause, {})
+        self.add_route('GET', '/purge', self.get_purge, {'drain_duration': int, 'drain_delay': int})
+        self.add_route('GET', '/calibrate', self.get_calibrate, {'sensor': str, 'value': float, 'clear': int})
+
+    # The flattened public settings, which are only rebuilt when the settings change
+    @property
+    def settings_substitutions(self):
+        version = self.settings.version
+        if version != self._settings_version:
+            self._settings_substitutions = flatten_dict(self.settings.public_values_dictionary)
+            self._settings_version = version
+        return self._settings_substitutions
     
     # Overloads the base class method to supply state and settings values
     # as substitutions for html documents. Other documents do not get
-    # substitutions
-    async def return_http_document(self, writer, path):
+    # substitutions. Settings take precedence over state values with the
+    # same key.
+    async def return_http_document(self, writer, path, request_headers = None):
         if path.endswith('.html'):
-            values = {}
-            values.update(self.compressor.state_dictionary)
-            values.update(self.settings.public_values_dictionary)
-
-            values = flatten_dict(values);
+            values = (self.settings_substitutions, self.compressor.state_dictionary)
         else:
             values = None
         
-        await super().return_http_document(writer, path = path, substitutions = values)
+        await super().return_http_document(writer, path = path, substitutions = values, request_headers = request_headers)
+
+    # Adds the cost of sampling the pressure sensors and of writing the logs and
+    # settings to flash to the request metrics
+    def stats_dictionary(self):
+        stats = super().stats_dictionary()
+        compressor = self.compressor
+        sensors = {'tank_pressure': compressor.tank_pressure_sampler.stats_dictionary}
+        if compressor.line_pressure_sampler is not None:
+            sensors['line_pressure'] = compressor.line_pressure_sampler.stats_dictionary
+        stats['sensors'] = sensors
+        if self.settings.persister is not None:
+            stats['settings_persister'] = self.settings.persister.stats_dictionary
+        if compressor.state_log_store is not None:
+            stats['log_stores'] = {'state': compressor.state_log_store.stats_dictionary, 'activity': compressor.activity_log_store.stats_dictionary}
+            for store in compressor.state_rollup_stores:
+                stats['log_stores'][store.name] = store.stats_dictionary
+        return stats
 
     def return_ok(self, writer):
         self.return_json(writer, {'result':'ok'})
-    
-    async def serve_client(self, reader, writer):
+
+    # Streams changes to the compressor as Server-Sent Events until the client
+    # disconnects. Each event has the same json form as the polling endpoint:
+    #
+    #    status:   the keys of /status that have changed since the last event
+    #    state:    a /state_logs response with the new state logs
+    #    activity: an /activity_logs response with the new and updated activity and commands
+    #
+    # Logs are sent since the time of the previous event (or since the since
+    # parameter for the first event), so like the polling endpoints a log may be
+    # received more than once.
+    #
+    # At most http_max_streams streams are served at once, others get a 503 (the
+    # pages poll instead).
+    async def serve_events(self, writer, since):
+        if not self.start_stream(writer):
+            self.return_json(writer, {'result':'too many event streams'}, 503)
+            return
+
+        compressor = self.compressor
+        interval = self.settings.event_stream_interval
+        # The stream only ends when the connection is closed
+        writer.keep_alive = False
+        self.response_header(writer, content_type = 'text/event-stream', headers = {'Cache-Control': 'no-cache'})
+
+        sent_state = None
+        sent_version = None
+        state_revision = None
+        activity_revision = None
+        state_since = since
+        activity_since = since
         try:
-            request_line = await reader.readline()
-
-            # TODO Don't log every endpoint, only log serving pages (every endpoint gets chatty)
-            headers = await self.read_headers(reader)
-            (request_type, endpoint, parameters) = self.parse_request(request_line, log_request = self.log_requests)
-
-            compressor = self.compressor
-                
-            if request_type == 'GET':
-                if endpoint == '/settings':
-                    if len(parameters) > 0:
-                        try:
-                            # settings are only updated from the main thread, so it is sufficient
-                            # to rely on the individual locks in these two methods
-                            self.settings.update(parameters)
-                            self.settings.write_delta()
-                            
-                            self.return_json(writer, self.settings.public_values_dictionary)
-                        except KeyError as e:
-                            self.return_json(writer, {'result':'unknown key error', 'missing key': e}, 400)                    
+            while self.running:
+                status = compressor.status
+                if status.version != sent_version:
+                    if sent_state is None:
+                        delta = status.state
                     else:
-                        self.return_json(writer, self.settings.public_values_dictionary)
-                
-                # The rest of the commands only accept 0 - 2 parameters
-                elif len(parameters) > 2:                
-                    self.return_json(writer, {'result':'unexpected parameters'}, 400)                        
-                elif endpoint == '/purge':
-                    drain_duration = parameters.get("drain_duration", None)
-                    if drain_duration:
-                        drain_duration = int(drain_duration)
-
-                    drain_delay = parameters.get("drain_delay", None)
-                    if drain_delay:
-                        drain_delay = int(drain_delay)
-
-                    compressor.purge(drain_duration, drain_delay)
-                    self.return_ok(writer)
-                
-                # The rest of the commands only accept 0 or 1 parameters
-                elif len(parameters) > 1:
-                    self.return_json(writer, {'result':'unexpected parameters'}, 400)                        
-                elif endpoint == '/activity_logs':
-                    # Return all state logs since a value supplied by the caller (or all logs if there is no since)
-                    self.response_header(writer)
-                    writer.write('{"time":' + str(time.time()) + ',"activity":[')
-                    # The logs need to be locked so that they can be accessed. To prevent holding the lock
-                    # for too long (which could block the compressor thread), the dump commands set blocking
-                    # to False. But this will require the buffer to hold all of the data that is being sent,
-                    # so it is a memory consumption risk.
-                    
-                    # Return all activity logs that end after since
-                    await compressor.activity_log.dump(writer, int(parameters.get('since', 0)), 1, blocking = not compressor.thread_safe)
+                        delta = {key: value for (key, value) in status.state.items() if sent_state.get(key) != value}
+                    sent_state = status.state
+                    sent_version = status.version
+                    if delta:
+                        writer.write('event: status\ndata: ')
+                        writer.write(ujson.dumps(delta))
+                        writer.write('\n\n')
+
+                revision = compressor.state_log.revision
+                if revision != state_revision:
+                    now = time.time()
+                    writer.write('event: state\ndata: {"time":' + str(now) + ',"maxDuration":' + str(compressor.state_log.max_duration) + ',"state":[')
+                    await compressor.state_log.dump(writer, state_since)
+                    writer.write(']}\n\n')
+                    state_since = now
+                    state_revision = revision
+
+                revision = compressor.activity_log.revision + compressor.command_log.revision
+                if revision != activity_revision:
+                    now = time.time()
+                    writer.write('event: activity\ndata: {"time":' + str(now) + ',"activity":[')
+                    await compressor.activity_log.dump(writer, activity_since, 1)
                     writer.write('],"commands":[')
-                    # Return all command logs that fired after since
-                    await compressor.command_log.dump(writer, int(parameters.get('since', 0)), blocking = not compressor.thread_safe)
-                    writer.write(']}')
-                elif endpoint == '/state_logs':
-                    # Return all state logs since a value supplied by the caller (or all logs if there is no since)
-                    self.response_header(writer)
-                    # The logs need to be locked so that they can be accessed. To prevent holding the lock
-                    # for too long (which could block the compressor thread), the dump commands set blocking
-                    # to False. But this will require the buffer to hold all of the data that is being sent,
-                    # so it is a memory consumption risk.
-                    writer.write('{"time":' + str(time.time()) + ',"maxDuration":' + str(compressor.state_log.max_duration) + ',"state":[')
-                    await compressor.state_log.dump(writer, int(parameters.get('since', 0)), blocking = not compressor.thread_safe)
-                    writer.write(']}')
-                elif endpoint == '/on':
-                    shutdown_time = parameters.get("shutdown_in", None)
-                    if shutdown_time:
-                        shutdown_time = int(shutdown_time)
-                        
-                    compressor.compressor_on(shutdown_time)
-                    self.return_ok(writer)
-
-                # The rest of the commands do not accept parameters
-                elif len(parameters) > 0:
-                    self.return_json(writer, {'result':'unexpected parameters'}, 400)
-                elif endpoint == '/':
-                    await self.return_http_document(writer, self.root_document)
-                elif endpoint == '/status':
-                    self.return_json(writer, compressor.state_dictionary)
-                elif endpoint == '/run':
-                    compressor.request_run()
-                    self.return_ok(writer)
-                elif endpoint == '/off':
-                    compressor.compressor_off()
-                    self.return_ok(writer)
-                elif endpoint == '/pause':
-                    compressor.pause()
-                    self.return_ok(writer)
-                else:
-                    # Not an API endpoint, try to serve the requested document
-                    # TODO Need to strip the leading '/' off of the endpoint to get the path
-                    await self.return_http_document(writer, endpoint)
-            elif request_type == 'POST':
-                if len(parameters) > 0:
-                    self.return_json(writer, {'result':'unexpected parameters'}, 400)                
-                elif endpoint == '/settings' and headers['Content-Type'] == 'application/json':
-                    content_length = int(headers['Content-Length'])                    
-                    raw_data = await reader.read(content_length)
-                    parameters = ujson.loads(raw_data)
-
-                    try:
-                        # settings are only updated from the main thread, so it is sufficient
-                        # to rely on the individual locks in these two methods
-                        self.settings.update(parameters)
-                        self.settings.write_delta()
-                        
-                        self.return_ok(writer)
-                    except KeyError as e:
-                        self.return_json(writer, {'result':'unknown key error', 'missing key': e}, 400)                        
-                else:
-                    self.return_json(writer, {'result':'unknown endpoint'}, 404)
-            else:
-                self.return_json(writer, {'result':'unknown method'}, 404)
-        except Exception as e:
-            print("Error handling request.")
-            sys.print_exception(e)
-        finally:
-            await writer.drain()
-            await writer.wait_closed()
+                    await compressor.command_log.dump(writer, activity_since)
+                    writer.write(']}\n\n')
+                    activity_since = now
+                    activity_revision = revision
+
+                await writer.drain()
+                await asyncio.sleep_ms(interval)
+        except OSError:
+            # The client has closed the connection
+            pass
+    
+    # Settings can be changed with query parameters (any number of them) or by
+    # posting json. Either way the updated settings are saved.
+    async def get_settings(self, writer, parameters, headers, body):
+        if len(parameters) > 0:
+            try:
+                # settings are only updated from the main thread, so it is sufficient
+                # to rely on the individual locks in these two methods
+                self.settings.update(parameters)
+                self.settings.write_delta()
+            except KeyError as e:
+                self.return_json(writer, {'result':'unknown key error', 'missing key': e}, 400)
+                return
+            except ValueError as e:
+                self.return_json(writer, {'result':'invalid value', 'error': str(e)}, 400)
+                return
+        self.return_json(writer, self.settings.public_values_dictionary)
+
+    async def post_settings(self, writer, parameters, headers, body):
+        if headers.get('Content-Type') != 'application/json' or not body:
+            self.return_json(writer, {'result':'expected json'}, 400)
+            return
+
+        try:
+            # settings are only updated from the main thread, so it is sufficient
+            # to rely on the individual locks in these two methods
+            self.settings.update(ujson.loads(body))
+            self.settings.write_delta()
+
+            self.return_ok(writer)
+        except KeyError as e:
+            self.return_json(writer, {'result':'unknown key error', 'missing key': e}, 400)
+        except ValueError as e:
+            self.return_json(writer, {'result':'invalid value', 'error': str(e)}, 400)
+
+    # Records calibration points for a pressure sensor (sensor=tank or sensor=line).
+    # The sensor is read, and with value (the pressure shown on a reference gauge)
+    # the reading is added to the sensor's calibration curve, replacing any point for
+    # the same pressure. With clear=1 the curve is emptied first. Without either the
+    # reading is only returned, along with the pressure it maps to and the curve.
+    async def get_calibrate(self, writer, parameters, headers, body):
+        sensor = parameters.get('sensor')
+        raw = self.compressor.raw_sensor_value(sensor)
+        if raw is None:
+            self.return_json(writer, {'result':'unknown sensor'}, 400)
+            return
+
+        key = sensor + '_pressure_sensor'
+        points = self.settings[key].calibration
+        value = parameters.get('value')
+        if parameters.get('clear') or value is not None:
+            if parameters.get('clear'):
+                points = []
+            if value is not None:
+                points = [point for point in points if point[1] != value] + [[raw, value]]
+            self.settings.update({key: {'calibration': points}})
+            self.settings.write_delta()
+
+        self.return_json(writer, {'sensor': sensor, 'raw': raw, 'value': self.settings[key].map(raw), 'calibration': points})
+
+    async def get_purge(self, writer, parameters, headers, body):
+        self.compressor.purge(parameters.get('drain_duration'), parameters.get('drain_delay'))
+        self.return_ok(writer)
+
+    async def get_on(self, writer, parameters, headers, body):
+        self.compressor.compressor_on(parameters.get('shutdown_in'))
+        self.return_ok(writer)
+
+    async def get_off(self, writer, parameters, headers, body):
+        self.compressor.compressor_off()
+        self.return_ok(writer)
+
+    async def get_run(self, writer, parameters, headers, body):
+        self.compressor.request_run()
+        self.return_ok(writer)
+
+    async def get_pause(self, writer, parameters, headers, body):
+        self.compressor.pause()
+        self.return_ok(writer)
+
+    # The status is built once per update and shared by all requests. If the
+    # client already has this version only the headers are sent. The status always
+    # has the sensor values of the last update, fresh=1 is accepted for older clients
+    # but ignored (use /sensors?fresh=1 for a fresh reading).
+    async def get_status(self, writer, parameters, headers, body):
+        status = self.compressor.status
+        if headers.get('If-None-Match') == status.etag:
+            self.response_header(writer, 304, headers = {'ETag': status.etag})
+        else:
+            self.response_header(writer, headers = {'ETag': status.etag, 'Cache-Control': 'no-cache'}, content_length = len(status.json))
+            writer.write(status.json)
+
+    # Returns the latest sensor values and their age. With fresh=1 the sensors are
+    # sampled for the request (see CompressorController.sensor_values())
+    async def get_sensors(self, writer, parameters, headers, body):
+        self.return_json(writer, self.compressor.sensor_values(bool(parameters.get('fresh'))))
+
+    # Returns the activity logs that end after since and the command logs that
+    # fired after since (or all logs if there is no since)
+    async def get_activity_logs(self, writer, parameters, headers, body):
+        compressor = self.compressor
+        since = parameters.get('since', 0)
+        self.response_header(writer)
+        writer.write('{"time":' + str(time.time()) + ',"activity":[')
+        await compressor.activity_log.dump(writer, since, 1)
+        writer.write('],"commands":[')
+        await compressor.command_log.dump(writer, since)
+        writer.write(']}')
+
+    # Returns the state history to answer a /state_logs query with (see
+    # CompressorController.state_history()) and the time to send logs since. A span
+    # without a since asks for the last span seconds.
+    def state_history(self, parameters):
+        resolution = parameters.get('resolution')
+        span = parameters.get('span')
+        (log, store) = self.compressor.state_history(resolution, span)
+        since = parameters.get('since', 0)
+        if since == 0 and span is not None:
+            since = time.time() - span
+        return (log, store, since)
+
+    # Returns all state logs since a value supplied by the caller (or all logs in memory
+    # if there is no since). Logs that are older than the ones in memory are read from
+    # flash, but only for an explicit since or span, so that a new chart doesn't load
+    # the whole history.
+    #
+    # Longer histories are summarized at coarser intervals (see RollupLog), which are
+    # chosen with a resolution or span parameter. The logs of a summary also have
+    # tank_min and tank_max, and the resolution of the logs is returned.
+    async def get_state_logs(self, writer, parameters, headers, body):
+        (log, store, since) = self.state_history(parameters)
+        self.response_header(writer)
+        writer.write('{"time":' + str(time.time()) + ',"resolution":' + str(log.log_interval) + ',"maxDuration":' + str(log.max_duration) + ',"state":[')
+        with log.lock:
+            oldest_time = log[log.count - 1][0] if log.count else time.time() + 1
+        written = await log.dump(writer, since)
+        if since > 0 and store is not None:
+            await store.dump(writer, since, oldest_time, written)
+        writer.write(']}')
+
+    # The same logs as /activity_logs, as two sections of packed records (see RingLog.dump_binary)
+    async def get_activity_logs_binary(self, writer, parameters, headers, body):
+        compressor = self.compressor
+        since = parameters.get('since', 0)
+        self.response_header(writer, content_type = 'application/octet-stream')
+        await compressor.activity_log.dump_binary(writer, since, 1, {"time": time.time()})
+        await compressor.command_log.dump_binary(writer, since)
+
+    # The same logs as /state_logs, as packed records (see RingLog.dump_binary)
+    async def get_state_logs_binary(self, writer, parameters, headers, body):
+        (log, store, since) = self.state_history(parameters)
+        self.response_header(writer, content_type = 'application/octet-stream')
+        await log.dump_binary(writer, since, header = {"time": time.time(), "resolution": log.log_interval, "maxDuration": log.max_duration})
+
+    async def get_events(self, writer, parameters, headers, body):
+        await self.serve_events(writer, parameters.get('since', 0))
 
+    async def get_root(self, writer, parameters, headers, body):
+        await self.return_http_document(writer, self.root_document, headers)
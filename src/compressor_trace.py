@@ -0,0 +1,374 @@
+import ustruct as struct
+import ujson
+import time
+import os
+
+import compressor_controller
+
+# A trace file records the inputs of a CompressorController, so that a field problem
+# can be replayed on a host (see host/replay.py). It starts with a header:
+#
+#    'CTRC', version (B), json length (H), start time (L), followed by the json of
+#    {"settings": persistent settings, "static": STATIC_SETTINGS, "state_format": ...,
+#     "sequence": the number of files recorded before this one since the controller started,
+#     "controller": the state of the controller when the file was started (see controller_state())}
+#
+# and continues with records. Every record starts with the record type (B), the
+# milliseconds since the trace started (L), and a correction (l) to get the value of
+# time.time() seen by the controller: start time + milliseconds//1000 + correction.
+#
+#    TICK:     tank sensor (f), line sensor (f), outputs (B)
+#              The filtered raw sensor values of an update, and the outputs after it
+#    COMMAND:  command (B), two arguments (ii), NO_ARGUMENT if they were not supplied
+#    BUTTON:   button (B), value (B)
+#    SETTINGS: json length (H), json of the values passed to Settings.update()
+#    STATE:    a StateLog entry (in the StateLog's format), after the update that logged it
+TRACE_MAGIC = b'CTRC'
+TRACE_VERSION = 2
+HEADER_FORMAT = '<4sBHL'
+RECORD_PREFIX_FORMAT = '<BLl'
+
+TRACE_TICK = 1
+TRACE_COMMAND = 2
+TRACE_BUTTON = 3
+TRACE_SETTINGS = 4
+TRACE_STATE = 5
+
+TICK_FORMAT = '<BLlffB'
+COMMAND_FORMAT = '<BLlBii'
+BUTTON_FORMAT = '<BLlBB'
+SETTINGS_FORMAT = '<BLlH'
+PREFIX_SIZE = struct.calcsize(RECORD_PREFIX_FORMAT)
+TICK_SIZE = struct.calcsize(TICK_FORMAT)
+COMMAND_SIZE = struct.calcsize(COMMAND_FORMAT)
+BUTTON_SIZE = struct.calcsize(BUTTON_FORMAT)
+SETTINGS_SIZE = struct.calcsize(SETTINGS_FORMAT)
+
+NO_ARGUMENT = -2147483648
+
+# The public commands of the controller that are recorded, and the names of their arguments
+COMMANDS = (
+    ('request_run', ()),
+    ('toggle_on_state', ()),
+    ('toggle_run_state', ()),
+    ('compressor_on', ('shutdown_in',)),
+    ('compressor_off', ()),
+    ('purge', ('duration', 'delay')),
+    ('pause', ())
+)
+
+BUTTONS = ('power', 'run_pause', 'purge', 'menu', 'value_up', 'value_down')
+
+# The static settings that change how the controller behaves, which are recorded
+# in the header so that the replay can be configured the same way
+STATIC_SETTINGS = ('line_pressure_pin', 'compressor_motor_pin', 'unload_solenoid_pin', 'drain_solenoid_pin', 'debug_mode')
+
+# Output bits of a tick
+OUTPUT_MOTOR = 1
+OUTPUT_UNLOAD = 2
+OUTPUT_PURGE = 4
+OUTPUT_ON = 8
+OUTPUT_PRESSURE_CHANGE_ERROR = 16
+OUTPUT_PURGE_PENDING = 32
+
+# Returns the output bits for the current state of a controller
+def controller_outputs(controller):
+    return (OUTPUT_MOTOR if controller.motor_state == compressor_controller.MOTOR_STATE_RUN else 0) |\
+           (OUTPUT_UNLOAD if controller.unload_valve_open else 0) |\
+           (OUTPUT_PURGE if controller.purge_valve_open else 0) |\
+           (OUTPUT_ON if controller.compressor_is_on else 0) |\
+           (OUTPUT_PRESSURE_CHANGE_ERROR if controller.pressure_change_error else 0) |\
+           (OUTPUT_PURGE_PENDING if controller.purge_pending else 0)
+
+# The attributes of the controller that are restored before a replay
+CONTROLLER_ATTRIBUTES = ('compressor_is_on', 'request_run_flag', 'motor_state', 'purge_valve_open', 'unload_valve_open',
+                         'purge_pending', 'shutdown_time', 'unload_close_time', 'duty_recovery_time', 'pressure_change_error')
+
+# Returns the state of a controller that a replay needs in order to continue from
+# it: its attributes, the activity logs (which the duty is calculated from) and the
+# state that the StateLog is accumulating. Pressure change alerts and purges that
+# are in progress aren't included.
+def controller_state(controller):
+    activity_log = controller.activity_log
+    state_log = controller.state_log
+    return {
+        "attributes": {name: getattr(controller, name) for name in CONTROLLER_ATTRIBUTES},
+        "activity_logs": [(log[0], log[1], log[2].decode()) for log in (activity_log[i] for i in range(activity_log.count - 1, -1, -1))],
+        "activity_open": activity_log.activity_open,
+        "state_log": (state_log.last_log_time, state_log.tank_total, state_log.line_total, state_log.delayed_count)
+    }
+
+# Restores the state of a controller from the result of controller_state()
+def restore_controller_state(controller, state):
+    for (name, value) in state["attributes"].items():
+        setattr(controller, name, value)
+
+    activity_log = controller.activity_log
+    for (start, stop, event) in state["activity_logs"]:
+        activity_log.log((start, stop, event.encode()))
+    activity_log.activity_open = state["activity_open"]
+    activity_log.restored()
+
+    state_log = controller.state_log
+    (state_log.last_log_time, state_log.tank_total, state_log.line_total, state_log.delayed_count) = state["state_log"]
+
+# TraceRecorder records the inputs of a controller to a trace file. It attaches to
+# the controller by wrapping its sensor samplers, its public commands and _update(),
+# so the controller doesn't need to know about it except to report button presses
+# (log_button()) and to close it.
+#
+# Records are packed into a buffer that is written to the file when it is full, so
+# a tick only costs a pack_into(). When the file reaches max_size it is renamed to
+# path + '.old' (replacing the previous one) and a new trace is started, so at most
+# two files are kept. Each file starts with the state of the controller, so it can
+# be replayed on its own.
+#
+# Recording must never stop the controller, so if a record can't be written (for
+# example because the flash is full) the error is printed and tracing stops.
+class TraceRecorder:
+    def __init__(self, controller, path, max_size, buffer_size = 1024):
+        self.controller = controller
+        self.path = path
+        self.max_size = max_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.length = 0         # Bytes in the buffer
+        self.file = None
+        self.file_size = 0
+        self.sequence = 0       # The number of files that were started before this one
+        self.depth = 0          # > 0 while a recorded call is running, so nested calls aren't recorded
+        self.tank_value = 0     # The last values read by the samplers
+        self.line_value = 0
+        self.state_generation = controller.state_log.generation
+        self.error = None       # The error that stopped tracing
+
+        self._wrap_sampler('tank_pressure_sampler', 'tank_value')
+        self._wrap_sampler('line_pressure_sampler', 'line_value')
+        for (command, (name, arguments)) in enumerate(COMMANDS):
+            self._wrap_command(command, name, arguments)
+        self._wrap_update()
+        self._wrap_settings()
+
+        self._start_file()
+
+    def _wrap_sampler(self, sampler_name, value_name):
+        sampler = getattr(self.controller, sampler_name)
+        if sampler is None:
+            return
+        read = sampler.read
+
+        def recording_read(settings = None):
+            value = read(settings)
+            setattr(self, value_name, value)
+            return value
+        sampler.read = recording_read
+
+    def _wrap_command(self, command, name, arguments):
+        controller = self.controller
+        method = getattr(controller, name)
+
+        def recording_command(*args, **kwargs):
+            with controller.lock:
+                if self.depth == 0:
+                    self._record(self._record_command, command, arguments, args, kwargs)
+                self.depth += 1
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    self.depth -= 1
+        setattr(controller, name, recording_command)
+
+    def _record_command(self, command, arguments, args, kwargs):
+        values = [NO_ARGUMENT, NO_ARGUMENT]
+        for i in range(len(arguments)):
+            value = args[i] if i < len(args) else kwargs.get(arguments[i])
+            if value is not None:
+                values[i] = int(value)
+        self._pack(COMMAND_FORMAT, COMMAND_SIZE, TRACE_COMMAND, self._time(), command, values[0], values[1])
+
+    def _wrap_update(self):
+        controller = self.controller
+        update = controller._update
+
+        def recording_update():
+            # Files are only started between updates, so that the controller state
+            # recorded in the header is the state that the next update starts from
+            if self.file is not None and self.file_size + self.length >= self.max_size:
+                self._record(self._rotate)
+
+            # The records of the update have the time that it started at, which is the time seen by the controller
+            record_time = self._time()
+            self.depth += 1
+            try:
+                update()
+            finally:
+                self.depth -= 1
+            self._record(self._record_tick, record_time)
+        controller._update = recording_update
+
+    def _record_tick(self, record_time):
+        controller = self.controller
+        self._pack(TICK_FORMAT, TICK_SIZE, TRACE_TICK, record_time, self.tank_value, self.line_value, controller_outputs(controller))
+
+        # Record any state that was logged by the update
+        state_log = controller.state_log
+        if state_log.generation != self.state_generation:
+            self.state_generation = state_log.generation
+            stride = state_log.stride
+            self._reserve(PREFIX_SIZE + stride)
+            struct.pack_into(RECORD_PREFIX_FORMAT, self.buffer, self.length, TRACE_STATE, *record_time)
+            offset = self.length + PREFIX_SIZE
+            state_log._copy_logs(self.view[offset:offset + stride], 0, 1)
+            self.length = offset + stride
+
+    def _wrap_settings(self):
+        settings = self.controller.settings
+        update = settings.update
+
+        def recording_update(values):
+            with self.controller.lock:
+                if self.depth == 0:
+                    self._record(self._record_settings, values)
+                update(values)
+        settings.update = recording_update
+
+    def _record_settings(self, values):
+        data = ujson.dumps(values).encode()
+        self._reserve(SETTINGS_SIZE + len(data))
+        struct.pack_into(SETTINGS_FORMAT, self.buffer, self.length, TRACE_SETTINGS, *self._time(), len(data))
+        offset = self.length + SETTINGS_SIZE
+        self.view[offset:offset + len(data)] = data
+        self.length = offset + len(data)
+
+    # Records a button edge. Button presses are replayed through the commands and
+    # settings updates that they cause, so these are only for reference.
+    def log_button(self, name, value):
+        if name in BUTTONS:
+            with self.controller.lock:
+                self._record(self._pack, BUTTON_FORMAT, BUTTON_SIZE, TRACE_BUTTON, self._time(), BUTTONS.index(name), 1 if value else 0)
+
+    # Calls a method that records something, unless tracing has stopped. Any error
+    # stops tracing rather than being raised to the controller.
+    def _record(self, method, *args):
+        if self.error is not None:
+            return
+        try:
+            method(*args)
+        except Exception as e:
+            self.error = e
+            print('Tracing stopped: {}'.format(e))
+            self.length = 0
+            try:
+                self.close()
+            except Exception:
+                self.file = None
+
+    # Returns the time fields of a record prefix
+    def _time(self):
+        milliseconds = time.ticks_diff(time.ticks_ms(), self.start_ticks)
+        return (milliseconds, time.time() - self.start_time - milliseconds//1000)
+
+    # Packs a record into the buffer. record_time is the result of _time(), and
+    # values are the fields after the record prefix.
+    def _pack(self, record_format, size, record_type, record_time, *values):
+        self._reserve(size)
+        struct.pack_into(record_format, self.buffer, self.length, record_type, record_time[0], record_time[1], *values)
+        self.length += size
+
+    # Makes room for size bytes in the buffer
+    def _reserve(self, size):
+        if self.length + size > len(self.buffer):
+            self.flush()
+        if size > len(self.buffer):
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+
+    def _start_file(self):
+        settings = self.controller.settings
+        self.start_time = time.time()
+        self.start_ticks = time.ticks_ms()
+        description = ujson.dumps({
+            "settings": settings.values_dictionary,
+            "sequence": self.sequence,
+            "controller": controller_state(self.controller),
+            "static": {name: getattr(settings, name) for name in STATIC_SETTINGS},
+            "state_format": self.controller.state_log.struct_format
+        }).encode()
+
+        self.file = open(self.path, 'wb')
+        self.file.write(struct.pack(HEADER_FORMAT, TRACE_MAGIC, TRACE_VERSION, len(description), self.start_time))
+        self.file.write(description)
+        self.file_size = struct.calcsize(HEADER_FORMAT) + len(description)
+
+    # Writes the buffered records to the file
+    def flush(self):
+        if self.file is None or self.length == 0:
+            return
+        self.file.write(self.view[0:self.length])
+        self.file.flush()
+        self.file_size += self.length
+        self.length = 0
+
+    # Moves the file to path + '.old' and starts a new one
+    def _rotate(self):
+        self.flush()
+        self.file.close()
+        try:
+            os.remove(self.path + '.old')
+        except OSError:
+            pass
+        os.rename(self.path, self.path + '.old')
+        self.sequence += 1
+        self._start_file()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+# Reads a trace file. records() yields (type, milliseconds, time, values), where
+# time is the value of time.time() seen by the controller and values are the
+# fields that follow the record prefix (the json is decoded for SETTINGS, and
+# STATE values are the StateLog tuple).
+class TraceReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        (magic, version, length, self.start_time) = struct.unpack_from(HEADER_FORMAT, self.data, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError('{} is not a version {} trace'.format(path, TRACE_VERSION))
+        offset = struct.calcsize(HEADER_FORMAT)
+        self.description = ujson.loads(self.data[offset:offset + length])
+        self.state_format = self.description['state_format']
+        self.records_offset = offset + length
+
+    def records(self):
+        data = self.data
+        offset = self.records_offset
+        prefix_size = PREFIX_SIZE
+        state_size = struct.calcsize(self.state_format)
+        while offset + prefix_size <= len(data):
+            (record_type, milliseconds, correction) = struct.unpack_from(RECORD_PREFIX_FORMAT, data, offset)
+            record_time = self.start_time + milliseconds//1000 + correction
+            if record_type == TRACE_TICK:
+                values = struct.unpack_from(TICK_FORMAT, data, offset)[3:]
+                offset += TICK_SIZE
+            elif record_type == TRACE_COMMAND:
+                values = struct.unpack_from(COMMAND_FORMAT, data, offset)[3:]
+                offset += COMMAND_SIZE
+            elif record_type == TRACE_BUTTON:
+                values = struct.unpack_from(BUTTON_FORMAT, data, offset)[3:]
+                offset += BUTTON_SIZE
+            elif record_type == TRACE_SETTINGS:
+                length = struct.unpack_from(SETTINGS_FORMAT, data, offset)[3]
+                offset += SETTINGS_SIZE
+                values = ujson.loads(data[offset:offset + length])
+                offset += length
+            elif record_type == TRACE_STATE:
+                values = struct.unpack_from(self.state_format, data, offset + prefix_size)
+                offset += prefix_size + state_size
+            else:
+                raise ValueError('Unknown record type {} at {}'.format(record_type, offset))
+            yield (record_type, milliseconds, record_time, values)
@@ -135,6 +135,8 @@ class CompressorPinMonitor(pin_monitor.PinMonitor):
         
     def pin_value_did_change(self, pin_name, new_value, previous_duration):
         #print('Pin {} changed value to {} after {} millis at old value'.format(pin_name, new_value, previous_duration))
+        if self.compressor.trace is not None:
+            self.compressor.trace.log_button(pin_name, new_value)
         
         if not new_value:
             if pin_name == 'power':
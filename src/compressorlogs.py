@@ -1,23 +1,71 @@
 from ringlog import RingLog
 from linear_least_squares import linear_least_squares
 
+import ustruct as struct
 import time
+from array import array
 
 EVENT_RUN=const(b'R')
 EVENT_PURGE=const(b'P')
 
+# Logs activities (runs of the motor and purges) with their start and stop times.
+# An activity is open from log_start() until log_stop(), or until the next
+# log_start(), which stops it.
 class EventLog(RingLog):
-    def __init__(self, thread_safe = True):
-        RingLog.__init__(self, "LLs", ["start", "stop", "event"], 40, thread_safe = thread_safe)
+    time_fields = (0, 1)
+
+    def __init__(self, thread_safe = True, size_limit = 40, columnar = False):
+        RingLog.__init__(self, "<LLs", ["start", "stop", "event"], size_limit, thread_safe = thread_safe, columnar = columnar)
         self.console_log = False
         self.activity_open = False
-            
-    # Open a new log entry for the start time
+
+        # Running tallies of the runtime of closed run events. These are updated
+        # when events are logged, closed and evicted so that duty and runtime
+        # queries don't need to scan the log.
+        self.total_runtime = 0       # Runtime of all of the closed run events in the log
+        self.window_runtime = 0      # Runtime of the closed run events in the duty window
+        self.window_count = 0        # The number of most recent logs that may overlap the duty window
+        self.window_duration = None  # The duration of the duty window that is being tallied
+        self.window_start = 0        # The start of the duty window when it was last advanced
+
+    # Returns the runtime of a closed log
+    def _runtime(self, log):
+        return log[1] - log[0] if log[2] == EVENT_RUN else 0
+
+    # The open log is still being updated, so it isn't final
+    @property
+    def closed_generation(self):
+        return self.generation - 1 if self.activity_open else self.generation
+
+    # Recalculates the tallies from the logs (the duty window is rebuilt by the next query)
+    def restored(self):
+        with self.lock:
+            self.total_runtime = 0
+            for i in range(1 if self.activity_open else 0, self.count):
+                self.total_runtime += self._runtime(self[i])
+            self.window_duration = None
+
+    # Open a new log entry for the start time. Only one activity can be open at a
+    # time, so if an activity is still open it is stopped now, as if log_stop() had
+    # been called first. (An activity that was left open used to keep its stop time
+    # in the distant future, so it was counted as running forever, and the next
+    # log_stop() closed the new activity instead.)
     def log_start(self, event):
         with self.lock:
+            self.log_stop()
+
+            if self.count == self.size_limit:
+                # The oldest log is about to be overwritten. Remove it from the tallies.
+                runtime = self._runtime(self[self.count - 1])
+                self.total_runtime -= runtime
+                if self.window_count == self.size_limit:
+                    self.window_runtime -= runtime
+                    self.window_count -= 1
+
             start = time.time()
             # TODO Instead of + 1000000 this should just be int max, for the max possible time
             self.log((start, start + 100000000, event))
+            self.window_count += 1
             self.activity_open = True
         
     # Update the current log entry with the current time
@@ -36,6 +84,12 @@ class EventLog(RingLog):
                 # Update the log with the current time as the stop time
                 self[0] = (start, stop, event)
                 self.activity_open = False
+
+                # The log is closed, so its runtime is final. The most recent log
+                # is always inside the duty window.
+                if event == EVENT_RUN:
+                    self.total_runtime += stop - start
+                    self.window_runtime += stop - start
             
     def map_value_for_dump(self, name, value):
         if name == 'stop':
@@ -55,6 +109,19 @@ class EventLog(RingLog):
         # Find the total time that the compressor was running in the window (query_start - query_end)
         with self.lock:            
             total_runtime = 0
+            if self.columns is not None:
+                # The order of the logs doesn't matter, so the columns are read by
+                # slot. The first count slots are the ones that have been used.
+                (starts, stops, events) = self.columns
+                run = EVENT_RUN[0]
+                for slot in range(self.count):
+                    start = max(query_start, starts[slot])
+                    stop = min(query_end, stops[slot])
+                    if events[slot] == run and stop > start:
+                        total_runtime += stop - start
+                    first_log_time = min(first_log_time, max(query_start, start))
+                return (total_runtime, first_log_time)
+
             for i in range(len(self)):
                 log = self[i]
                 event = log[2]
@@ -78,6 +145,38 @@ class EventLog(RingLog):
             # both values are clamped to the log duration and the query window
             return (total_runtime, first_log_time)
             
+    # Returns the runtime of the open log (if it is a run event) that falls
+    # after query_start
+    def _open_runtime(self, query_start, now):
+        if self.activity_open:
+            log = self[0]
+            if log[2] == EVENT_RUN:
+                return max(0, now - max(query_start, log[0]))
+        return 0
+
+    # Moves the start of the duty window to query_start, dropping logs that
+    # ended before it from the window tally. Since activities don't overlap
+    # the logs end in order, so each log only needs to be dropped once.
+    def _advance_window(self, query_start, duration):
+        if duration != self.window_duration or query_start < self.window_start:
+            # The window has changed in a way that can't be tracked incrementally
+            # (the duration was changed, or the clock moved backwards). Start
+            # again from all of the logs.
+            self.window_duration = duration
+            self.window_count = self.count
+            self.window_runtime = self.total_runtime
+        self.window_start = query_start
+
+        while self.window_count > 0:
+            index = self.window_count - 1
+            if index == 0 and self.activity_open:
+                break
+            log = self[index]
+            if log[1] > query_start:
+                break
+            self.window_runtime -= self._runtime(log)
+            self.window_count = index
+
     def calculate_duty(self, duration):
         now = time.time()
         # Clamp the start of the sample window to 0
@@ -85,8 +184,20 @@ class EventLog(RingLog):
             query_start = now - duration
         else:
             query_start = now
-        
-        total_runtime, first_log_time = self._analyze_logs(query_start, now)
+
+        with self.lock:
+            self._advance_window(query_start, duration)
+
+            total_runtime = self.window_runtime
+            if self.window_count > 0:
+                # The oldest log in the window may have started before the window
+                # did. Only count the part of it that is inside the window.
+                index = self.window_count - 1
+                if not (index == 0 and self.activity_open):
+                    log = self[index]
+                    if log[2] == EVENT_RUN and log[0] < query_start:
+                        total_runtime -= query_start - log[0]
+            total_runtime += self._open_runtime(query_start, now)
 
         duty = total_runtime/duration
 
@@ -96,8 +207,16 @@ class EventLog(RingLog):
         # Return the percentage of the sample window where the compressor was running
         return duty
 
+    # Returns the total runtime of all of the logs, and the start time of the
+    # oldest log (or the current time if there are no logs)
     def calculate_runtime(self):
-        return self._analyze_logs(0, time.time())
+        now = time.time()
+        with self.lock:
+            if self.count == 0:
+                return (0, now)
+
+            first_log_time = min(now, self[self.count - 1][0])
+            return (self.total_runtime + self._open_runtime(0, now), first_log_time)
     
 COMMAND_ON=const(b'O')
 COMMAND_OFF=const(b'F')
@@ -107,20 +226,166 @@ COMMAND_PURGE=const(b'P')
 
 class CommandLog(RingLog):
     def __init__(self, thread_safe):
-        RingLog.__init__(self, "Ls", ["time", "command"], 10, thread_safe = thread_safe)
+        RingLog.__init__(self, "<Ls", ["time", "command"], 10, thread_safe = thread_safe, ordered_index = 0)
         self.console_log = False
 
     def log_command(self, event):
         self.log((time.time(), event))
 
+# StateLog records the pressures and state of the compressor.
+#
+# StateLog can also maintain a linear regression of one of its values over a
+# trailing time window (regression_window seconds, optionally starting no earlier
+# than regression_since). Running sums of the logs in the window are updated as
+# logs are added and evicted, so regression() doesn't need to scan the log.
 class StateLog(RingLog):
-    def __init__(self, log_interval, thread_safe, size_limit = 200):
-        RingLog.__init__(self, "Lfff3s", ["time", "tank_pressure", "line_pressure", "duty", "state"], size_limit, thread_safe = thread_safe)
+    # Every sample is also added to rollup (see RollupLog), if there is one
+    def __init__(self, log_interval, thread_safe, size_limit = 200, regression_window = None, regression_index = 1, rollup = None, columnar = False):
+        RingLog.__init__(self, "<Lfff3s", ["time", "tank_pressure", "line_pressure", "duty", "state"], size_limit, thread_safe = thread_safe, ordered_index = 0, columnar = columnar)
         self.last_log_time = 0
         self.log_interval = log_interval
+        self.rollup = rollup
         self.console_log = False
         self._reset_tally()
+
+        self.regression_window = regression_window  # The duration of the regression window, or None to disable it
+        self.regression_since = None                # The earliest time that will be included in the regression
+        self.regression_index = regression_index    # The index of the value that the regression is calculated for
+        self.regression_time = 0                    # The time that the window was last advanced to
+        self._rebuild_regression()
+
+    def log(self, log_tuple):
+        with self.lock:
+            if self.regression_window is None:
+                RingLog.log(self, log_tuple)
+                return
+
+            if self.count == self.size_limit and self.regression_count == self.size_limit:
+                # The oldest log is about to be overwritten. Remove it from the regression.
+                self._remove_regression(self.count - 1)
+                self.regression_count -= 1
+
+            RingLog.log(self, log_tuple)
+
+            # Add the stored log (not log_tuple) so that exactly the same values are
+            # removed when the log is evicted
+            log_time = self.field(0, 0)
+            if self.regression_count == 0:
+                self._reset_regression(log_time)
+            self._add_regression(0)
+            self.regression_count += 1
+            self._advance_regression(log_time)
+
+    def _reset_regression(self, origin):
+        # Times are stored relative to an origin to keep the squares small. The
+        # time sums are integers, so they are exact.
+        self.regression_origin = origin
+        self.sum_x = 0
+        self.sum_xx = 0
+        self.sum_y = 0
+        self.sum_xy = 0
+
+    # Adds log[index] to the sums. Only the two fields are read, which for a
+    # columnar log doesn't unpack the log.
+    def _add_regression(self, index):
+        x = self.field(index, 0) - self.regression_origin
+        y = self.field(index, self.regression_index)
+        self.sum_x += x
+        self.sum_xx += x*x
+        self.sum_y += y
+        self.sum_xy += x*y
+
+    def _remove_regression(self, index):
+        x = self.field(index, 0) - self.regression_origin
+        y = self.field(index, self.regression_index)
+        self.sum_x -= x
+        self.sum_xx -= x*x
+        self.sum_y -= y
+        self.sum_xy -= x*y
+
+    # The earliest time that is inside the regression window at time now
+    def _regression_start(self, now):
+        start = now - self.regression_window
+        if self.regression_since is not None and self.regression_since > start:
+            return self.regression_since
+        return start
+
+    # Recalculates the sums from the logs in the window. The start of the window
+    # is found by bisection, so only the logs in the window are visited.
+    def _rebuild_regression(self):
+        self.regression_count = 0
+        self._reset_regression(0)
+        if self.regression_window is None:
+            return
+
+        count = self.count_since(self._regression_start(self.regression_time))
+        if count:
+            self._reset_regression(self.field(count - 1, 0))
+            for i in range(count):
+                self._add_regression(i)
+        self.regression_count = count
+
+    # Removes logs that are older than the window at time now
+    def _advance_regression(self, now):
+        self.regression_time = max(self.regression_time, now)
+        start = self._regression_start(self.regression_time)
+        while self.regression_count > 0:
+            if self.field(self.regression_count - 1, 0) >= start:
+                break
+            self._remove_regression(self.regression_count - 1)
+            self.regression_count -= 1
+
+        # Float rounding accumulates as values are added and removed, and the
+        # times grow relative to the origin. Periodically recalculate the sums
+        # relative to the oldest log. This only happens once per window, so the
+        # cost is constant per log.
+        if self.regression_count == 0:
+            self._reset_regression(0)
+        elif self.field(self.regression_count - 1, 0) - self.regression_origin > self.regression_window:
+            self._rebuild_regression()
+
+    # Configures the regression window. The sums are only recalculated if logs
+    # need to be added to the window, moving the window forward is incremental.
+    def track_regression(self, window, since = None):
+        with self.lock:
+            # Moving regression_since earlier (or clearing it) adds logs to the window
+            if since is None:
+                grows = self.regression_since is not None
+            else:
+                grows = self.regression_since is not None and since < self.regression_since
+
+            if window != self.regression_window or grows:
+                self.regression_window = window
+                self.regression_since = since
+                self._rebuild_regression()
+            else:
+                self.regression_since = since
+                self._advance_regression(self.regression_time)
+
+    # Returns the slope and intercept of the line of best fit for the logs in the
+    # regression window at time now, and the number of logs that were used.
+    # Like linear_least_squares() the intercept is relative to the oldest log,
+    # and ZeroDivisionError is raised if the slope can't be determined.
+    def regression(self, now = None):
+        with self.lock:
+            if now is not None:
+                self._advance_regression(now)
+
+            n = self.regression_count
+            if n < 2:
+                return (0, 0, n)
+
+            sum_x = self.sum_x
+            m = (n*self.sum_xy - sum_x*self.sum_y)/(n*self.sum_xx - sum_x*sum_x)
+            b = (self.sum_y - m*sum_x)/n + m*(self.field(n - 1, 0) - self.regression_origin)
+            return (m, b, n)
         
+    # Continues logging at log_interval from the most recent restored log
+    def restored(self):
+        with self.lock:
+            if self.count:
+                self.last_log_time = self[0][0]
+
     def _reset_tally(self):
         self.tank_total = 0
         self.line_total = 0
@@ -134,6 +399,9 @@ class StateLog(RingLog):
         self.tank_total = self.tank_total + tank_pressure
         self.line_total = self.line_total + line_pressure
         self.delayed_count = self.delayed_count + 1
+
+        if self.rollup is not None:
+            self.rollup.add(now, tank_pressure, tank_pressure, tank_pressure, line_pressure, duty, state)
         
         if self.log_interval == 0 or since_last > self.log_interval:
             self.last_log_time = now
@@ -147,16 +415,13 @@ class StateLog(RingLog):
     def max_duration(self):
         return self.log_interval * self.size_limit
         
+    # The logs are ordered by time, so the logs from start_time to end_time are
+    # found by bisection (see RingLog.index_range()), and only the two fields are
+    # read from them
     def linear_least_squares(self, value_index = 1, start_time = None, end_time = None):
         with self.lock:
-            data = []
-            
-            # Find the coefficients of the equations of the two minimal lines
-            for i in range(len(self)):
-                log = self[i]
-                timeX = log[0]
-                if (start_time == None or timeX >= start_time) and (end_time == None or timeX <= end_time):
-                    data.append([timeX, log[value_index]])
+            (index, count) = self.index_range(start_time, end_time)
+            data = [[timeX, valueY] for (timeX, valueY) in zip(self.iter_field(0, index, count), self.iter_field(value_index, index, count))]
                     
             if len(data) > 1:
                 (m, b) = linear_least_squares(data)
@@ -164,3 +429,211 @@ class StateLog(RingLog):
             else:
                 return (0, 0, len(data))
             
+# The packed form of a CompactStateLog entry: the time as seconds after the base of
+# its block, the tank and line pressures in hundredths of a PSI (up to 327.67), the
+# duty in steps of 1/250, and the index of the state in the table of states.
+COMPACT_STATE_FORMAT=const("<HhhBB")
+COMPACT_STATE_STRIDE=const(8)
+COMPACT_TIME_BLOCK=const(16)        # The number of logs that share a time base
+COMPACT_TIME_OVERFLOW=const(0xffff) # Marks a time that is in overflow_times instead
+COMPACT_PRESSURE_SCALE=const(100)
+COMPACT_DUTY_SCALE=const(250)
+COMPACT_ROLLUP_FORMAT=const("<LhhhhBB")   # See CompactRollupLog
+COMPACT_ROLLUP_STRIDE=const(14)
+COMPACT_UNKNOWN_STATE = b'???'      # The state of logs whose state didn't fit in the table of states
+
+# Numbers the state strings of a compact log, so that a state can be stored in a
+# byte. There are only a few combinations of state, so the table stays small, but
+# if it fills up the logs can't be stored correctly. Rather than storing another
+# state, index 0 is reserved for COMPACT_UNKNOWN_STATE, which is stored for any new
+# state once the table is full, and an error is printed the first time.
+class StateTable:
+    def __init__(self):
+        self.states = [COMPACT_UNKNOWN_STATE]
+        self.unknown_count = 0      # The number of states that were stored as unknown
+
+    # Returns the index of a state (as packed by StateLog), adding it to the table if it is new
+    def index(self, state):
+        if isinstance(state, str):
+            state = state.encode()
+        if len(state) != 3:
+            state = (state + b'\x00\x00\x00')[:3]
+        try:
+            return self.states.index(state)
+        except ValueError:
+            if len(self.states) == 256:
+                if self.unknown_count == 0:
+                    print('ERROR: the table of states is full, {} is logged as {}'.format(state, COMPACT_UNKNOWN_STATE))
+                self.unknown_count += 1
+                return 0
+            self.states.append(state)
+            return len(self.states) - 1
+
+    def __getitem__(self, index):
+        return self.states[index]
+
+# A StateLog that stores each log in 8 bytes instead of 19, so the same memory holds
+# more than twice the history. Logs are decoded when they are read, so to everything
+# else (dumps, LogStore, traces) it is a StateLog, except that the pressures are
+# rounded to 0.01 and the duty to 0.004.
+#
+# Every COMPACT_TIME_BLOCK slots share the time of the first log written to them,
+# and the logs store the seconds since then. When the ring wraps, the block that is
+# being written also still has older logs, so its previous base is kept until they
+# are overwritten. A time that doesn't fit (after a gap of more than 18 hours, or if
+# the clock went backwards) is kept in overflow_times. States are stored as an index
+# into a table of the states that have been logged (see StateTable).
+class CompactStateLog(StateLog):
+    def _allocate(self, columnar):
+        self.data = None
+        self.columns = None
+        self.entries = bytearray(self.size_limit*COMPACT_STATE_STRIDE)
+        block_count = (self.size_limit + COMPACT_TIME_BLOCK - 1)//COMPACT_TIME_BLOCK
+        self.time_bases = array('L', bytes(struct.calcsize('L')*block_count))
+        self.previous_base = 0      # The base of the block being written for the logs from the previous pass
+        self.base_generation = -1   # The generation whose log set the base of the block being written
+        self.overflow_times = {}    # The times of the logs that don't fit in their block, by slot
+        self.states = StateTable()
+
+    @property
+    def storage_size(self):
+        return len(self.entries) + len(self.time_bases)*struct.calcsize('L')
+
+    def _read_slot(self, slot):
+        (delta, tank_pressure, line_pressure, duty, state) = struct.unpack_from(COMPACT_STATE_FORMAT, self.entries, slot*COMPACT_STATE_STRIDE)
+        if delta == COMPACT_TIME_OVERFLOW:
+            log_time = self.overflow_times[slot]
+        elif slot//COMPACT_TIME_BLOCK == self.end_index//COMPACT_TIME_BLOCK and slot > self.end_index:
+            log_time = self.previous_base + delta
+        else:
+            log_time = self.time_bases[slot//COMPACT_TIME_BLOCK] + delta
+        return (log_time, tank_pressure/COMPACT_PRESSURE_SCALE, line_pressure/COMPACT_PRESSURE_SCALE, duty/COMPACT_DUTY_SCALE, self.states[state])
+
+    def _write_slot(self, slot, log_tuple):
+        (log_time, tank_pressure, line_pressure, duty, state) = log_tuple
+        block = slot//COMPACT_TIME_BLOCK
+        # A new log in the first slot of a block starts the block again
+        if slot % COMPACT_TIME_BLOCK == 0 and self.base_generation != self.generation:
+            self.previous_base = self.time_bases[block]
+            self.time_bases[block] = log_time
+            self.base_generation = self.generation
+
+        delta = log_time - self.time_bases[block]
+        if 0 <= delta < COMPACT_TIME_OVERFLOW:
+            self.overflow_times.pop(slot, None)
+        else:
+            self.overflow_times[slot] = log_time
+            delta = COMPACT_TIME_OVERFLOW
+
+        struct.pack_into(COMPACT_STATE_FORMAT, self.entries, slot*COMPACT_STATE_STRIDE, delta,
+                         _fixed_point(tank_pressure, COMPACT_PRESSURE_SCALE, -32768, 32767),
+                         _fixed_point(line_pressure, COMPACT_PRESSURE_SCALE, -32768, 32767),
+                         _fixed_point(duty, COMPACT_DUTY_SCALE, 0, 255),
+                         self.states.index(state))
+
+# Scales a value to an integer, limited to the range of its field
+def _fixed_point(value, scale, minimum, maximum):
+    return min(maximum, max(minimum, int(round(value*scale))))
+
+# Summarizes the pressure history over fixed intervals, so that a long history fits
+# in a small ring. Each log covers log_interval seconds from its time, and holds the
+# minimum, average and maximum tank pressure, the average line pressure and duty,
+# and the state that was seen most often.
+#
+# Samples are added to the open bucket as they arrive, so only the totals of the
+# bucket are kept. When a sample arrives for a later interval the bucket is logged,
+# and it is added to the next rollup (which must have a longer interval) as a single
+# sample weighted by the number of samples it summarizes. The dominant state of the
+# next rollup is weighted the same way, so it is the state that was dominant for the
+# most samples rather than exactly the most common state. The open buckets are only
+# kept in memory, so a restart loses the samples of the current intervals.
+class RollupLog(RingLog):
+    def __init__(self, log_interval, size_limit, thread_safe = False, next_rollup = None, columnar = False):
+        RingLog.__init__(self, "<Lfffff3s", ["time", "tank_min", "tank_pressure", "tank_max", "line_pressure", "duty", "state"], size_limit, thread_safe = thread_safe, ordered_index = 0, columnar = columnar)
+        self.log_interval = log_interval
+        self.next_rollup = next_rollup
+        self.bucket_time = None     # The start of the interval of the open bucket, or None if it is empty
+        self._reset_bucket()
+
+    def _reset_bucket(self):
+        self.weight = 0             # The number of samples in the bucket
+        self.tank_min = 0
+        self.tank_max = 0
+        self.tank_total = 0
+        self.line_total = 0
+        self.duty_total = 0
+        self.state_weights = {}     # The weight of each state that was seen
+
+    # Adds a sample to the open bucket. A single value (such as a raw sample) is
+    # added with the same tank_min, tank_pressure and tank_max.
+    def add(self, sample_time, tank_min, tank_pressure, tank_max, line_pressure, duty, state, weight = 1):
+        bucket_time = sample_time - sample_time % self.log_interval
+        if bucket_time != self.bucket_time:
+            self.close_bucket()
+            self.bucket_time = bucket_time
+            self.tank_min = tank_min
+            self.tank_max = tank_max
+        else:
+            self.tank_min = min(self.tank_min, tank_min)
+            self.tank_max = max(self.tank_max, tank_max)
+
+        self.weight += weight
+        self.tank_total += tank_pressure*weight
+        self.line_total += line_pressure*weight
+        self.duty_total += duty*weight
+        self.state_weights[state] = self.state_weights.get(state, 0) + weight
+
+    # Logs the open bucket and passes it on to the next rollup
+    def close_bucket(self):
+        if self.bucket_time is None:
+            return
+
+        dominant_state = None
+        dominant_weight = 0
+        for (state, weight) in self.state_weights.items():
+            if weight > dominant_weight:
+                dominant_state = state
+                dominant_weight = weight
+
+        weight = self.weight
+        log_tuple = (self.bucket_time, self.tank_min, self.tank_total/weight, self.tank_max, self.line_total/weight, self.duty_total/weight, dominant_state)
+        self.log(log_tuple)
+        if self.next_rollup is not None:
+            self.next_rollup.add(*log_tuple, weight = weight)
+
+        self.bucket_time = None
+        self._reset_bucket()
+
+    @property
+    def max_duration(self):
+        return self.log_interval * self.size_limit
+
+# A RollupLog that stores each log in 14 bytes instead of 27: the time, the four
+# pressures in hundredths of a PSI, the duty in steps of 1/250, and the index of the
+# state in a StateTable. The logs are still packed in the RollupLog format when they
+# are dumped or stored.
+class CompactRollupLog(RollupLog):
+    def _allocate(self, columnar):
+        self.data = None
+        self.columns = None
+        self.entries = bytearray(self.size_limit*COMPACT_ROLLUP_STRIDE)
+        self.states = StateTable()
+
+    @property
+    def storage_size(self):
+        return len(self.entries)
+
+    def _read_slot(self, slot):
+        (log_time, tank_min, tank_pressure, tank_max, line_pressure, duty, state) = struct.unpack_from(COMPACT_ROLLUP_FORMAT, self.entries, slot*COMPACT_ROLLUP_STRIDE)
+        return (log_time, tank_min/COMPACT_PRESSURE_SCALE, tank_pressure/COMPACT_PRESSURE_SCALE, tank_max/COMPACT_PRESSURE_SCALE,
+                line_pressure/COMPACT_PRESSURE_SCALE, duty/COMPACT_DUTY_SCALE, self.states[state])
+
+    def _write_slot(self, slot, log_tuple):
+        (log_time, tank_min, tank_pressure, tank_max, line_pressure, duty, state) = log_tuple
+        struct.pack_into(COMPACT_ROLLUP_FORMAT, self.entries, slot*COMPACT_ROLLUP_STRIDE, log_time,
+                         _fixed_point(tank_min, COMPACT_PRESSURE_SCALE, -32768, 32767),
+                         _fixed_point(tank_pressure, COMPACT_PRESSURE_SCALE, -32768, 32767),
+                         _fixed_point(tank_max, COMPACT_PRESSURE_SCALE, -32768, 32767),
+                         _fixed_point(line_pressure, COMPACT_PRESSURE_SCALE, -32768, 32767),
+                         _fixed_point(duty, COMPACT_DUTY_SCALE, 0, 255),
+                         self.states.index(state))
@@ -8,3 +8,4 @@ DEBUG_ACTIVITY_LOG=const(32)# Output activity logs
 DEBUG_STATE_LOG=const(64)   # Output state logs
 DEBUG_WEB_REQUEST=const(128)# Output the web requests
 DEBUG_PRESSURE_CHANGE=const(256) # Debug monitoring of pressure changes
+DEBUG_TRACE=const(512)      # Record a trace of the controller inputs (see compressor_trace)
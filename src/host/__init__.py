@@ -0,0 +1 @@
+# Runs the controller on a host computer with CPython. See run.py.
@@ -0,0 +1,44 @@
+# Runs the benchmark suite (see benchmark.py) with CPython:
+#
+#    python3 src/host/bench.py --output before.json
+#    python3 src/host/bench.py --output after.json --compare before.json
+#
+# The results are labelled with the current git commit unless --label is given.
+import argparse
+import os
+import subprocess
+import sys
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def git_label():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd = SRC_PATH, stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks the logging and analytics code of the controller.')
+    parser.add_argument('--output', default = 'benchmark.json', help = 'json file for the results')
+    parser.add_argument('--sizes', type = int, nargs = '+', help = 'ring sizes to run (default 10 100 1000 10000)')
+    parser.add_argument('--benchmark', action = 'append', help = 'only run this benchmark (can be repeated)')
+    parser.add_argument('--min-time', type = float, default = 0.1, help = 'seconds to run each case for')
+    parser.add_argument('--label', help = 'label for the results (default: the git commit)')
+    parser.add_argument('--compare', help = 'results to compare the new results to')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    compare = os.path.abspath(args.compare) if args.compare else None
+
+    if SRC_PATH not in sys.path:
+        sys.path.insert(0, SRC_PATH)
+    from host import runtime
+    runtime.install()
+
+    import benchmark
+    label = args.label if args.label else git_label()
+    benchmark.run(output, tuple(args.sizes) if args.sizes else benchmark.SIZES, args.benchmark, int(args.min_time*1000000), label)
+    if compare:
+        benchmark.compare(compare, output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import asyncio
+import selectors
+import time
+
+# The real clock functions, before time is patched by the host runtime
+_monotonic = time.monotonic
+_time = time.time
+_sleep = time.sleep
+
+# HostClock is the clock that the controller sees when it runs on a host. It runs
+# scale times faster than real time, so that hours of compressor cycles can be
+# simulated in minutes. Everything that measures time (time.time(), ticks_ms(),
+# time.sleep(), the event loop and the plant model) uses the same clock.
+class HostClock:
+    def __init__(self, scale = 1):
+        self.scale = scale
+        self.real_start = _monotonic()
+        self.epoch = _time()
+
+    # Seconds since the clock was started
+    def monotonic(self):
+        return (_monotonic() - self.real_start)*self.scale
+
+    # Seconds since the unix epoch
+    def time(self):
+        return self.epoch + self.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _sleep(seconds/self.scale)
+
+    # Returns a selector for the event loop that waits on this clock
+    def selector(self, selector):
+        return ScaledSelector(selector, self.scale)
+
+# VirtualClock is a clock that only moves when something waits on it, so a
+# replay (see host/replay.py) runs as fast as it can be computed and gets the
+# same times on every run. epoch can be adjusted to line time.time() up with
+# recorded times.
+class VirtualClock:
+    def __init__(self, epoch = 0):
+        self.now = 0
+        self.epoch = epoch
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.epoch + self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    # Moves the clock forward to a time (seconds since the clock was started)
+    def advance_to(self, now):
+        self.now = max(self.now, now)
+
+    def selector(self, selector):
+        return VirtualSelector(selector, self)
+
+# Waits for scaled timeouts, so that the event loop wakes up for timers on
+# the scaled clock
+class ScaledSelector:
+    def __init__(self, selector, scale):
+        self.selector = selector
+        self.scale = scale
+
+    def select(self, timeout = None):
+        if timeout is not None:
+            timeout = timeout/self.scale
+        return self.selector.select(timeout)
+
+    def __getattr__(self, name):
+        return getattr(self.selector, name)
+
+# Moves a VirtualClock forward by the timeout instead of waiting, so that the
+# event loop immediately runs the next timer. Sockets are still polled.
+class VirtualSelector:
+    def __init__(self, selector, clock):
+        self.selector = selector
+        self.clock = clock
+
+    def select(self, timeout = None):
+        events = self.selector.select(0)
+        if not events and timeout is not None:
+            self.clock.sleep(timeout)
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self.selector, name)
+
+# An event loop that runs on a HostClock or a VirtualClock
+class HostEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(clock.selector(selectors.DefaultSelector()))
+        self.clock = clock
+
+    def time(self):
+        return self.clock.monotonic()
@@ -0,0 +1,90 @@
+# Stand-ins for the machine module. Output pins and ADCs are connected to the
+# plant model (see host.plant) when one is attached with attach_plant(). Input
+# pins read their pull up/down level unless set_input() is used to simulate a
+# button press.
+import time
+
+PWRON_RESET = 1
+WDT_RESET = 3
+SOFT_RESET = 5
+
+plant = None        # The plant model connected to the pins and ADCs
+_pin_values = {}    # Pin id -> value, shared by all Pin instances with the same id
+
+def attach_plant(new_plant):
+    global plant
+    plant = new_plant
+
+# Returns the value of a pin by id (0 if it has not been configured)
+def pin_value(pin_id):
+    return _pin_values.get(pin_id, 0)
+
+# Sets the level of an input pin, e.g. set_input(12, 0) presses a button wired to ground
+def set_input(pin_id, value):
+    _pin_values[pin_id] = value
+
+def reset_cause():
+    return PWRON_RESET
+
+def reset():
+    raise SystemExit('machine.reset()')
+
+def freq():
+    return 125000000
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, pin_id, mode = -1, pull = -1, value = None):
+        self.pin_id = pin_id
+        if value is not None:
+            self.value(value)
+        elif pin_id not in _pin_values:
+            _pin_values[pin_id] = 1 if mode == Pin.IN and pull == Pin.PULL_UP else 0
+
+    def value(self, value = None):
+        if value is None:
+            return _pin_values.get(self.pin_id, 0)
+
+        # Bring the plant up to date, so the change takes effect from now
+        if plant is not None:
+            plant.step()
+        _pin_values[self.pin_id] = 1 if value else 0
+
+    def __call__(self, value = None):
+        return self.value(value)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(not self.value())
+
+class ADC:
+    def __init__(self, pin_id):
+        self.pin_id = pin_id
+
+    def read_u16(self):
+        if plant is None:
+            return 0
+        return plant.read_u16(self.pin_id)
+
+# Reports when the watchdog would have reset the board, rather than resetting
+class WDT:
+    def __init__(self, id = 0, timeout = 5000):
+        self.timeout = timeout
+        self.last_feed = time.ticks_ms()
+
+    def feed(self):
+        now = time.ticks_ms()
+        interval = time.ticks_diff(now, self.last_feed)
+        if interval > self.timeout:
+            print('WDT: {} ms between feeds, the board would have been reset'.format(interval))
+        self.last_feed = now
@@ -0,0 +1,42 @@
+# Stand-ins for the network module. The host is always connected.
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+STAT_CONNECT_FAIL = -1
+STAT_NO_AP_FOUND = -2
+STAT_WRONG_PASSWORD = -3
+
+class WLAN:
+    def __init__(self, interface = STA_IF):
+        self.interface = interface
+        self.is_active = False
+        self.connected = False
+        self.settings = {}
+
+    def active(self, is_active = None):
+        if is_active is None:
+            return self.is_active
+        self.is_active = is_active
+
+    def config(self, *args, **kwargs):
+        if args:
+            return self.settings.get(args[0])
+        self.settings.update(kwargs)
+
+    def connect(self, ssid = None, key = None):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def isconnected(self):
+        return self.connected
+
+    def status(self):
+        return STAT_GOT_IP if self.connected else STAT_IDLE
+
+    def ifconfig(self, config = None):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
@@ -0,0 +1,89 @@
+# uasyncio on top of CPython's asyncio. The loop is a HostEventLoop that is
+# installed by host.runtime.install().
+import asyncio
+from asyncio import CancelledError, Event, Lock, TimeoutError, gather, sleep, wait_for
+
+loop = None         # The HostEventLoop
+port_map = {}       # Maps the ports the controller listens on to the ports used on the host
+
+def get_event_loop():
+    return loop
+
+def new_event_loop():
+    return loop
+
+def create_task(coro):
+    return loop.create_task(coro)
+
+async def sleep_ms(ms):
+    await asyncio.sleep(ms/1000)
+
+async def wait_for_ms(awaitable, timeout):
+    return await asyncio.wait_for(awaitable, timeout/1000)
+
+# Runs a coroutine to completion. main() calls get_event_loop().run_forever()
+# from inside the coroutine, which uasyncio allows but asyncio doesn't (the loop
+# would already be running). So the coroutine is stepped here, outside of the
+# loop, and the loop only runs until each future that it awaits is done.
+def run(coro):
+    while True:
+        try:
+            future = coro.send(None)
+        except StopIteration as e:
+            return e.value
+        if future is not None:
+            loop.run_until_complete(future)
+
+# A uasyncio stream: a single object that is both the reader and the writer
+# of a connection, and accepts str as well as bytes.
+class Stream:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def get_extra_info(self, name):
+        return self.writer.get_extra_info(name)
+
+    async def read(self, n = -1):
+        return await self.reader.read(n)
+
+    async def readinto(self, buffer):
+        data = await self.reader.read(len(buffer))
+        buffer[0:len(data)] = data
+        return len(data)
+
+    async def readexactly(self, n):
+        return await self.reader.readexactly(n)
+
+    async def readline(self):
+        return await self.reader.readline()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        # The caller may reuse its buffer as soon as write() returns
+        self.writer.write(bytes(data))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+    async def wait_closed(self):
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+async def start_server(callback, host, port, backlog = 5):
+    def connected(reader, writer):
+        stream = Stream(reader, writer)
+        return callback(stream, stream)
+
+    return await asyncio.start_server(connected, host, port_map.get(port, port), backlog = backlog)
+
+async def open_connection(host, port):
+    (reader, writer) = await asyncio.open_connection(host, port)
+    stream = Stream(reader, writer)
+    return (stream, stream)
@@ -0,0 +1,9 @@
+# ujson serializes objects that json can't (such as exceptions) as strings
+import json
+from json import load, loads
+
+def dumps(obj):
+    return json.dumps(obj, default = str)
+
+def dump(obj, stream):
+    json.dump(obj, stream, default = str)
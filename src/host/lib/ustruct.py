@@ -0,0 +1,12 @@
+# ustruct accepts str values for 's' fields, which struct only accepts as bytes
+import struct
+from struct import calcsize, error, unpack, unpack_from, iter_unpack
+
+def _encode(values):
+    return tuple(value.encode() if isinstance(value, str) else value for value in values)
+
+def pack(fmt, *values):
+    return struct.pack(fmt, *_encode(values))
+
+def pack_into(fmt, buffer, offset, *values):
+    struct.pack_into(fmt, buffer, offset, *_encode(values))
@@ -0,0 +1,158 @@
+import machine
+import random
+
+# Default plant settings. Any of them can be overridden with a json file (see run.py).
+DEFAULT_CONFIG = {
+    "tank_volume": 20,                  # Gallons
+    "initial_pressure": 80,             # psi
+    # Free air delivered by the pump (SCFM) at tank pressures (psi), interpolated between points
+    "pump_curve": [[0, 7.0], [90, 6.0], [125, 5.2], [150, 4.5], [175, 0]],
+    "leak_rate": 0.05,                  # SCFM lost to leaks at 100 psi (proportional to pressure)
+    "drain_rate": 2.0,                  # SCFM through the open drain valve at 100 psi (proportional to pressure)
+    "unload_rate": 0.5,                 # SCFM of the pump output vented by the open unload valve
+    "regulator_pressure": 90,           # psi, the line pressure is the tank pressure up to this
+    # Consumers as [start, duration, SCFM], in seconds from the start of each load_period
+    "load_profile": [[60, 120, 3.0], [300, 30, 6.0]],
+    "load_period": 600,
+    "sensor_noise": 0.3,                # Standard deviation of the pressure sensor noise (psi)
+    "time_step": 0.05,                  # Longest step (seconds) used to integrate the pressure
+
+    "motor_pin": 15,                    # Output pins that drive the plant
+    "unload_pin": 14,
+    "drain_pin": 16,
+    # The ADC pins connected to pressure sensors. source is 'tank' or 'line', and the
+    # scale matches the sensor settings of the controller.
+    "sensors": {
+        "0": {"source": "tank", "value_min": 0, "value_max": 150, "sensor_min": 6554, "sensor_max": 58981}
+    }
+}
+
+ATMOSPHERIC_PRESSURE = 14.7     # psi
+CUBIC_FEET_PER_GALLON = 0.1337
+
+# TankPlant models the air system that the controller regulates: a pump that fills
+# a tank, and leaks, drains and consumers that empty it. The model is advanced to
+# the current time on the clock whenever a sensor is read or an output pin changes.
+#
+# Flows are in SCFM (cubic feet of free air per minute), so the pressure in a tank
+# of volume V (cubic feet) changes by flow*14.7/V psi per minute.
+class TankPlant:
+    def __init__(self, clock, config = None):
+        self.clock = clock
+        self.config = dict(DEFAULT_CONFIG)
+        if config:
+            self.config.update(config)
+        config = self.config
+
+        self.volume = config['tank_volume']*CUBIC_FEET_PER_GALLON
+        self.pump_curve = config['pump_curve']
+        self.sensors = {int(pin_id): sensor for (pin_id, sensor) in config['sensors'].items()}
+        self.failed_sensors = set()
+
+        self.time = clock.monotonic()
+        self.tank_pressure = float(config['initial_pressure'])
+        self.pump_flow = 0          # The flows at the last step
+        self.load_flow = 0
+        self.loss_flow = 0
+        self.motor_runtime = 0      # Seconds that the motor has run
+        self.motor_starts = 0
+        self.motor_was_on = False
+
+    @property
+    def line_pressure(self):
+        return min(self.tank_pressure, self.config['regulator_pressure'])
+
+    # Returns the free air delivery of the pump at a tank pressure
+    def pump_delivery(self, pressure):
+        curve = self.pump_curve
+        if pressure <= curve[0][0]:
+            return curve[0][1]
+        for i in range(1, len(curve)):
+            (p1, q1) = curve[i]
+            if pressure <= p1:
+                (p0, q0) = curve[i - 1]
+                return q0 + (q1 - q0)*(pressure - p0)/(p1 - p0)
+        return curve[-1][1]
+
+    # Returns the demand of the consumers at a time (seconds on the clock)
+    def load_demand(self, now):
+        period = self.config['load_period']
+        offset = now % period if period else now
+        demand = 0
+        for (start, duration, flow) in self.config['load_profile']:
+            if start <= offset < start + duration:
+                demand += flow
+        return demand
+
+    # Advances the model to the current time
+    def step(self):
+        config = self.config
+        now = self.clock.monotonic()
+        motor_on = machine.pin_value(config['motor_pin']) == 1
+        unload_open = machine.pin_value(config['unload_pin']) == 1
+        drain_open = machine.pin_value(config['drain_pin']) == 1
+        if motor_on and not self.motor_was_on:
+            self.motor_starts += 1
+        self.motor_was_on = motor_on
+
+        while self.time < now:
+            dt = min(config['time_step'], now - self.time)
+            pressure = self.tank_pressure
+
+            # While the unload valve is open part of the pump output is vented
+            pump_flow = 0
+            if motor_on:
+                pump_flow = self.pump_delivery(pressure)
+                if unload_open:
+                    pump_flow = max(0, pump_flow - config['unload_rate'])
+            loss_flow = config['leak_rate']*pressure/100
+            if drain_open:
+                loss_flow += config['drain_rate']*pressure/100
+            # Consumers get less air when the line pressure drops below the regulator
+            load_flow = self.load_demand(self.time)*min(1, self.line_pressure/config['regulator_pressure'])
+
+            self.tank_pressure = max(0, pressure + (pump_flow - loss_flow - load_flow)*ATMOSPHERIC_PRESSURE/self.volume*dt/60)
+            if motor_on:
+                self.motor_runtime += dt
+            self.pump_flow = pump_flow
+            self.load_flow = load_flow
+            self.loss_flow = loss_flow
+            self.time += dt
+
+    # Returns the reading of the sensor on an ADC pin, including noise. A failed
+    # sensor (see fail_sensor()) reads 0, which is out of range.
+    def read_u16(self, pin_id):
+        self.step()
+        sensor = self.sensors.get(pin_id)
+        if sensor is None or pin_id in self.failed_sensors:
+            return 0
+
+        pressure = self.tank_pressure if sensor['source'] == 'tank' else self.line_pressure
+        pressure += random.gauss(0, self.config['sensor_noise'])
+        scaled = (pressure - sensor['value_min'])/(sensor['value_max'] - sensor['value_min'])
+        raw = sensor['sensor_min'] + scaled*(sensor['sensor_max'] - sensor['sensor_min'])
+        return max(0, min(65535, int(raw)))
+
+    def fail_sensor(self, pin_id, failed = True):
+        if failed:
+            self.failed_sensors.add(pin_id)
+        else:
+            self.failed_sensors.discard(pin_id)
+
+    @property
+    def state_dictionary(self):
+        self.step()
+        config = self.config
+        return {
+            'time': round(self.time, 1),
+            'tank_pressure': round(self.tank_pressure, 2),
+            'line_pressure': round(self.line_pressure, 2),
+            'motor': machine.pin_value(config['motor_pin']),
+            'unload': machine.pin_value(config['unload_pin']),
+            'drain': machine.pin_value(config['drain_pin']),
+            'pump_flow': round(self.pump_flow, 2),
+            'load_flow': round(self.load_flow, 2),
+            'loss_flow': round(self.loss_flow, 2),
+            'motor_runtime': round(self.motor_runtime),
+            'motor_starts': self.motor_starts
+        }
@@ -0,0 +1,218 @@
+# Replays a trace recorded by the controller (see compressor_trace) and checks
+# that the controller makes the same decisions:
+#
+#    python3 src/host/replay.py trace.bin.old trace.bin
+#
+# A trace is recorded when debug.DEBUG_TRACE is set in the debug_mode of the
+# controller. The files of a trace that was rotated are replayed in order. A
+# file that was started while the controller was running begins with the state
+# of the controller, but any pressure change alert or purge that was in progress
+# is lost, so its first minutes may not match.
+#
+# The controller runs on a VirtualClock, so the replay takes as long as it takes
+# to compute. The recorded sensor values are fed to the controller at the
+# recorded times, along with the commands and settings updates, and the motor,
+# unload and purge outputs and the StateLog entries are compared to the ones
+# that were recorded. Any differences are printed, and the exit status is 1 if
+# there were any.
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Names of the output bits, see compressor_trace.controller_outputs()
+OUTPUT_NAMES = ('motor', 'unload', 'purge', 'on', 'pressure_change_error', 'purge_pending')
+
+# Returns the difference between the epoch of the trace and its tick clock that
+# makes int(epoch + milliseconds/1000) equal to the time of every record, if
+# there is one. Otherwise the epoch is adjusted as records are replayed.
+def estimate_epoch(trace):
+    low = None
+    high = None
+    for (record_type, milliseconds, record_time, values) in trace.records():
+        seconds = milliseconds/1000
+        low = record_time - seconds if low is None else max(low, record_time - seconds)
+        high = record_time + 1 - seconds if high is None else min(high, record_time + 1 - seconds)
+    if low is None:
+        return trace.start_time
+    return (low + high)/2 if low < high else low
+
+# Supplies recorded sensor values in place of a SensorSampler
+class ReplaySensor:
+    def __init__(self):
+        self.value = 0
+
+    def read(self, settings = None):
+        return self.value
+
+    @property
+    def stats_dictionary(self):
+        return {'replay': self.value}
+
+class Replay:
+    def __init__(self, paths, tolerance, verbose):
+        from compressor_trace import TraceReader
+        self.traces = [TraceReader(path) for path in paths]
+        self.tolerance = tolerance
+        self.verbose = verbose
+        self.output = sys.stdout    # The controller's output is hidden unless verbose is set
+        self.differences = 0
+        self.ticks = 0
+        self.states = 0
+        self.replayed_states = []   # StateLog entries logged by the replay that haven't been compared
+
+    def report(self, record_time, message):
+        self.differences += 1
+        print('{}: {}'.format(record_time, message), file = self.output)
+
+    # Builds a controller configured like the one that recorded the first trace
+    def build_controller(self, clock):
+        import compressor_controller
+        import debug
+        import main
+
+        from compressor_trace import restore_controller_state
+        description = self.traces[0].description
+
+        settings = main.CompressorSettings(main.default_settings, persist_path = None)
+        settings.update(description['settings'])
+        for (name, value) in description['static'].items():
+            setattr(settings, name, value)
+        # Only keep the debug settings that change how the controller behaves
+        settings.debug_mode &= debug.DEBUG_ADC_SIMULATE
+        # The replay mustn't restore or add to the logs of a controller running on this computer
+        settings.log_directory = None
+
+        clock.epoch = estimate_epoch(self.traces[0])
+        self.controller = compressor_controller.CompressorController(settings)
+        # A trace that continues another starts with a controller that was already
+        # running, so its state is restored (see compressor_trace.controller_state())
+        restore_controller_state(self.controller, description['controller'])
+        self.tank_sensor = ReplaySensor()
+        self.controller.tank_pressure_sampler = self.tank_sensor
+        self.line_sensor = ReplaySensor()
+        if self.controller.line_pressure_sampler is not None:
+            self.controller.line_pressure_sampler = self.line_sensor
+
+    # Calls a recorded command on the controller
+    def command(self, command, arguments):
+        from compressor_trace import COMMANDS, NO_ARGUMENT
+        (name, argument_names) = COMMANDS[command]
+        kwargs = {}
+        for (argument_name, value) in zip(argument_names, arguments):
+            if value != NO_ARGUMENT:
+                kwargs[argument_name] = value
+        getattr(self.controller, name)(**kwargs)
+        return '{}({})'.format(name, kwargs)
+
+    def tick(self, record_time, tank_value, line_value, outputs):
+        from compressor_trace import controller_outputs
+        controller = self.controller
+        self.tank_sensor.value = tank_value
+        self.line_sensor.value = line_value
+
+        generation = controller.state_log.generation
+        with controller.lock:
+            controller._update()
+            controller._publish_status()
+        self.ticks += 1
+        if controller.state_log.generation != generation:
+            self.replayed_states.append(controller.state_log[0])
+
+        replayed_outputs = controller_outputs(controller)
+        if replayed_outputs != outputs:
+            changed = [name for (bit, name) in enumerate(OUTPUT_NAMES) if (replayed_outputs ^ outputs) & (1 << bit)]
+            self.report(record_time, 'outputs differ ({}): recorded {}, replayed {}'.format(', '.join(changed), self.output_string(outputs), self.output_string(replayed_outputs)))
+
+    def output_string(self, outputs):
+        return ' '.join(name for (bit, name) in enumerate(OUTPUT_NAMES) if outputs & (1 << bit)) or '-'
+
+    def state(self, record_time, recorded):
+        self.states += 1
+        if not self.replayed_states:
+            self.report(record_time, 'state {} was not logged by the replay'.format(recorded))
+            return
+        replayed = self.replayed_states.pop(0)
+        # Floats are single precision on the board, so the values are compared with a tolerance
+        same = recorded[0] == replayed[0] and recorded[4] == replayed[4] and\
+               all(abs(a - b) <= self.tolerance for (a, b) in zip(recorded[1:4], replayed[1:4]))
+        if not same:
+            self.report(record_time, 'state differs: recorded {}, replayed {}'.format(recorded, replayed))
+
+    # Plays the records of the traces at their recorded times. Sleeping on the event
+    # loop until each record is due lets any tasks that the controller started (such
+    # as purges) run at the same times that they did when the trace was recorded.
+    async def run(self, clock):
+        import compressor_trace
+        offset = 0      # The time on the clock that the current trace started at
+        for trace in self.traces:
+            if trace is not self.traces[0]:
+                offset = clock.monotonic()
+            records = list(trace.records())
+            for (i, (record_type, milliseconds, record_time, values)) in enumerate(records):
+                # The time can change during an update. If the update logged a state, the
+                # time of the state is the one that the controller decided on.
+                if record_type == compressor_trace.TRACE_TICK and i + 1 < len(records):
+                    next_record = records[i + 1]
+                    if next_record[0] == compressor_trace.TRACE_STATE and next_record[1] == milliseconds:
+                        record_time = next_record[3][0]
+
+                delay = offset + milliseconds/1000 - clock.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                clock.advance_to(offset + milliseconds/1000)
+                if int(clock.time()) != record_time:
+                    clock.epoch = record_time + 0.5 - clock.monotonic()
+
+                if record_type == compressor_trace.TRACE_TICK:
+                    self.tick(record_time, *values)
+                elif record_type == compressor_trace.TRACE_COMMAND:
+                    description = self.command(values[0], values[1:])
+                    if self.verbose:
+                        print('{}: {}'.format(record_time, description))
+                elif record_type == compressor_trace.TRACE_SETTINGS:
+                    self.controller.settings.update(values)
+                    if self.verbose:
+                        print('{}: settings {}'.format(record_time, values))
+                elif record_type == compressor_trace.TRACE_BUTTON:
+                    if self.verbose:
+                        print('{}: button {} {}'.format(record_time, compressor_trace.BUTTONS[values[0]], 'released' if values[1] else 'pressed'))
+                elif record_type == compressor_trace.TRACE_STATE:
+                    self.state(record_time, values)
+
+        for state in self.replayed_states:
+            self.report(state[0], 'state {} was logged by the replay but not recorded'.format(state))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Replays controller traces and reports where the decisions differ.')
+    parser.add_argument('traces', nargs = '+', help = 'trace files, oldest first')
+    parser.add_argument('--tolerance', type = float, default = 0.01, help = 'largest difference allowed between logged pressures and duties')
+    parser.add_argument('--verbose', action = 'store_true', help = 'print the commands, settings and controller output')
+    args = parser.parse_args()
+    paths = [os.path.abspath(path) for path in args.traces]
+
+    if SRC_PATH not in sys.path:
+        sys.path.insert(0, SRC_PATH)
+    from host import runtime
+    from host.clock import VirtualClock
+    clock = VirtualClock()
+    runtime.install(host_clock = clock)
+    os.chdir(SRC_PATH)
+
+    replay = Replay(paths, args.tolerance, args.verbose)
+    # The controller prints as it unloads, which isn't interesting unless asked for.
+    # Differences are still printed (see Replay.output).
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        replay.build_controller(clock)
+        runtime.loop.run_until_complete(replay.run(clock))
+
+    print('Replayed {} ticks and {} states with {} differences'.format(replay.ticks, replay.states, replay.differences))
+    sys.exit(1 if replay.differences else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Runs main.py on a host computer with CPython, against a simulated tank:
+#
+#    python3 src/host/run.py --scale 10 --port 8080 --report 30
+#
+# The controller is unmodified. MicroPython modules are provided by host/lib,
+# and the pins and ADCs are connected to a TankPlant (see plant.py), whose
+# settings can be overridden with a json file (--plant). Time runs --scale times
+# faster than real time. The web server listens on --port instead of port 80.
+import argparse
+import json
+import os
+import runpy
+import sys
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Runs the air compressor controller against a simulated tank.')
+    parser.add_argument('--scale', type = float, default = 1, help = 'speed of the clock relative to real time')
+    parser.add_argument('--port', type = int, default = 8080, help = 'port for the web server (port 80 on the board)')
+    parser.add_argument('--plant', help = 'json file with plant settings, see plant.DEFAULT_CONFIG')
+    parser.add_argument('--duration', type = float, help = 'seconds of simulated time to run for')
+    parser.add_argument('--report', type = float, help = 'interval (seconds of simulated time) between reports of the plant state')
+    args = parser.parse_args()
+
+    plant_config = {}
+    if args.plant:
+        with open(args.plant) as f:
+            plant_config = json.load(f)
+
+    if SRC_PATH not in sys.path:
+        sys.path.insert(0, SRC_PATH)
+    from host import runtime
+    runtime.install(args.scale, {80: args.port}, plant_config)
+    if args.duration:
+        runtime.stop_after(args.duration)
+    if args.report:
+        runtime.report_every(args.report)
+
+    # main.py expects to run from the root of the file system
+    os.chdir(SRC_PATH)
+    runpy.run_path(os.path.join(SRC_PATH, 'main.py'), run_name = '__main__')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import builtins
+import gc
+import os
+import sys
+import time
+import traceback
+
+from host.clock import HostClock, HostEventLoop
+
+LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+
+TICKS_PERIOD = 1 << 30      # ticks_ms() and ticks_us() wrap like they do on the board
+TICKS_HALF_PERIOD = TICKS_PERIOD >> 1
+
+clock = None
+loop = None
+plant = None
+
+def _ticks_diff(end, start):
+    return ((end - start + TICKS_HALF_PERIOD) & (TICKS_PERIOD - 1)) - TICKS_HALF_PERIOD
+
+def _print_exception(e, file = sys.stdout):
+    traceback.print_exception(type(e), e, e.__traceback__, file = file)
+
+# Makes the MicroPython modules and builtins that the controller uses available
+# on CPython, with time running on a HostClock that is scale times real time
+# (or on another clock, such as a VirtualClock). If plant_config is not None a
+# TankPlant is connected to the pins and ADCs (see host.plant). port_map maps
+# the ports the server listens on to host ports.
+def install(scale = 1, port_map = None, plant_config = None, host_clock = None):
+    global clock, loop, plant
+    clock = HostClock(scale) if host_clock is None else host_clock
+
+    if LIB_PATH not in sys.path:
+        sys.path.insert(0, LIB_PATH)
+
+    builtins.const = lambda value: value
+    sys.print_exception = _print_exception
+    gc.mem_alloc = lambda: 0
+    gc.mem_free = lambda: 0
+
+    time.time = lambda: int(clock.time())
+    time.sleep = clock.sleep
+    time.sleep_ms = lambda ms: clock.sleep(ms/1000)
+    time.sleep_us = lambda us: clock.sleep(us/1000000)
+    time.ticks_ms = lambda: int(clock.monotonic()*1000) & (TICKS_PERIOD - 1)
+    time.ticks_us = lambda: int(clock.monotonic()*1000000) & (TICKS_PERIOD - 1)
+    time.ticks_add = lambda ticks, delta: (ticks + delta) & (TICKS_PERIOD - 1)
+    time.ticks_diff = _ticks_diff
+
+    import asyncio
+    import uasyncio
+    loop = HostEventLoop(clock)
+    asyncio.set_event_loop(loop)
+    uasyncio.loop = loop
+    uasyncio.port_map = port_map or {}
+
+    if plant_config is not None:
+        import machine
+        from host.plant import TankPlant
+        plant = TankPlant(clock, plant_config)
+        machine.attach_plant(plant)
+
+    return clock
+
+# Stops the event loop after a number of seconds on the clock, which ends main()
+def stop_after(seconds):
+    loop.call_at(seconds, loop.stop)
+
+# Prints the state of the plant every interval seconds on the clock
+def report_every(interval):
+    def report():
+        print('plant: {}'.format(plant.state_dictionary))
+        loop.call_later(interval, report)
+
+    loop.call_later(interval, report)
@@ -6,6 +6,8 @@ class ChartMonitor {
         this.last_state_update = 0;
         this.last_activity_update = 0;
         this.server_time_offset = null;
+        this.maxDuration = null;         // Seconds of history the server keeps at full resolution
+        this.historyDuration = 0;        // Milliseconds of history that have been loaded from the rollups
 
         this.activitiesVisible = true;
         this.commandsVisible = true;
@@ -27,10 +29,27 @@ class ChartMonitor {
                 clearInterval(this.monitorId);
                 this.monitorId = null;
             }
+            if (this.stateListener) {
+                serverEvents().removeEventListener('state', this.stateListener);
+                serverEvents().removeEventListener('activity', this.activityListener);
+                this.stateListener = null;
+            }
         } else if (settings.debug) {
             let t = this;
             this.monitorId = setInterval(() => t.appendDemoData(), queryInterval);
             this.appendDemoData();
+        } else if (settings.serverEvents) {
+            // The server pushes new logs as they are added
+            let t = this;
+            this.stateListener = (event) => t.processStateData(JSON.parse(event.data));
+            this.activityListener = (event) => t.processActivity(JSON.parse(event.data));
+            serverEvents().addEventListener('state', this.stateListener);
+            serverEvents().addEventListener('activity', this.activityListener);
+            onServerEventsClosed(() => {
+                t.stateListener = null;
+                t.monitorId = setInterval(() => t.fetchChartData(), queryInterval);
+                t.fetchChartData();
+            });
         } else {
             let t = this;
             this.monitorId = setInterval(() => t.fetchChartData(), queryInterval);
@@ -59,6 +78,7 @@ class ChartMonitor {
         if (this.chartDurationIndex != index) {
             this.chartDuration = settings.chartDuration[index];
             this.chartDurationIndex = index;
+            this.fetchHistory();
             
             if (this.chart) {
                 this.updateDomain();
@@ -275,19 +295,21 @@ class ChartMonitor {
     fetchChartData() {
         console.log('Updating chart…');
         let t = this;
+        const suffix = settings.binaryLogs ? '.bin' : '';
+        const accept = settings.binaryLogs ? 'application/octet-stream' : 'application/json';
         
         if (!this.stateFetchPending.isLocked()) {
             // Query the server for state logs that are after the last state
             // query that we made
-            fetch('/state_logs?since=' + this.last_state_update.toString(), {
+            fetch('/state_logs' + suffix + '?since=' + this.last_state_update.toString(), {
                method: 'GET',
                headers: {
-                   'Accept': 'application/json',
+                   'Accept': accept,
                },
                signal: this.stateFetchPending.abortController.signal
             })
-            .then((response) => response.json())
-            .then((data) => t.processStateData(data))
+            .then((response) => settings.binaryLogs ? response.arrayBuffer() : response.json())
+            .then((data) => t.processStateData(settings.binaryLogs ? t.mapBinaryStateData(data) : data))
             .catch((error) => console.error('Communication Error Fetching State:', error))
             .finally(() => t.stateFetchPending.unlock());
         }
@@ -295,25 +317,85 @@ class ChartMonitor {
         // Query the server for activity logs that end after the last
         // update that we received.
         if (!this.activityFetchPending.isLocked()) {
-            fetch('/activity_logs?since=' + this.last_activity_update.toString(), {
+            fetch('/activity_logs' + suffix + '?since=' + this.last_activity_update.toString(), {
                method: 'GET',
                headers: {
-                   'Accept': 'application/json',
+                   'Accept': accept,
                },
                signal: this.activityFetchPending.abortController.signal
             })
-            .then((response) => response.json())
-            .then((data) => t.processActivity(data))
+            .then((response) => settings.binaryLogs ? response.arrayBuffer() : response.json())
+            .then((data) => t.processActivity(settings.binaryLogs ? t.mapBinaryActivityData(data) : data))
             .catch((error) => console.error('Communication Error Fetching Activity:', error))
             .finally(() => t.activityFetchPending.unlock());
         }
     }
+    
+    // Durations that are longer than the server keeps at full resolution are filled
+    // in from the summaries of the history, which the server chooses by span. The
+    // history is only fetched once for each longer duration, since the newer logs
+    // arrive at full resolution.
+    fetchHistory() {
+        if (settings.debug || this.maxDuration === null || this.chartDuration <= Math.max(this.maxDuration*1000, this.historyDuration)) {
+            return;
+        }
+        
+        let t = this;
+        const suffix = settings.binaryLogs ? '.bin' : '';
+        const accept = settings.binaryLogs ? 'application/octet-stream' : 'application/json';
+        const duration = this.chartDuration;
+        fetch('/state_logs' + suffix + '?span=' + Math.ceil(duration/1000).toString(), {
+           method: 'GET',
+           headers: {
+               'Accept': accept,
+           }
+        })
+        .then((response) => settings.binaryLogs ? response.arrayBuffer() : response.json())
+        .then((data) => {
+            t.historyDuration = Math.max(t.historyDuration, duration);
+            t.prependStateData(settings.binaryLogs ? t.mapBinaryStateData(data) : data);
+            t.chart.update('none');
+        })
+        .catch((error) => console.error('Communication Error Fetching History:', error));
+    }
+
+    // Converts a /state_logs.bin response to the same form as a /state_logs response
+    mapBinaryStateData(buffer) {
+        const [state] = decodeBinaryLogs(buffer);
+        return {
+            time: state.time,
+            resolution: state.resolution,
+            maxDuration: state.maxDuration,
+            // The records arrive oldest first, but json logs are most recent first
+            state: state.records.reverse()
+        };
+    }
+
+    // Converts an /activity_logs.bin response to the same form as an /activity_logs response
+    mapBinaryActivityData(buffer) {
+        const [activity, commands] = decodeBinaryLogs(buffer);
+        // Open activities have a stop time in the future. The json logs clamp it to the
+        // server time, so do the same here.
+        activity.records.forEach((record) => record.stop = Math.min(record.stop, activity.time));
+        return {
+            time: activity.time,
+            activity: activity.records,
+            commands: commands.records
+        };
+    }
 
     processStateData(data) {
         // Store the current server time (in the server timescale)
         // so that we don't refetch activity
         this.last_state_update = data['time'];
         
+        // The first response tells how much history the server keeps at full
+        // resolution, so any longer duration can now be filled in
+        if (this.maxDuration === null && data.maxDuration) {
+            this.maxDuration = data.maxDuration;
+            this.fetchHistory();
+        }
+        
         // Calculate when the chart should end (in the local timescale)
         const domainEnd = this.last_state_update*1000
         
@@ -357,6 +439,22 @@ class ChartMonitor {
         this.stateData.push(...states);
     }
 
+    // Adds history that is older than the data in the chart to its start
+    prependStateData(data) {
+        let states = data.state.reverse();
+        states.forEach((state, index) => {
+            state.time = state.time*1000 - this.server_time_offset;
+            state.duty *= 100;
+        });
+        
+        if (this.stateData.length) {
+            const firstTime = this.stateData[0].time;
+            states = states.filter((state) => state.time < firstTime);
+        }
+        
+        this.stateData.unshift(...states);
+    }
+
     processActivity(data) {
         // Store the current server time (in the server timescale)
         // so that we don't refetch events that have been received
@@ -25,7 +25,8 @@ class StateMonitor {
         }
     }
     
-    // Begins periodically polling the server for the state of self
+    // Begins periodically polling the server for the state of self. If server
+    // events are enabled the state is streamed from the server instead.
     monitor(interval = null) {
         interval ??= settings.stateQueryInterval;
         
@@ -35,9 +36,23 @@ class StateMonitor {
                 clearInterval(this.monitorId);
                 this.monitorId = null;
             }
+            if (this.statusListener) {
+                serverEvents().removeEventListener('status', this.statusListener);
+                serverEvents().removeEventListener('error', this.streamErrorListener);
+                this.statusListener = null;
+            }
         } else if (settings.debug) {
             this.monitorId = setInterval(() => t.applyDebugState(), interval);
             this.applyDebugState();
+        } else if (settings.serverEvents) {
+            this.statusListener = (event) => t.handleStatusEvent(JSON.parse(event.data));
+            this.streamErrorListener = () => t.handleFetchStateError('State stream error.');
+            serverEvents().addEventListener('status', this.statusListener);
+            serverEvents().addEventListener('error', this.streamErrorListener);
+            onServerEventsClosed(() => {
+                t.monitor(0);
+                t.monitor(interval);
+            });
         } else {
             this.monitorId = setInterval(() => t.fetchState(), interval);
             this.fetchState();
@@ -254,6 +269,19 @@ class StateMonitor {
         .finally(() => t.fetchPending.unlock());
     }
         
+    // Status events only contain the values that have changed, so they are
+    // merged into the last state that was received.
+    handleStatusEvent(delta) {
+        this.streamedState = Object.assign(this.streamedState ?? {}, delta);
+        
+        // If the stream stalls without an error, report it the same way as an overdue fetch
+        let t = this;
+        clearTimeout(this.streamOverdueId);
+        this.streamOverdueId = setTimeout(() => t.handleFetchStateError('State stream overdue.'), settings.fetchRecoveryInterval);
+
+        this.handleFetchStateResponse(this.streamedState);
+    }
+        
     handleFetchStateResponse(data) {        
         this.removeStateClass('compressor_error');
         
@@ -4,9 +4,35 @@ settings = {
     chartQueryInterval: 5000,
     fetchRecoveryInterval: 5000,       // When a fetch is issued, sending another query is blocked until it returns or this time has elapsed
     chartDomainUpdateInterval: 1000, 
-    chartDuration: [ 5*60*1000, 10*60*1000, 20*60*1000 ]
+    binaryLogs: true,                  // Fetch chart logs as packed records (/state_logs.bin) instead of json
+    serverEvents: true,                // Subscribe to the /events stream instead of polling
+    chartDuration: [ 5*60*1000, 10*60*1000, 20*60*1000, 24*60*60*1000, 7*24*60*60*1000 ]   // Durations longer than the server's state log are filled in from its rollups
 };
 
+// Returns the EventSource for the server's /events stream. All of the monitors
+// on a page share one stream, so there is only one connection to the server.
+let sharedServerEvents = null;
+let serverEventsClosedCallbacks = [];
+function serverEvents() {
+    if (!sharedServerEvents) {
+        sharedServerEvents = new EventSource('/events');
+        // The server only serves a few streams at once. If it refuses this one the
+        // browser won't retry, so the monitors poll instead.
+        sharedServerEvents.addEventListener('error', () => {
+            if (sharedServerEvents.readyState == EventSource.CLOSED) {
+                settings.serverEvents = false;
+                serverEventsClosedCallbacks.splice(0).forEach((callback) => callback());
+            }
+        });
+    }
+    return sharedServerEvents;
+}
+
+// Calls callback if the /events stream is closed for good
+function onServerEventsClosed(callback) {
+    serverEventsClosedCallbacks.push(callback);
+}
+
 function assignKeyPath(destination, path, value) {
     if (!Array.isArray(path)) path = path.split('.');
     
@@ -63,3 +89,87 @@ class FetchLock {
         this.unlock();
     }
 }
+
+// Sizes and DataView readers for the struct format codes used by the server logs
+const structFormatCodes = {
+    'B': { size: 1, read: (view, offset) => view.getUint8(offset) },
+    'b': { size: 1, read: (view, offset) => view.getInt8(offset) },
+    'H': { size: 2, read: (view, offset) => view.getUint16(offset, true) },
+    'h': { size: 2, read: (view, offset) => view.getInt16(offset, true) },
+    'L': { size: 4, read: (view, offset) => view.getUint32(offset, true) },
+    'l': { size: 4, read: (view, offset) => view.getInt32(offset, true) },
+    'I': { size: 4, read: (view, offset) => view.getUint32(offset, true) },
+    'i': { size: 4, read: (view, offset) => view.getInt32(offset, true) },
+    'f': { size: 4, read: (view, offset) => view.getFloat32(offset, true) },
+    'd': { size: 8, read: (view, offset) => view.getFloat64(offset, true) }
+};
+
+// Converts a little endian struct format (like '<Lfff3s') to a list of field readers
+function parseStructFormat(format) {
+    let fields = [];
+    const decoder = new TextDecoder();
+    for (const [, count, code] of format.replace(/^[<=]/, '').matchAll(/(\d*)([a-zA-Z])/g)) {
+        const repeat = count ? parseInt(count) : 1;
+        if (code == 's') {
+            fields.push({ size: repeat, read: (view, offset) => decoder.decode(new Uint8Array(view.buffer, offset, repeat)) });
+        } else {
+            for (let i = 0; i < repeat; i++) {
+                fields.push(structFormatCodes[code]);
+            }
+        }
+    }
+    return fields;
+}
+
+// Decodes a binary log response. The response is made of sections, each of which
+// is a line of json that describes the records followed by blocks of packed records.
+// Each block starts with its number of records (a little endian uint16), and a block
+// of 0 records ends the section. Returns a list of the section descriptions, with the
+// decoded records assigned to 'records' (oldest first).
+function decodeBinaryLogs(buffer) {
+    const bytes = new Uint8Array(buffer);
+    const view = new DataView(buffer);
+    const decoder = new TextDecoder();
+    let sections = [];
+    let offset = 0;
+    while (offset < bytes.length) {
+        const lineEnd = bytes.indexOf(10, offset);
+        if (lineEnd < 0) {
+            break;
+        }
+        let section = JSON.parse(decoder.decode(bytes.subarray(offset, lineEnd)));
+        offset = lineEnd + 1;
+        
+        const fields = parseStructFormat(section.format);
+        section.records = [];
+        let complete = false;
+        while (offset + 2 <= bytes.length) {
+            const blockCount = view.getUint16(offset, true);
+            offset += 2;
+            if (blockCount == 0) {
+                complete = true;
+                break;
+            }
+            if (offset + blockCount*section.stride > bytes.length) {
+                break;
+            }
+            for (let i = 0; i < blockCount; i++) {
+                let record = {};
+                let fieldOffset = offset;
+                fields.forEach((field, index) => {
+                    record[section.fields[index]] = field.read(view, fieldOffset);
+                    fieldOffset += field.size;
+                });
+                section.records.push(record);
+                offset += section.stride;
+            }
+        }
+        sections.push(section);
+        if (!complete) {
+            // The response was cut off, so there is nothing after this section
+            console.error('Binary log section is truncated after ' + section.records.length + ' records');
+            break;
+        }
+    }
+    return sections;
+}
@@ -0,0 +1,351 @@
+import ustruct as struct
+import ujson
+import time
+import os
+import uasyncio as asyncio
+from condlock import CondLock
+
+# LogStore keeps the history of a RingLog on flash, so that it survives a restart
+# and can reach further back than the ring.
+#
+# Logs are copied once they are final (see RingLog.closed_generation). They are
+# packed into a block in memory, and a full block is queued to be appended to the
+# newest segment file by a LogWriter, so flash is only written once per block, and
+# not while the control loop is updating the compressor. Every write is a whole
+# block (unused records are padded with 0xff), so the files stay block aligned. A
+# block holds at most half of the ring, so logs that haven't been written yet are
+# still in the ring as long as the writer keeps up. The files are:
+#
+#    <directory>/<name>.json   The format of the records, the block size and the time offsets
+#    <directory>/<name>.<n>    Segments of up to segment_blocks blocks, numbered from 0
+#
+# When a segment is full a new one is started, and only the newest segment_count
+# segments are kept. The first field of the logs must be their time.
+#
+# The Pico has no battery backed clock, so after a restart the clock starts from
+# the same time again and the stored logs are in its future. The stored logs are
+# then moved back so that they end just before the restart (see load_stores()).
+# This is done by adding an offset to the times of every stored segment, which is
+# kept in the json file, so the files are never rewritten. The time that the
+# controller was off is lost, and the history is always in order of time.
+class LogStore:
+    def __init__(self, log, directory, name, block_size, segment_blocks, segment_count, thread_safe = False):
+        self.log = log
+        self.directory = directory
+        self.name = name
+        self.block_size = block_size
+        self.segment_blocks = segment_blocks
+        self.segment_count = segment_count
+        self.lock = CondLock(thread_safe)   # Held while the files are being read or written
+        self.queue_lock = CondLock(thread_safe)     # Held while full_blocks and spare_blocks are changed
+
+        self.stride = log.stride
+        self.records_per_block = max(1, min(block_size//self.stride, log.size_limit//2))
+        self.empty_record = b'\xff'*self.stride
+        self.block = self._new_block()      # The block that logs are being added to
+        self.block_records = 0              # The number of records in self.block
+        self.full_blocks = []               # Blocks waiting to be written, oldest first
+        self.spare_blocks = []              # Written blocks that can be reused
+        self.read_buffer = bytearray(block_size)    # Blocks are read into this, see _read_block()
+        self.generation = log.closed_generation     # The logs up to this generation have been stored
+        self.segments = []                  # The numbers of the segment files, oldest first
+        self.segment_length = 0             # The number of blocks in the newest segment
+        self.offsets = {}                   # Seconds added to the times of each segment that was written before a clock reset
+
+        self.blocks_written = 0
+        self.last_write_ms = 0
+        self.max_write_ms = 0
+
+        self._open()
+
+    def _new_block(self):
+        return bytearray(self.empty_record*(self.block_size//self.stride) + b'\xff'*(self.block_size % self.stride))
+
+    def _segment_path(self, segment):
+        return '{}/{}.{}'.format(self.directory, self.name, segment)
+
+    def _description_path(self):
+        return '{}/{}.json'.format(self.directory, self.name)
+
+    # Writes the description of the files, with the offsets of the segments that exist
+    def _write_description(self):
+        offsets = {str(segment): self.offsets[segment] for segment in self.segments if segment in self.offsets}
+        with open(self._description_path(), 'w') as f:
+            f.write(ujson.dumps({"format": self.log.struct_format, "block_size": self.block_size, "offsets": offsets}))
+
+    # Finds the segments, and deletes them if they were written in a different format
+    def _open(self):
+        try:
+            os.mkdir(self.directory)
+        except OSError:
+            pass
+
+        prefix = self.name + '.'
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith(prefix) and file_name[len(prefix):].isdigit():
+                self.segments.append(int(file_name[len(prefix):]))
+        self.segments.sort()
+
+        try:
+            with open(self._description_path()) as f:
+                stored_description = ujson.loads(f.read())
+        except (OSError, ValueError):
+            stored_description = {}
+        if stored_description.get("format") != self.log.struct_format or stored_description.get("block_size") != self.block_size:
+            for segment in self.segments:
+                os.remove(self._segment_path(segment))
+            self.segments = []
+            self._write_description()
+        else:
+            offsets = stored_description.get("offsets", {})
+            self.offsets = {segment: offsets[str(segment)] for segment in self.segments if str(segment) in offsets}
+
+        if self.segments:
+            self.segment_length = os.stat(self._segment_path(self.segments[-1]))[6]//self.block_size
+
+    # Reads a block of a segment into read_buffer. Must be called with the lock held.
+    def _read_block(self, segment, block):
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(block*self.block_size)
+            return f.readinto(self.read_buffer) == self.block_size
+
+    # Returns the stored records of a block, oldest first, with offset added to
+    # their times (see RingLog.time_fields)
+    def _block_records(self, offset = 0):
+        records = []
+        time_fields = self.log.time_fields
+        for i in range(self.records_per_block):
+            position = i*self.stride
+            if self.read_buffer[position:position + self.stride] == self.empty_record:
+                break
+            record = struct.unpack_from(self.log.struct_format, self.read_buffer, position)
+            if offset:
+                record = list(record)
+                for field in time_fields:
+                    record[field] += offset
+                record = tuple(record)
+            records.append(record)
+        return records
+
+    # Yields the blocks of the segments (as (segment, block)) from the most recent
+    def _blocks(self):
+        for i in range(len(self.segments) - 1, -1, -1):
+            segment = self.segments[i]
+            try:
+                length = os.stat(self._segment_path(segment))[6]//self.block_size
+            except OSError:
+                # The segment was deleted after the list was read
+                continue
+            for block in range(length - 1, -1, -1):
+                yield (segment, block)
+
+    # Returns the latest time in the stored logs, or None if there are none
+    def newest_time(self):
+        with self.lock:
+            for (segment, block) in self._blocks():
+                if not self._read_block(segment, block):
+                    continue
+                records = self._block_records(self.offsets.get(segment, 0))
+                if records:
+                    return max(records[-1][field] for field in self.log.time_fields)
+        return None
+
+    # Restores the most recent stored logs into the log, after moving the stored
+    # logs time_shift seconds (see load_stores()). The logs after a shift start a new
+    # segment, since the offset only applies to the older ones. Logs must be added in
+    # order, so if the clock is still behind the stored logs they aren't restored.
+    def load(self, time_shift = 0):
+        log = self.log
+        if time_shift:
+            for segment in self.segments:
+                self.offsets[segment] = self.offsets.get(segment, 0) + time_shift
+            self._write_description()
+            self.segment_length = self.segment_blocks
+
+        records = []
+        with self.lock:
+            for (segment, block) in self._blocks():
+                if not self._read_block(segment, block):
+                    continue
+                records = self._block_records(self.offsets.get(segment, 0)) + records
+                if len(records) >= log.size_limit:
+                    break
+
+        if records and records[-1][0] > time.time():
+            print('{}: the clock is behind the stored logs, they will not be restored'.format(self.name))
+            self.segment_length = self.segment_blocks
+            return
+
+        with log.lock:
+            for record in records[-log.size_limit:]:
+                log.log(record)
+            log.restored()
+            self.generation = log.closed_generation
+
+    # Moves any logs that have become final into the block, and queues the block
+    # to be written when it is full. Called by the control loop with the lock of the
+    # log's owner held, so it never writes to flash.
+    def update(self):
+        log = self.log
+        closed_generation = log.closed_generation
+        # If the ring has wrapped past logs that weren't stored they are lost
+        self.generation = max(self.generation, log.generation - log.count)
+        while self.generation < closed_generation:
+            index = log.generation - self.generation - 1
+            log._copy_logs(memoryview(self.block)[self.block_records*self.stride:], index, 1)
+            self.generation += 1
+            self.block_records += 1
+            if self.block_records == self.records_per_block:
+                self._queue_block()
+
+    # Queues the block to be written, even if it isn't full, and starts a new one
+    def _queue_block(self):
+        if self.block_records == 0:
+            return
+        with self.queue_lock:
+            self.full_blocks.append(self.block)
+            self.block = self.spare_blocks.pop() if self.spare_blocks else self._new_block()
+        self.block_records = 0
+
+    # Writes the queued blocks to flash, at most limit of them if limit isn't None.
+    # Returns the number of blocks that were written.
+    def write_pending(self, limit = None):
+        written = 0
+        while limit is None or written < limit:
+            with self.queue_lock:
+                if not self.full_blocks:
+                    break
+                block = self.full_blocks[0]
+
+            self._write_block(block)
+            written += 1
+
+            block[0:self.records_per_block*self.stride] = self.empty_record*self.records_per_block
+            with self.queue_lock:
+                self.full_blocks.pop(0)
+                self.spare_blocks.append(block)
+        return written
+
+    # Appends a block to the newest segment, starting a new segment if it is full
+    def _write_block(self, block):
+        start = time.ticks_ms()
+        with self.lock:
+            if not self.segments or self.segment_length >= self.segment_blocks:
+                self.segments.append(self.segments[-1] + 1 if self.segments else 0)
+                self.segment_length = 0
+                while len(self.segments) > self.segment_count:
+                    segment = self.segments.pop(0)
+                    os.remove(self._segment_path(segment))
+                    self.offsets.pop(segment, None)
+
+            with open(self._segment_path(self.segments[-1]), 'ab') as f:
+                f.write(block)
+            self.segment_length += 1
+
+        self.blocks_written += 1
+        self.last_write_ms = time.ticks_diff(time.ticks_ms(), start)
+        self.max_write_ms = max(self.max_write_ms, self.last_write_ms)
+
+    # Writes everything now, including the block that isn't full yet. Must be
+    # called with the lock of the log's owner held.
+    def flush(self):
+        self._queue_block()
+        self.write_pending()
+
+    # Outputs the stored logs with since <= log[filter_index] < before as json, most
+    # recent first, continuing a list that already has written logs. Returns the number
+    # of logs that were written. Logs are read a block at a time, and the files are
+    # only locked while a block is read.
+    async def dump(self, writer, since, before, written = 0, filter_index = 0):
+        log = self.log
+        for (segment, block) in self._blocks():
+            with self.lock:
+                if not self._read_block(segment, block):
+                    continue
+                records = self._block_records(self.offsets.get(segment, 0))
+
+            for i in range(len(records) - 1, -1, -1):
+                record = records[i]
+                if since <= record[filter_index] < before:
+                    if written:
+                        writer.write(",")
+                    written += 1
+                    log.write_json(writer, record)
+            await writer.drain()
+
+            # Logs are stored in order of time, so older blocks can't match
+            if filter_index == 0 and records and records[0][0] < since:
+                break
+        return written
+
+    @property
+    def stats_dictionary(self):
+        return {
+            'segments': len(self.segments),
+            'blocks_written': self.blocks_written,
+            'pending_blocks': len(self.full_blocks),
+            'last_write_ms': self.last_write_ms,
+            'max_write_ms': self.max_write_ms
+        }
+
+# Restores the logs of stores whose logs are shown together (see LogStore.load()).
+# If the clock is behind the newest stored log it was reset by the restart, so the
+# stored logs of all of the stores are moved back by the same amount, so that they
+# end just before now and stay in step with each other.
+def load_stores(stores):
+    newest = None
+    for store in stores:
+        store_newest = store.newest_time()
+        if store_newest is not None and (newest is None or store_newest > newest):
+            newest = store_newest
+
+    time_shift = 0
+    now = time.time()
+    if newest is not None and newest >= now:
+        time_shift = now - 1 - newest
+        print('The clock is behind the stored logs, they are moved back {} seconds'.format(-time_shift))
+
+    for store in stores:
+        store.load(time_shift)
+
+# LogWriter writes the blocks that LogStores have queued to flash from a task of its
+# own, rather than from the update of the compressor. Writing to flash is blocking,
+# so while a block is written the other tasks on the event loop (the web server, and
+# the control loop unless the compressor runs on its own thread) wait for it. To
+# bound the wait, at most one block is written every interval milliseconds, taking
+# the stores in turn. The time taken by the writes is reported by the stats of the
+# stores. Any blocks that are still queued are written when the writer is stopped.
+class LogWriter:
+    def __init__(self, stores, interval):
+        self.stores = stores
+        self.interval = interval
+        self.next_store = 0     # The store that is checked first by the next wakeup
+        self.run_task = None
+
+    # Writes a block of the first store (from next_store) that has one queued.
+    # Returns True if a block was written.
+    def write_next(self):
+        count = len(self.stores)
+        for i in range(count):
+            index = (self.next_store + i) % count
+            if self.stores[index].write_pending(1):
+                self.next_store = (index + 1) % count
+                return True
+        return False
+
+    async def _run(self):
+        while True:
+            self.write_next()
+            await asyncio.sleep_ms(self.interval)
+
+    def run(self):
+        self.run_task = asyncio.create_task(self._run())
+
+    # Stops the writer and writes everything, including the blocks that aren't full.
+    # Must be called with the lock of the logs' owner held.
+    def stop(self):
+        if self.run_task is not None:
+            self.run_task.cancel()
+            self.run_task = None
+        for store in self.stores:
+            store.flush()
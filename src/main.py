@@ -1,5 +1,6 @@
 from settings import Settings
 from settings import ValueScale
+from settings_persister import SettingsPersister
 import debug
 from heartbeatmonitor import HeartbeatMonitor
 import compressor_controller
@@ -56,15 +57,22 @@ default_settings = {
         "value_min": 0,
         "value_max": 150,
         "sensor_min": 6554,            # 0.5V from sensor scaled to 0.33V for Pico (10%)
-        "sensor_max": 58981            # 4.5V from sensor scaled to 2.97V for Pico (90%)
+        "sensor_max": 58981,           # 4.5V from sensor scaled to 2.97V for Pico (90%)
+        "calibration": []              # [sensor, value] points measured with /calibrate, used instead of the min and max values when there are 2 or more
     },
     "line_pressure_sensor": {
         "value_min": 0,
         "value_max": 150,
         "sensor_min": 6554,            # 0.5V from sensor scaled to 0.33V for Pico (10%)
-        "sensor_max": 58981            # 4.5V from sensor scaled to 2.97V for Pico (90%)
+        "sensor_max": 58981,           # 4.5V from sensor scaled to 2.97V for Pico (90%)
+        "calibration": []              # [sensor, value] points measured with /calibrate, used instead of the min and max values when there are 2 or more
     },
     
+    # Sensor sampling (see SensorSampler)
+    "adc_samples": 8,                  # Number of samples taken for each pressure reading
+    "adc_filter": 'median',            # How the samples are combined: 'mean', 'median', 'trimmed' or 'ema'
+    "adc_ema_alpha": 0.3,              # Weight of each new reading for the 'ema' filter
+    
     # Setting this to False will permanently de-activate the server for debugging
     # The following command can be used as a 'poison pill' to prevent the server
     # from booting up and taking control of the device when debugging:
@@ -77,17 +85,20 @@ default_settings = {
 
 class CompressorSettings(Settings):
     # Static settings (cannot be updated or persisted)
-    def __init__(self, default_settings):
-        Settings.__init__(self, default_settings)
+    def __init__(self, default_settings, persist_path = 'settings.json'):
+        Settings.__init__(self, default_settings, persist_path)
         
         self.tank_pressure_pin = 0       # ADC pin for pressure sensor
         self.line_pressure_pin = None    # ADC pin for pressure sensor
+        self.adc_max_samples = 32        # Size of the sample buffers, the maximum value of adc_samples
+        self.sensor_min_read_interval = 250 # Milliseconds between fresh sensor reads requested by clients
         
         self.compressor_motor_pin = 15   # Output for compressor relay (Set to None if only pressure monitoring is desired)
         self.unload_solenoid_pin = 14    # Output for unload solenoid
         self.drain_solenoid_pin = 16     # Output for drain solenoid
         
         self.status_poll_interval = 250       # Update interval for status LEDs
+        self.event_stream_interval = 250      # Interval at which /events streams check for changes
         self.compressor_on_status_pin = 2     # Output for power LED (indicates that pressure is being regulated)
         self.compressor_on_status_pin2 = "LED" # Output for secondary power LED
         self.error_status_pin = 5             # Output for error LED
@@ -104,7 +115,32 @@ class CompressorSettings(Settings):
         self.value_down_button_pin = 13       # Input for value down button to decrement selected value
         
         self.http_root = 'http/'
+        self.http_cache_max_age = 0           # Seconds browsers may cache static files without revalidating (0 always revalidates)
+        self.http_keep_alive_timeout = 5      # Seconds an idle connection is kept open for another request
+        self.http_max_requests = 100          # Requests served on a connection before it is closed
+        self.http_max_connections = 8         # Connections served at once (not including event streams), others get a 503
+        self.http_max_streams = 4             # Event streams (/events) served at once, others get a 503
+        self.http_header_timeout = 5          # Seconds allowed for the first request of a connection to arrive, and to receive the headers of a request
+        self.http_body_timeout = 5            # Seconds allowed to receive the body of a request
+        self.http_write_timeout = 10          # Seconds allowed for the client to accept each block of a response
+        self.http_max_headers = 32            # Headers accepted in a request
+        self.http_max_header_length = 512     # Bytes accepted in a header line
+        self.http_max_body_length = 4096      # Bytes accepted in a request body
         self.watchdog_timeout = 5000;         # Milliseconds to allow between updates before the system is restarted
+        self.settings_write_delay = 2000      # Milliseconds without changes before changed settings are written to flash
+        
+        self.log_directory = None             # Directory for the history of the state and activity logs on flash (e.g. 'logs'), None keeps them in memory only
+        self.log_block_size = 512             # Bytes written to flash at a time, the logs since the last write are lost on a restart
+        self.log_segment_blocks = 16          # Blocks in each log file
+        self.log_segment_count = 12           # Log files kept for each log, older ones are deleted
+        self.log_write_interval = 1000        # Milliseconds between writes of full blocks of logs to flash, one block is written at a time
+        self.columnar_logs = False            # Keep each field of the state and activity logs in its own array (see RingLog)
+        self.compact_state_log = False        # Store the state log in 8 bytes per log instead of 19, and its summaries in 14 instead of 27 (see CompactStateLog)
+        self.state_log_size = 200             # Logs kept in memory by the state log, one every log_interval
+        self.state_rollups = ((60, 120), (900, 96), (3600, 168))  # (seconds per log, logs) of the summaries of the state history, finest first
+        
+        self.trace_path = 'trace.bin'         # File that controller traces are recorded to when debug.DEBUG_TRACE is set
+        self.trace_max_size = 64*1024         # Bytes in a trace file before it is moved to trace_path + '.old' and restarted
         
         self.use_multiple_threads = False
         #self.debug_mode = debug.DEBUG_COROUTINES | debug.DEBUG_WEB_REQUEST | debug.DEBUG_ADC_SIMULATE #| debug.DEBUG_ADC
@@ -127,6 +163,9 @@ async def main():
     # pressure is monitored
     compressor = compressor_controller.CompressorController(settings, thread_safe = settings.use_multiple_threads)
     tasks.append(compressor)
+
+    # Write changes to the settings in the background
+    tasks.append(SettingsPersister(settings, settings.settings_write_delay))
             
     # Start any UI coroutines to monitor and update the main thread
     if server_enabled:
@@ -149,5 +188,7 @@ async def main():
         
     print("WARNING: Foreground coroutines are done.")
 
-# Run main to start configuration
-asyncio.run(main())
+# Run main to start configuration. The settings and main() can be imported without
+# starting the controller (see host/replay.py).
+if __name__ == '__main__':
+    asyncio.run(main())
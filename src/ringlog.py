@@ -1,4 +1,6 @@
 import ustruct as struct
+import ujson
+from array import array
 from condlock import CondLock
 
 # Provides an efficient ring buffer for storing logs. The buffer is a
@@ -6,26 +8,119 @@ from condlock import CondLock
 # in order to append a new element. When referencing elements indexes
 # are relative to the last element added, so log[0] is the last element,
 # log[1] is the previous, etc.
+#
+# A columnar log keeps each field in its own array instead, indexed by the
+# slot of the log, so analytics can read the fields they need without
+# unpacking whole logs (see field_slices() and iter_field()). Logs are
+# packed into records when they are copied (see _copy_logs()), so dumps and
+# LogStore work the same for both layouts. field() reads a single field of a
+# log in either layout, and index_range() finds the logs in a time range.
 class RingLog:
-    def __init__(self, struct_format, field_names, size_limit, thread_safe = False):
+    # The fields that hold times, which LogStore moves if the clock has been reset
+    time_fields = (0,)
+
+    # ordered_index is the index of a field that never decreases as logs are added
+    # (such as a timestamp). Queries that filter on it can bisect the log instead
+    # of testing every entry.
+    def __init__(self, struct_format, field_names, size_limit, thread_safe = False, ordered_index = None, columnar = False):
         self.size_limit = size_limit
         self.struct_format = struct_format
         self.field_names = field_names
+        self.ordered_index = ordered_index
         self.lock = CondLock(thread_safe)
 
         self.stride = struct.calcsize(struct_format)
-        self.data = bytearray(size_limit * self.stride)
+        self._parse_fields()
+        self._allocate(columnar)
         
         self.console_log = False
         self.end_index = -1
         self.count = 0
+        self.generation = 0         # The number of logs that have ever been added
+        self.revision = 0           # Incremented whenever a log is added or modified
+
+        self.dump_block_size = 8    # The number of logs that dump() copies at a time
+        self.scratch = None         # Allocated by the first dump()
     
+    # Allocates the storage for the logs. A subclass that encodes logs itself sets
+    # data to None and provides _read_slot() and _write_slot(), like a columnar log.
+    def _allocate(self, columnar):
+        if columnar:
+            self.data = None
+            self._make_columns()
+        else:
+            self.data = bytearray(self.size_limit * self.stride)
+            self.columns = None
+
+    # Finds the type code, the width of string fields (or 0) and the offset in a
+    # packed record of each field of the format
+    def _parse_fields(self):
+        self.field_codes = []
+        self.widths = []            # The bytes per log of string fields, or 0
+        self.field_formats = []     # The struct format of each field on its own, see field()
+        self.field_offsets = []
+        byte_order = self.struct_format[0] if self.struct_format[0] in '<>!=@' else ''
+        offset = 0
+        count = ''
+        for code in self.struct_format:
+            if code in '<>!=@':
+                continue
+            if code.isdigit():
+                count += code
+                continue
+
+            repeat = int(count) if count else 1
+            count = ''
+            if code == 's':
+                self.field_codes.append(code)
+                self.widths.append(repeat)
+                self.field_formats.append(byte_order + str(repeat) + code)
+                self.field_offsets.append(offset)
+                offset += repeat
+            else:
+                for i in range(repeat):
+                    self.field_codes.append(code)
+                    self.widths.append(0)
+                    self.field_formats.append(byte_order + code)
+                    self.field_offsets.append(offset)
+                    offset += struct.calcsize(byte_order + code)
+
+    # Creates an array for each field of the format. Strings are kept in a bytearray
+    # with width bytes per log, other fields in an array of their type.
+    def _make_columns(self):
+        self.columns = []
+        self.column_size = 0        # The bytes of all of the columns
+        for (code, width) in zip(self.field_codes, self.widths):
+            if width:
+                self.columns.append(bytearray(width*self.size_limit))
+                self.column_size += width*self.size_limit
+            else:
+                self.columns.append(array(code, bytes(struct.calcsize(code)*self.size_limit)))
+                self.column_size += struct.calcsize(code)*self.size_limit
+
+    # The bytes of memory that are used to store the logs
+    @property
+    def storage_size(self):
+        return len(self.data) if self.columns is None else self.column_size
+
+    # The number of logs that have ever been added and are final. Logs that are
+    # still being updated (see EventLog) aren't final, so they can't be persisted.
+    @property
+    def closed_generation(self):
+        return self.generation
+
+    # Called after logs have been restored (see LogStore.load()), so that anything
+    # derived from the logs can be rebuilt
+    def restored(self):
+        pass
+
     # Advances the insertion point by 1, and packs a new long into the buffer
     def log(self, log_tuple):
         with self.lock:
             # Advance the end_index to the next available slot in the log
             self.end_index = (self.end_index + 1) % self.size_limit
             self.count = min(self.count + 1, self.size_limit)
+            self.generation += 1
 
             # Assign the tuple to the most recent slot
             self[0] = log_tuple
@@ -38,53 +133,264 @@ class RingLog:
             return '"' + value.decode() + '"'
 
         return value
-                
-    # Outputs all entries in the log as json pairs without having to allocate one big string
-    # NOTE If the blocking parameter is false, then the writer will not be drained. The caller
-    #      will not be blocked, but it will also be necessary for the writer to buffer all of
-    #      the data, so the memory consumption will be much larger. This is an unfortunate
-    #      tradeoff if the caller requires a lock on another thread.
-    async def dump(self, writer, since, filter_index = 0, blocking = True):
-        # TODO It may not be necessary to lock the log for the entire duration of
-        #      the write. This could alleviate the need for the blocking parameter.
-        #      But it would be necessary to ensure that a new log has not overwriten
-        #      one of the logs we're about to send. For now I'll just lock the whole
-        #      thing.
-        if blocking:
-            await writer.drain()
-            
+
+    # Copies the packed logs log[index + count - 1] ... log[index] into buffer,
+    # oldest first. The logs are contiguous in self.data unless they wrap
+    # around the end of the ring, so this is at most two block copies.
+    def _copy_logs(self, buffer, index, count):
+        stride = self.stride
+        first_slot = (self.end_index - index - count + 1) % self.size_limit
+        tail_count = min(count, self.size_limit - first_slot)
+
+        if self.data is None:
+            for i in range(count):
+                struct.pack_into(self.struct_format, buffer, i*stride, *self._read_slot((first_slot + i) % self.size_limit))
+            return
+
+        destination = memoryview(buffer)
+        source = memoryview(self.data)
+        destination[0:tail_count*stride] = source[first_slot*stride:(first_slot + tail_count)*stride]
+        if tail_count < count:
+            destination[tail_count*stride:count*stride] = source[0:(count - tail_count)*stride]
+
+    # Writes a log as a json object
+    def write_json(self, writer, log):
+        writer.write("{")
+        first_field = True
+        for field, value in zip(self.field_names, log):
+            if not first_field:
+                writer.write(",")
+            first_field = False
+
+            writer.write('"' + field + '":' + str(self.map_value_for_dump(field, value)))
+        writer.write("}")
+
+    # Outputs all entries in the log as json pairs without having to allocate one big
+    # string, and returns the number of logs that were written
+    #
+    # The log is only locked while a small block of logs is copied into a scratch
+    # buffer, so the writer can be drained without blocking a thread that is adding
+    # logs, and the writer never has to buffer more than one block. Logs that are
+    # added while the dump is in progress shift the indexes of the logs being sent,
+    # which is tracked with the generation counter. If logs that haven't been sent
+    # yet are overwritten the dump ends early.
+    async def dump(self, writer, since, filter_index = 0):
+        await writer.drain()
+
         with self.lock:
-            first_log = True
-            for i in range(self.count):
-                log = self[i]
+            count = self.count_since(since, filter_index)
+            generation = self.generation
+
+        if self.scratch is None:
+            self.scratch = bytearray(self.dump_block_size*self.stride)
+        scratch = self.scratch
+
+        written = 0
+        sent = 0
+        while sent < count:
+            with self.lock:
+                index = sent + self.generation - generation
+                block_count = min(self.dump_block_size, count - sent, self.count - index)
+                if block_count <= 0:
+                    break
+                self._copy_logs(scratch, index, block_count)
+
+            # The scratch buffer is shared by all dumps of this log, so it must be
+            # consumed before yielding to another coroutine. Logs are sent most
+            # recent first, so the block is read backwards.
+            for i in range(block_count - 1, -1, -1):
+                log = struct.unpack_from(self.struct_format, scratch, i*self.stride)
                 if log[filter_index] >= since:
-                    if not first_log:
+                    if written:
                         writer.write(",")
-                    first_log = False
-
-                    writer.write("{")
-                    first_field = True
-                    for field, value in zip(self.field_names, log):
-                        if not first_field:
-                            writer.write(",")
-                        first_field = False
-                                                
-                        writer.write('"' + field + '":' + str(self.map_value_for_dump(field, value)))
-                    writer.write("}")
-                    if blocking:
-                        await writer.drain()
+                    written += 1
+                    self.write_json(writer, log)
+
+            sent += block_count
+            await writer.drain()
+
+        return written
+
+    # Outputs the logs as packed binary records, oldest first. The records are
+    # preceded by a line of json that describes them:
+    #
+    #    {"format": struct_format, "fields": field_names, "stride": bytes per record}
+    #
+    # Any values in header are added to the description. The records are sent in
+    # blocks, each preceded by its number of records as a little endian uint16, and
+    # a block of 0 records ends the section. All of the logs from the oldest one
+    # that matches since are sent, so if the filter field isn't the ordered_index a
+    # few logs that don't match may be included. If logs that haven't been sent are
+    # overwritten during the dump it ends early, so the section may have fewer logs
+    # than matched when it started, but the blocks always say how many were sent.
+    async def dump_binary(self, writer, since, filter_index = 0, header = None):
+        await writer.drain()
+
+        with self.lock:
+            count = self.count_since(since, filter_index)
+            generation = self.generation
+
+        description = {} if header is None else dict(header)
+        description["format"] = self.struct_format
+        description["fields"] = self.field_names
+        description["stride"] = self.stride
+        writer.write(ujson.dumps(description))
+        writer.write("\n")
+
+        if self.scratch is None:
+            self.scratch = bytearray(self.dump_block_size*self.stride)
+        scratch = self.scratch
+
+        sent = 0
+        while sent < count:
+            block_count = min(self.dump_block_size, count - sent)
+            with self.lock:
+                # The oldest log that hasn't been sent was at index count - sent - 1
+                index = count - sent - block_count + self.generation - generation
+                if index + block_count > self.count:
+                    break
+                self._copy_logs(scratch, index, block_count)
+
+            # The records are already in order, so the block is sent as is. The
+            # writer copies anything that it can't send immediately.
+            writer.write(struct.pack('<H', block_count))
+            writer.write(memoryview(scratch)[0:block_count*self.stride])
+            sent += block_count
+            await writer.drain()
+        writer.write(struct.pack('<H', 0))
+
+    # Returns n such that the logs that may have log[filter_index] >= since are
+    # all in log[0] ... log[n - 1]. If filter_index is the ordered_index these are
+    # exactly the matching logs, and they are found by bisection. Otherwise n is
+    # found by testing logs from the oldest until one matches.
+    def count_since(self, since, filter_index = 0):
+        with self.lock:
+            if filter_index != self.ordered_index:
+                count = self.count
+                while count > 0 and self.field(count - 1, filter_index) < since:
+                    count -= 1
+                return count
+
+            return self._bisect(since, filter_index, False)
+
+    # Returns the number of logs with log[filter_index] >= value, or > value if
+    # after is set. The values must decrease with the index. Must be called with
+    # the lock held.
+    def _bisect(self, value, filter_index, after):
+        # Logs are indexed from the most recent, so the values decrease with
+        # the index. Find the first index whose value is before value.
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            field = self.field(middle, filter_index)
+            if field > value or (field == value and not after):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Returns the logs with since <= log[ordered_index] <= until as (index, count),
+    # for field_slices(), iter_field() or _copy_logs(). Either limit may be None.
+    def index_range(self, since = None, until = None):
+        with self.lock:
+            index = 0 if until is None else self._bisect(until, self.ordered_index, True)
+            end = self.count if since is None else self._bisect(since, self.ordered_index, False)
+            return (index, max(0, end - index))
+
+    # Returns a field of log[index] without unpacking the rest of the log
+    def field(self, index, field_index):
+        with self.lock:
+            slot = (self.end_index - index) % self.size_limit
+            if self.columns is not None:
+                width = self.widths[field_index]
+                if width:
+                    return bytes(self.columns[field_index][slot*width:(slot + 1)*width])
+                return self.columns[field_index][slot]
+            if self.data is not None:
+                return struct.unpack_from(self.field_formats[field_index], self.data, slot*self.stride + self.field_offsets[field_index])[0]
+            return self._read_slot(slot)[field_index]
+
+    # Returns the values of a field for log[index + count - 1] ... log[index], oldest
+    # first, as views of its column. There are two views if the logs wrap around the
+    # end of the ring, otherwise one. Nothing is copied, so the views must be used with
+    # the lock held. A string field has width bytes per log. Only for columnar logs.
+    def field_slices(self, field_index, index = 0, count = None):
+        if self.columns is None:
+            raise ValueError('field_slices() needs a columnar log')
+        if count is None:
+            count = self.count - index
+        first_slot = (self.end_index - index - count + 1) % self.size_limit
+        tail_count = min(count, self.size_limit - first_slot)
+
+        width = self.widths[field_index] or 1
+        column = memoryview(self.columns[field_index])
+        slices = [column[first_slot*width:(first_slot + tail_count)*width]]
+        if tail_count < count:
+            slices.append(column[0:(count - tail_count)*width])
+        return slices
+
+    # Yields the values of a field for log[index + count - 1] ... log[index], oldest
+    # first. A columnar log reads them from the column without unpacking the logs.
+    def iter_field(self, field_index, index = 0, count = None):
+        if count is None:
+            count = self.count - index
+        if self.columns is None:
+            # The logs aren't columnar, so they are unpacked
+            for i in range(index + count - 1, index - 1, -1):
+                yield self[i][field_index]
+            return
+
+        width = self.widths[field_index]
+        for values in self.field_slices(field_index, index, count):
+            if width:
+                for offset in range(0, len(values), width):
+                    yield bytes(values[offset:offset + width])
+            else:
+                for value in values:
+                    yield value
+
+    # Returns the log in a slot of a columnar log
+    def _read_slot(self, slot):
+        values = []
+        for (column, width) in zip(self.columns, self.widths):
+            if width:
+                values.append(bytes(column[slot*width:(slot + 1)*width]))
+            else:
+                values.append(column[slot])
+        return tuple(values)
+
+    # Stores a log in a slot of a columnar log. Strings are padded with zeros or
+    # truncated to the width of their field, like struct does.
+    def _write_slot(self, slot, log_tuple):
+        for (column, width, value) in zip(self.columns, self.widths, log_tuple):
+            if width:
+                if isinstance(value, str):
+                    value = value.encode()
+                value = value[:width]
+                column[slot*width:slot*width + len(value)] = value
+                if len(value) < width:
+                    column[slot*width + len(value):(slot + 1)*width] = bytes(width - len(value))
+            else:
+                column[slot] = value
 
     def __getitem__(self, index):
         with self.lock:
             wrapped_index = (self.end_index - index) % self.size_limit
-            
+
+            if self.data is None:
+                return self._read_slot(wrapped_index)
             return struct.unpack_from(self.struct_format, self.data, wrapped_index * self.stride)
 
     def __setitem__(self, index, log_tuple):
         with self.lock:
             wrapped_index = (self.end_index - index) % self.size_limit
 
-            struct.pack_into(self.struct_format, self.data, wrapped_index * self.stride, *log_tuple)
+            if self.data is None:
+                self._write_slot(wrapped_index, log_tuple)
+            else:
+                struct.pack_into(self.struct_format, self.data, wrapped_index * self.stride, *log_tuple)
+            self.revision += 1
         
         if self.console_log:
             print("Logged[{}]: {}".format(wrapped_index, log_tuple))
@@ -0,0 +1,125 @@
+from array import array
+import time
+
+# SensorSampler reduces the noise of an analog sensor by taking several samples
+# for each reading, and combining them with a filter. The samples are read into a
+# buffer that is allocated once, so a reading doesn't allocate memory.
+#
+# The number of samples (adc_samples) and the filter (adc_filter) are read from a
+# snapshot of the settings on every reading, so they can be changed while running:
+#
+#    mean:     the average of the samples
+#    median:   the middle sample, which ignores spikes in up to half of the samples
+#    trimmed:  the average of the samples after dropping the lowest and highest quarter
+#    ema:      an exponential moving average (weighted by adc_ema_alpha) of the
+#              mean of each reading. It is the smoothest, but it lags behind changes
+#              in pressure (and sensor errors) by several readings.
+#
+# The time taken by each reading is measured, so that the cost of sampling can be
+# weighed against the noise (the spread of the samples) that it removes.
+class SensorSampler:
+    def __init__(self, adc, settings, max_samples):
+        self.adc = adc
+        self.settings = settings
+        self.samples = array('H', bytes(2*max_samples))
+        self.average = None     # The moving average of the ema filter
+        self.spread = 0         # The difference between the largest and smallest sample of the last reading
+        self.last_us = 0        # The time taken by the last reading
+        self.max_us = 0         # The longest time taken by a reading
+        self.total_us = 0       # The total time taken by all readings
+        self.count = 0          # The number of readings
+
+    # Samples the sensor and returns the filtered raw value. The settings are read
+    # from settings, a snapshot of the settings (the current one by default), so the
+    # control loop can pass the snapshot of its update.
+    def read(self, settings = None):
+        start = time.ticks_us()
+        if settings is None:
+            settings = self.settings.snapshot
+        samples = self.samples
+        count = min(max(1, settings.adc_samples), len(samples))
+        sample_filter = settings.adc_filter
+
+        read_u16 = self.adc.read_u16
+        for i in range(count):
+            samples[i] = read_u16()
+
+        if sample_filter == 'median' or sample_filter == 'trimmed':
+            self._sort(count)
+            if sample_filter == 'median':
+                middle = count >> 1
+                if count & 1:
+                    value = samples[middle]
+                else:
+                    value = (samples[middle - 1] + samples[middle])/2
+            else:
+                trim = count >> 2
+                value = self._sum(trim, count - trim)/(count - 2*trim)
+            self.spread = samples[count - 1] - samples[0]
+        else:
+            value = self._sum(0, count)/count
+            if sample_filter == 'ema':
+                if self.average is not None:
+                    value = self.average + settings.adc_ema_alpha*(value - self.average)
+                self.average = value
+
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        self.last_us = elapsed
+        self.total_us += elapsed
+        self.count += 1
+        if elapsed > self.max_us:
+            self.max_us = elapsed
+
+        return value
+
+    # Samples the sensor count times (the size of the buffer by default) and returns
+    # the average of the samples, without the filter. This is for calibration, where
+    # the reading must match the pressure now rather than lag behind it. The filter
+    # state and the statistics of the readings aren't changed.
+    def read_raw(self, count = None):
+        count = len(self.samples) if count is None else min(max(1, count), len(self.samples))
+        read_u16 = self.adc.read_u16
+        total = 0
+        for i in range(count):
+            total += read_u16()
+        return total/count
+
+    # Returns the sum of samples[start:end], and records their spread
+    def _sum(self, start, end):
+        samples = self.samples
+        total = 0
+        low = 65535
+        high = 0
+        for i in range(start, end):
+            sample = samples[i]
+            total += sample
+            if sample < low:
+                low = sample
+            if sample > high:
+                high = sample
+        self.spread = high - low
+        return total
+
+    # Sorts samples[0:count] in place. The sample counts are small, so an
+    # insertion sort is fast enough and doesn't allocate.
+    def _sort(self, count):
+        samples = self.samples
+        for i in range(1, count):
+            sample = samples[i]
+            j = i - 1
+            while j >= 0 and samples[j] > sample:
+                samples[j + 1] = samples[j]
+                j -= 1
+            samples[j + 1] = sample
+
+    @property
+    def stats_dictionary(self):
+        settings = self.settings.snapshot
+        return {
+            'samples': min(max(1, settings.adc_samples), len(self.samples)),
+            'filter': settings.adc_filter,
+            'spread': self.spread,
+            'last_us': self.last_us,
+            'max_us': self.max_us,
+            'average_us': self.total_us/self.count if self.count else 0
+        }
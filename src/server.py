@@ -4,7 +4,296 @@ import network
 import socket
 import ujson
 import sys
+import os
+import time
     
+STATUS_REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    408: 'Request Timeout',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable'
+}
+
+# Raised while reading a request that can't be served. The connection is closed
+# after the error response is sent.
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+# Reads the requests of a connection through a buffer that is reused for every
+# request, so reading a request only allocates the strings that are kept: the
+# method, the path, the query parameters, and the headers the route asked for.
+# Data after the current request (the start of a pipelined request) stays in the
+# buffer for the next one.
+class RequestReader:
+    def __init__(self, reader, size = 1024):
+        self.reader = reader
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0      # Start of the data that hasn't been consumed
+        self.end = 0        # End of the data in the buffer
+        self.scanned = 0    # End of the data that has been searched for a line end
+
+    # Reads more data into the buffer, moving any data that hasn't been consumed to
+    # the front first. Returns False if the connection was closed. Raises
+    # RequestError if a line doesn't fit in the buffer.
+    async def fill(self):
+        start = self.start
+        if start:
+            count = self.end - start
+            self.buffer[0:count] = self.buffer[start:self.end]
+            self.start = 0
+            self.end = count
+            self.scanned = max(0, self.scanned - start)
+        if self.end == len(self.buffer):
+            raise RequestError(431, 'request too large')
+
+        count = await self.reader.readinto(self.view[self.end:])
+        if not count:
+            return False
+        self.end += count
+        return True
+
+    # Waits until there is data for a request. Returns False if the connection was
+    # closed.
+    async def wait_for_data(self):
+        if self.start < self.end:
+            return True
+        return await self.fill()
+
+    # Consumes the next line and returns its (start, end) indexes in the buffer,
+    # without the line ending. Raises RequestError if the connection is closed
+    # before the line ends.
+    async def read_line(self):
+        buffer = self.buffer
+        while True:
+            i = max(self.scanned, self.start)
+            end = self.end
+            # MicroPython's bytearray has no find(), so scan the new data here
+            while i < end:
+                if buffer[i] == 10:
+                    break
+                i += 1
+            if i < end:
+                break
+            self.scanned = end
+            if not await self.fill():
+                raise RequestError(400, 'incomplete request')
+
+        start = self.start
+        self.start = self.scanned = i + 1
+        if i > start and buffer[i - 1] == 13:
+            i -= 1
+        return (start, i)
+
+    # Reads a request line. Returns (method, path, parameters, protocol), where
+    # path and parameters are url decoded. Blank lines before the request are
+    # skipped. Raises RequestError if the line isn't a valid request.
+    async def read_request_line(self):
+        (start, end) = await self.read_line()
+        while start == end:
+            (start, end) = await self.read_line()
+
+        buffer = self.buffer
+        method_end = find_byte(buffer, 32, start, end)         # ' '
+        target_end = find_byte(buffer, 32, method_end + 1, end)
+        if method_end < 0 or target_end < 0:
+            raise RequestError(400, 'malformed request')
+        method = str(self.view[start:method_end], 'ascii')
+        # Only HTTP/1.1 and HTTP/1.0 are expected, anything else is answered as 1.0
+        if end - target_end == 9 and buffer[end - 3] == 49 and buffer[end - 1] == 49:
+            protocol = 'HTTP/1.1'
+        else:
+            protocol = 'HTTP/1.0'
+
+        query = find_byte(buffer, 63, method_end + 1, target_end)      # '?'
+        path = url_decode(buffer, method_end + 1, target_end if query < 0 else query, False)
+        parameters = {}
+        if query >= 0:
+            position = query + 1
+            while position < target_end:
+                pair_end = find_byte(buffer, 38, position, target_end)   # '&'
+                if pair_end < 0:
+                    pair_end = target_end
+                if pair_end > position:
+                    separator = find_byte(buffer, 61, position, pair_end)    # '='
+                    if separator < 0:
+                        parameters[url_decode(buffer, position, pair_end, True)] = ''
+                    else:
+                        parameters[url_decode(buffer, position, separator, True)] = url_decode(buffer, separator + 1, pair_end, True)
+                position = pair_end + 1
+
+        return (method, path, parameters, protocol)
+
+    # Reads the request headers, keeping only those named in route.header_names.
+    # Header names are matched without regard to case. Raises RequestError if there
+    # are more than max_headers headers or a line is longer than max_length.
+    async def read_headers(self, route, max_headers, max_length):
+        buffer = self.buffer
+        header_names = route.header_names
+        header_lengths = route.header_lengths
+        headers = {}
+        count = 0
+        while True:
+            (start, end) = await self.read_line()
+            if start == end:
+                return headers
+
+            count += 1
+            if count > max_headers or end - start > max_length:
+                raise RequestError(431, 'headers too large')
+            colon = find_byte(buffer, 58, start, end)           # ':'
+            if colon < 0:
+                raise RequestError(400, 'malformed header')
+            if colon - start not in header_lengths:
+                continue
+            name = header_names.get(bytes(self.view[start:colon]).lower())
+            if name is None:
+                continue
+
+            start = colon + 1
+            while start < end and (buffer[start] == 32 or buffer[start] == 9):
+                start += 1
+            while end > start and (buffer[end - 1] == 32 or buffer[end - 1] == 9):
+                end -= 1
+            headers[name] = str(self.view[start:end], 'utf-8')
+
+    # Reads a body of length bytes
+    async def read_body(self, length):
+        body = bytearray(length)
+        count = min(length, self.end - self.start)
+        body[0:count] = self.view[self.start:self.start + count]
+        self.start += count
+
+        view = memoryview(body)
+        while count < length:
+            read = await self.reader.readinto(view[count:])
+            if not read:
+                raise RequestError(400, 'incomplete body')
+            count += read
+        return bytes(body)
+
+# Wraps the stream writer of a connection to frame the responses sent on it.
+# When the connection is kept alive each response must have a known length, so
+# a response without a Content-Length is sent with chunked transfer encoding.
+# Writes are collected into chunks of up to chunk_size bytes (rather than one
+# chunk per write) to keep the framing overhead low.
+class ResponseWriter:
+    def __init__(self, writer, write_timeout, chunk_size = 512):
+        self.writer = writer
+        self.write_timeout = write_timeout  # Seconds to wait for the client to accept data
+        self.protocol = 'HTTP/1.0'      # Protocol of the current request
+        self.keep_alive = False         # True if the connection stays open after the current response
+        self.chunked = False            # True if the current response is being sent in chunks
+        self.chunk = bytearray(chunk_size)
+        self.chunk_view = memoryview(self.chunk)
+        self.chunk_length = 0
+        self.status = None              # Status of the current response, set by response_header()
+        self.stream = False             # True once the connection is an event stream, see ServerController.start_stream()
+
+    # Prepares for the response to a new request
+    def start_response(self, protocol, keep_alive):
+        self.protocol = protocol
+        self.keep_alive = keep_alive
+        self.chunked = False
+        self.status = None
+        self.chunk_length = 0
+
+    def write(self, data):
+        if not self.chunked:
+            self.writer.write(data)
+            return
+
+        if type(data) is str:
+            data = data.encode()
+        view = memoryview(data)
+        position = 0
+        while position < len(view):
+            count = min(len(view) - position, len(self.chunk) - self.chunk_length)
+            self.chunk_view[self.chunk_length:self.chunk_length + count] = view[position:position + count]
+            self.chunk_length += count
+            position += count
+            if self.chunk_length == len(self.chunk):
+                self._write_chunk()
+
+    def _write_chunk(self):
+        if self.chunk_length:
+            self.writer.write('{:x}\r\n'.format(self.chunk_length))
+            self.writer.write(self.chunk_view[0:self.chunk_length])
+            self.writer.write('\r\n')
+            self.chunk_length = 0
+
+    async def drain(self):
+        if self.chunked:
+            self._write_chunk()
+        await asyncio.wait_for(self.writer.drain(), self.write_timeout)
+
+    # Completes the current response
+    async def finish(self):
+        if self.chunked:
+            self._write_chunk()
+            self.writer.write('0\r\n\r\n')
+            self.chunked = False
+        await asyncio.wait_for(self.writer.drain(), self.write_timeout)
+
+# Request headers that are read for every route
+REQUEST_HEADERS = ('Content-Length', 'Connection')
+
+# An endpoint of the server. parameters maps the name of each query parameter the
+# route accepts to a function that converts its value (e.g. int), or is None if
+# the route accepts any parameters (which are passed as strings). headers lists
+# the request headers the handler uses, other headers are skipped when the request
+# is read. The handler is called as handler(writer, parameters, headers, body).
+class Route:
+    def __init__(self, handler, parameters = None, headers = ()):
+        self.handler = handler
+        self.parameters = parameters
+        # Lower case header names (as bytes) mapped to the names passed to the handler
+        self.header_names = {}
+        for name in REQUEST_HEADERS + tuple(headers):
+            self.header_names[name.lower().encode()] = name
+        self.header_lengths = set(len(name) for name in self.header_names)
+        self.count = 0          # Requests served
+        self.errors = 0         # Requests that failed or returned an error status
+        self.total_ms = 0       # Total time spent serving requests
+        self.max_ms = 0         # Longest time spent serving a request
+
+    # Returns the request parameters converted to their declared types. Raises
+    # KeyError for a parameter the route doesn't accept and ValueError for a value
+    # that can't be converted.
+    def convert_parameters(self, parameters):
+        spec = self.parameters
+        if spec is None:
+            return parameters
+        converted = {}
+        for key, value in parameters.items():
+            converted[key] = spec[key](value)
+        return converted
+
+    def record(self, elapsed_ms, error):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+
+    @property
+    def stats_dictionary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_ms': self.total_ms,
+            'max_ms': self.max_ms,
+            'average_ms': self.total_ms / self.count if self.count else 0
+        }
+
 # Loosly based on https://gist.github.com/aallan/3d45a062f26bc425b22a17ec9c81e3b6
 class ServerController:
     def __init__(self, settings):
@@ -12,95 +301,389 @@ class ServerController:
         self.server = None
         self.wlan = None
         self.status_values = None
-        
-    def parse_request(self, request_line, log_request = False):
-        (request_type, request, protocol) = request_line.decode('ascii').split()
-
-        tokens = request.split('?')
-
-        if len(tokens) == 0:
-            endpoint = ''
-            parameter_strings = None
-        elif len(tokens) == 1:
-            endpoint = str(tokens[0])
-            parameter_strings = None
-        elif len(tokens) == 2:
-            endpoint = str(tokens[0])
-            parameter_strings = str(tokens[1])
-        
-        parameters = {}
-        if not parameter_strings == None and len(parameter_strings):
-            kv = parameter_strings.split('&')
-            for pair in kv:
-                (key, value) = pair.split('=')
-                
-                parameters[key] = value
-
-        if log_request:
-            print("Request: ", request_line)
-            #print("Request Type: '{}'".format(request_type))
-            #print("Endpoint: '{}'".format(endpoint))
-            #print("Parameters: '{}' found: {}".format(parameter_strings, len(parameters)))
-        
-        return (request_type, endpoint, parameters)
+        self.templates = {}
+        self.file_buffer = bytearray(1024)  # Shared by all requests, see send_file()
+        self.log_requests = False
+        self.running = False
+        self.connection_count = 0   # Connections currently being served, other than streams
+        self.stream_count = 0       # Event streams currently being served
+        self.connection_stats = {'accepted': 0, 'rejected': 0, 'rejected_streams': 0, 'timeouts': 0, 'errors': 0}
+        self.routes = {}            # (method, path) -> Route, see add_route()
+        # Metrics for GET requests that don't match a route, which are served as documents
+        self.document_route = Route(None, {}, ('If-None-Match', 'Accept-Encoding'))
+        self.add_route('GET', '/stats', self.serve_stats, {})
 
-    async def read_headers(self, reader):
-        # We are not interested in HTTP request headers, skip them
-        headers = {}
-        while True:
-            header_line = await reader.readline()
-            if header_line == b"\r\n":
-                break
-            
-            (key, value) = header_line.split(b': ')
-            headers[key.decode()] = value[:-2].decode()
-            
-        return headers
+    # Registers handler for requests to path with method. See Route for
+    # parameters and the signature of handler.
+    def add_route(self, method, path, handler, parameters = None, headers = ()):
+        self.routes[(method, path)] = Route(handler, parameters, headers)
         
-    def response_header(self, writer, status = 200, content_type = 'application/json'):
-        writer.write('HTTP/1.0 {} OK\r\nContent-type: {}\r\n\r\n'.format(status, content_type))
+    # Writes the status line and headers of a response. If the length of the body
+    # isn't known it is sent in chunks when the connection is kept alive (HTTP/1.1),
+    # otherwise the connection is closed to mark the end of the body.
+    def response_header(self, writer, status = 200, content_type = 'application/json', headers = None, content_length = None):
+        writer.status = status
+        writer.write('{} {} {}\r\n'.format(writer.protocol, status, STATUS_REASONS.get(status, 'OK')))
+        # A 304 response has no body, so it has no content type or length
+        if status != 304:
+            writer.write('Content-type: {}\r\n'.format(content_type))
+            if content_length is not None:
+                writer.write('Content-Length: {}\r\n'.format(content_length))
+            elif writer.keep_alive and writer.protocol == 'HTTP/1.1':
+                writer.write('Transfer-Encoding: chunked\r\n')
+            else:
+                writer.keep_alive = False
+        if headers:
+            for key, value in headers.items():
+                writer.write('{}: {}\r\n'.format(key, value))
+        if writer.keep_alive:
+            writer.write('Connection: keep-alive\r\nKeep-Alive: timeout={}\r\n\r\n'.format(self.settings.http_keep_alive_timeout))
+        else:
+            writer.write('Connection: close\r\n\r\n')
+        writer.chunked = status != 304 and content_length is None and writer.keep_alive
     
     def return_json(self, writer, obj, status = 200):
-        self.response_header(writer, status)
         # TODO I'd rather do this 'inline' without having to serialize to a string first, but
         #      ujson.dump() doesn't support uasyncio (which seems strange to me).
-        writer.write(ujson.dumps(obj))
+        data = ujson.dumps(obj).encode()
+        self.response_header(writer, status, content_length = len(data))
+        writer.write(data)
+
+    # Parses a document that uses format style substitutions ('{key}', with '{{'
+    # and '}}' for literal braces) into a list of chunks. Literal text (encoded
+    # as bytes) is at even indexes, and substitution keys are at odd indexes.
+    def compile_template(self, path):
+        f = open(self.settings.http_root + path)
+        text = f.read()
+        f.close()
+
+        chunks = []
+        literal = ''
+        position = 0
+        while position < len(text):
+            open_index = text.find('{', position)
+            close_index = text.find('}', position)
+            if open_index < 0 and close_index < 0:
+                literal += text[position:]
+                break
+            elif open_index < 0 or (close_index >= 0 and close_index < open_index):
+                # Outside of a substitution '}' must be escaped as '}}'
+                if text[close_index + 1:close_index + 2] != '}':
+                    raise ValueError("Single '}' in template " + path)
+                literal += text[position:close_index + 1]
+                position = close_index + 2
+            elif text[open_index + 1:open_index + 2] == '{':
+                literal += text[position:open_index + 1]
+                position = open_index + 2
+            else:
+                end_index = text.find('}', open_index)
+                if end_index < 0:
+                    raise ValueError("Unterminated '{' in template " + path)
+                chunks.append((literal + text[position:open_index]).encode())
+                chunks.append(text[open_index + 1:end_index])
+                literal = ''
+                position = end_index + 1
+        chunks.append(literal.encode())
+
+        return chunks
 
-    # Returns a file stored in the local file system
-    async def return_http_document(self, writer, path, substitutions = None, status = 200):
+    # Returns the compiled chunks of a template, compiling it on first use
+    def template(self, path):
+        chunks = self.templates.get(path)
+        if chunks is None:
+            chunks = self.compile_template(path)
+            self.templates[path] = chunks
+        return chunks
+
+    # Sends a static file. If the client accepts gzip and a pre-compressed copy of
+    # the file exists (path + '.gz', created with 'gzip -k9 <file>') that is sent
+    # instead. The etag is derived from the size and modification time of the file
+    # that is sent, so if it matches If-None-Match only the headers are sent.
+    # Returns False, without sending anything, if the file doesn't exist. Errors
+    # after the header has been sent (such as the client going away) are raised.
+    async def send_file(self, writer, path, content_type, request_headers):
+        file_path = self.settings.http_root + path
+        extra_headers = {'Vary': 'Accept-Encoding'}
+        stat = None
+        if 'gzip' in request_headers.get('Accept-Encoding', ''):
+            try:
+                stat = os.stat(file_path + '.gz')
+                file_path = file_path + '.gz'
+                extra_headers['Content-Encoding'] = 'gzip'
+            except OSError:
+                pass
+        try:
+            if stat is None:
+                stat = os.stat(file_path)
+            f = open(file_path, 'rb')
+        except OSError:
+            return False
+
+        size = stat[6]
+        etag = '"{:x}-{:x}{}"'.format(size, stat[8], '-gz' if file_path.endswith('.gz') else '')
+        extra_headers['ETag'] = etag
+        max_age = self.settings.http_cache_max_age
+        extra_headers['Cache-Control'] = 'max-age={}'.format(max_age) if max_age else 'no-cache'
+
+        try:
+            if request_headers.get('If-None-Match') == etag:
+                self.response_header(writer, 304, headers = extra_headers)
+                return True
+
+            self.response_header(writer, content_type = content_type, headers = extra_headers, content_length = size)
+
+            # Send the file in blocks through a buffer that is reused. The writer copies
+            # anything that it can't send immediately, so the buffer can be shared.
+            buffer = self.file_buffer
+            view = memoryview(buffer)
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                writer.write(view[0:count])
+                await writer.drain()
+        finally:
+            f.close()
+        return True
+
+    # Returns a file stored in the local file system. If substitutions is supplied
+    # it is a list of dictionaries. The document is treated as a template, and each
+    # key is replaced with its value from the first dictionary that contains it.
+    # Otherwise the file is sent as a static file (see send_file()), which uses the
+    # request headers to negotiate compression and caching.
+    async def return_http_document(self, writer, path, substitutions = None, status = 200, request_headers = None):
         await writer.drain()
 
+        if path.endswith('.html'):
+            content_type = 'text/html'
+        elif path.endswith('.js'):
+            content_type = 'script/javascript'
+        elif path.endswith('.json'):
+            content_type = 'application/json'
+        elif path.endswith('.css'):
+            content_type = 'text/css'
+        else:
+            content_type = 'text/plain'
+
+        if substitutions:
+            # Only a missing document is answered with a 404. Once the header has
+            # been sent an error (such as the client going away) closes the connection.
+            try:
+                chunks = self.template(path)
+            except OSError:
+                self.return_not_found(writer, path)
+                return
+
+            self.response_header(writer, content_type = content_type)
+            for i in range(len(chunks)):
+                if i & 1:
+                    key = chunks[i]
+                    for values in substitutions:
+                        if key in values:
+                            writer.write(str(values[key]))
+                            break
+                    else:
+                        raise KeyError(key)
+                else:
+                    writer.write(chunks[i])
+                    await writer.drain()
+        elif not await self.send_file(writer, path, content_type, request_headers or {}):
+            self.return_not_found(writer, path)
+
+    # Returns a 404 page for a document that doesn't exist
+    def return_not_found(self, writer, path):
+        data = '<html><head></head><body><h1>Error 404: Document {} not found.</h1></body></html>'.format(path).encode()
+        self.response_header(writer, status = 404, content_type = 'text/html', content_length = len(data))
+        writer.write(data)
+
+    # Reads the body of a request. A body is only read if the request has a
+    # Content-Length, so the next request on the connection can be found. Raises
+    # RequestError if the body is longer than http_max_body_length.
+    async def read_body(self, request_reader, headers):
+        try:
+            content_length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            raise RequestError(400, 'invalid content length')
+        if content_length <= 0:
+            return None
+        if content_length > self.settings.http_max_body_length:
+            raise RequestError(413, 'body too large')
+        return await request_reader.read_body(content_length)
+
+    # Reads the request line and headers of a request. Returns (route, method, path,
+    # parameters, protocol, headers).
+    async def read_request(self, request_reader):
+        try:
+            (method, path, parameters, protocol) = await request_reader.read_request_line()
+        except ValueError:
+            # Not valid utf-8
+            raise RequestError(400, 'malformed request')
+        # TODO Don't log every endpoint, only log serving pages (every endpoint gets chatty)
+        if self.log_requests:
+            print("Request: ", method, path, parameters)
+
+        route = self.find_route(method, path)
+        # Requests without a route still need the common headers to find the next request
+        headers = await request_reader.read_headers(route or self.document_route, self.settings.http_max_headers, self.settings.http_max_header_length)
+        return (route, method, path, parameters, protocol, headers)
+
+    # Returns the route for a request. GET requests that don't match a route are
+    # served from the documents in http_root, other requests return None.
+    def find_route(self, method, path):
+        route = self.routes.get((method, path))
+        if route is None and method == 'GET':
+            route = self.document_route
+        return route
+
+    # Handles a single request by calling the handler of its route (see
+    # find_route()), writing the response to writer (a ResponseWriter).
+    async def handle_request(self, writer, route, endpoint, parameters, headers, body):
+        if route is None:
+            self.return_json(writer, {'result':'unknown endpoint'}, 404)
+            return
+
+        start = time.ticks_ms()
+        error = True
         try:
-            if path.endswith('.html'):
-                content_type = 'text/html'
-            elif path.endswith('.js'):
-                content_type = 'script/javascript'
-            elif path.endswith('.json'):
-                content_type = 'application/json'
-            elif path.endswith('.css'):
-                content_type = 'text/css'
+            try:
+                parameters = route.convert_parameters(parameters)
+            except KeyError:
+                self.return_json(writer, {'result':'unexpected parameters'}, 400)
+                return
+            except ValueError:
+                self.return_json(writer, {'result':'invalid parameter'}, 400)
+                return
+
+            if route is self.document_route:
+                await self.return_http_document(writer, endpoint, request_headers = headers)
             else:
-                content_type = 'text/plain'
+                await route.handler(writer, parameters, headers, body)
+            error = writer.status is None or writer.status >= 400
+        finally:
+            route.record(time.ticks_diff(time.ticks_ms(), start), error)
 
-            self.response_header(writer, content_type = content_type)
+    # Returns the request metrics for each route
+    def stats_dictionary(self):
+        routes = {}
+        for (method, path), route in self.routes.items():
+            routes[method + ' ' + path] = route.stats_dictionary
+        routes['GET *'] = self.document_route.stats_dictionary
+        connections = {'active': self.connection_count, 'streams': self.stream_count}
+        connections.update(self.connection_stats)
+        return {'routes': routes, 'connections': connections}
 
-            f = open(self.settings.http_root + path)
-            # Transimit the document one line at a time to save memory
-            while True:
-                line = f.readline()
+    async def serve_stats(self, writer, parameters, headers, body):
+        self.return_json(writer, self.stats_dictionary())
+
+    # Serves the requests of a connection. HTTP/1.1 connections are kept open until
+    # the client closes them, the client is idle for http_keep_alive_timeout seconds
+    # or http_max_requests requests have been served. Requests are handled in the
+    # order they arrive, so a client can pipeline requests on the connection.
+    #
+    # To keep slow or stalled clients from tying up the heap, at most
+    # http_max_connections connections are served at once (others get an immediate
+    # 503) and each phase of a request has a timeout: http_header_timeout for the
+    # first request of a connection to arrive and to read the request line and
+    # headers once they start arriving, http_body_timeout to read the body and
+    # http_write_timeout for each write to be accepted. Event streams stay open,
+    # so they are limited separately (see start_stream()).
+    async def serve_client(self, reader, stream_writer):
+        settings = self.settings
+        writer = ResponseWriter(stream_writer, settings.http_write_timeout)
+        connection_stats = self.connection_stats
+        if self.connection_count >= settings.http_max_connections:
+            connection_stats['rejected'] += 1
+            await self.reject_client(writer, 503, 'server busy', {'Retry-After': 1})
+            await self.close_client(stream_writer)
+            return
 
-                if line == '':
+        self.connection_count += 1
+        connection_stats['accepted'] += 1
+        request_reader = RequestReader(reader)
+        request_count = 0
+        try:
+            while self.running:
+                # Only an open connection that has already been used waits for the
+                # keep-alive timeout
+                idle_timeout = settings.http_keep_alive_timeout if request_count else settings.http_header_timeout
+                try:
+                    if not await asyncio.wait_for(request_reader.wait_for_data(), idle_timeout):
+                        # The client has closed the connection
+                        break
+                except asyncio.TimeoutError:
+                    if not request_count:
+                        connection_stats['timeouts'] += 1
                     break
-                if substitutions:
-                    line = line.format(**substitutions)
-                    
-                writer.write(line)
-                await writer.drain()
-                
-            f.close()    
+
+                writer.start_response('HTTP/1.0', False)
+                try:
+                    (route, method, endpoint, parameters, protocol, headers) = await asyncio.wait_for(self.read_request(request_reader), settings.http_header_timeout)
+                    body = await asyncio.wait_for(self.read_body(request_reader, headers), settings.http_body_timeout)
+                except asyncio.TimeoutError:
+                    connection_stats['timeouts'] += 1
+                    await self.reject_client(writer, 408, 'request timeout')
+                    break
+                except RequestError as e:
+                    connection_stats['errors'] += 1
+                    await self.reject_client(writer, e.status, e.message)
+                    break
+                request_count += 1
+
+                connection = headers.get('Connection', '').lower()
+                if protocol == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+                writer.start_response(protocol, keep_alive and request_count < settings.http_max_requests)
+
+                await self.handle_request(writer, route, endpoint, parameters, headers, body)
+                await writer.finish()
+                if not writer.keep_alive:
+                    break
+        except asyncio.TimeoutError:
+            # The client stopped accepting data
+            connection_stats['timeouts'] += 1
+        except Exception as e:
+            print("Error handling request.")
+            sys.print_exception(e)
+        finally:
+            if writer.stream:
+                self.stream_count -= 1
+            else:
+                self.connection_count -= 1
+            await self.close_client(stream_writer)
+
+    # Called by a handler that is about to turn its connection into a long lived
+    # stream. The connection is moved from the http_max_connections limit to the
+    # http_max_streams limit, so open streams don't keep pages from loading.
+    # Returns False if there are already http_max_streams streams, in which case
+    # the handler should reject the request.
+    def start_stream(self, writer):
+        if self.stream_count >= self.settings.http_max_streams:
+            self.connection_stats['rejected_streams'] += 1
+            return False
+        self.connection_count -= 1
+        self.stream_count += 1
+        writer.stream = True
+        return True
+
+    # Sends an error response and closes the connection
+    async def reject_client(self, writer, status, message, headers = None):
+        try:
+            data = ujson.dumps({'result': message}).encode()
+            self.response_header(writer, status, headers = headers, content_length = len(data))
+            writer.write(data)
+            await writer.finish()
+        except Exception:
+            # The connection is closed regardless
+            pass
+
+    async def close_client(self, stream_writer):
+        try:
+            stream_writer.close()
+            await stream_writer.wait_closed()
         except OSError:
-            self.response_header(writer, status = 404, content_type = 'text/html')
-            writer.write('<html><head></head><body><h1>Error 404: Document {} not found.</h1></body></html>'.format(path))
+            pass
 
     def status_map(self, status):
         if not self.status_values:
@@ -191,6 +774,47 @@ class ServerController:
             self.server.close()
             self.server = None
 
+# Returns the index of the first byte in buffer[start:end] equal to value, or -1
+def find_byte(buffer, value, start, end):
+    while start < end:
+        if buffer[start] == value:
+            return start
+        start += 1
+    return -1
+
+def _hex_digit(value):
+    if 48 <= value <= 57:       # '0' - '9'
+        return value - 48
+    value |= 32                 # lower case
+    if 97 <= value <= 102:      # 'a' - 'f'
+        return value - 87
+    raise RequestError(400, 'invalid escape')
+
+# Decodes the url encoded text in buffer[start:end]. '+' is decoded as a space if
+# plus_is_space is set (as it is in query strings).
+def url_decode(buffer, start, end, plus_is_space):
+    i = start
+    while i < end:
+        value = buffer[i]
+        if value == 37 or (value == 43 and plus_is_space):      # '%' or '+'
+            break
+        i += 1
+    else:
+        return str(memoryview(buffer)[start:end], 'utf-8')
+
+    decoded = bytearray(buffer[start:i])
+    while i < end:
+        value = buffer[i]
+        if value == 37:
+            if i + 3 > end:
+                raise RequestError(400, 'invalid escape')
+            decoded.append(_hex_digit(buffer[i + 1]) * 16 + _hex_digit(buffer[i + 2]))
+            i += 3
+        else:
+            decoded.append(32 if value == 43 and plus_is_space else value)
+            i += 1
+    return str(decoded, 'utf-8')
+
 # A utility that takes a nested dictinary and returns a copy with
 # all nested keys stored as key paths on the root
 def flatten_dict(input_dict, output_dict = None, prefix = None):
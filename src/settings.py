@@ -1,6 +1,19 @@
 import ujson
+import hashlib
+import os
 from condlock import CondLock
 
+# An immutable copy of the values of a Settings object. The values are plain
+# attributes, and the snapshot is replaced rather than modified when the settings
+# are updated, so it can be read without locking. Settings values are snapshots
+# of their own. Subclasses can precompute values that are derived from the
+# settings (see ValueScaleSnapshot).
+class SettingsSnapshot:
+    def __init__(self, values, version):
+        for (key, value) in values.items():
+            setattr(self, key, value)
+        self.version = version
+
 # Settings manages persistent settings, and attempts to minimize the amount
 # of data that must be written. When settings are persisted they are written
 # to a JSON file that contains only the settings that are different than the
@@ -15,18 +28,24 @@ from condlock import CondLock
 # specify the type of the object.
 #
 # Settings can be run in thread_safe mode. In thread_safe mode it will aquire lock
-# before updating or returning settings, so settings can accessed from mulitple
-# threads without contention. Note that if multiple values are read, it is still the
-# callers responsability to ensure that proper locking is used to ensure that they are
-# consistent. It is possible for a caller to aquire settings.lock to ensure that
-# settings are not mutated between queries.
+# before updating settings, so settings can be updated from mulitple threads without
+# contention. Reading settings never needs the lock: every update builds a new
+# SettingsSnapshot and swaps it in, so the values of self are read from a snapshot
+# that is never modified. A caller that reads several values that must be consistent
+# should keep a snapshot (settings.snapshot) and read them from it.
 class Settings:
+    snapshot_class = SettingsSnapshot   # The class of the snapshots of the values
+
     def __init__(self, defaults, persist_path = 'settings.json', thread_safe = False):
+        self.snapshot = None    # The current SettingsSnapshot, replaced by every update
         self.defaults = defaults
         self.values = {}
         self.private_keys = ()
         self.persist_path = persist_path
         self.lock = CondLock(thread_safe)
+        self.version = 0    # Incremented by every update, so that derived values can be cached
+        self.persister = None       # Writes the settings in the background if set (see SettingsPersister)
+        self.persisted_hash = None  # The sha256 of the settings file as it was last read or written
         
         # Create the ValueScale settings
         self.setup_properties(defaults)
@@ -35,13 +54,15 @@ class Settings:
         # even if there are no saved settings
         self._read()
         
+    # Values are read from the current snapshot, which doesn't need the lock
     def __getattr__(self, name):
-        with self.lock:
-            return self.values[name]
+        return getattr(self.snapshot, name)
     
     def __getitem__(self, name):
-        with self.lock:
-            return self.values[name]
+        try:
+            return getattr(self.snapshot, name)
+        except AttributeError:
+            raise KeyError(name)
 
     @property
     def values_dictionary(self):
@@ -84,44 +105,95 @@ class Settings:
 
     # Writes the values of self to permanent storage. Only values that are
     # different from the defaults are written. Writing should be minimized
-    # to preserve the flash RAM, so only perform a single write when all
-    # updates in a batch are complete.
+    # to preserve the flash RAM, so if there is a persister the write is left
+    # to it, and a batch of updates is written once. Otherwise it is written now.
     def write_delta(self):
         if self.persist_path != None:
-            delta = ujson.dumps(self.delta)
-            f = open(self.persist_path, 'w')
+            if self.persister is not None:
+                self.persister.request()
+            else:
+                self.persist()
+
+    # Writes the values that are different from the defaults, unless the file already
+    # has them, and returns whether it was written. The file is written under a
+    # temporary name and then renamed over the old one, so a crash can't leave a
+    # partly written file.
+    def persist(self):
+        if self.persist_path == None:
+            return False
+
+        delta = ujson.dumps(self.delta).encode()
+        digest = hashlib.sha256(delta).digest()
+        if digest == self.persisted_hash:
+            return False
+
+        temp_path = self.persist_path + '.tmp'
+        with open(temp_path, 'wb') as f:
             f.write(delta)
-            f.close()
+        try:
+            os.rename(temp_path, self.persist_path)
+        except OSError:
+            # Some file systems can't rename over an existing file
+            os.remove(self.persist_path)
+            os.rename(temp_path, self.persist_path)
+        self.persisted_hash = digest
+        return True
             
     # Updates the values of self using a dictionary
     def update(self, values):
         with self.lock:
+            self.version += 1
             defaults = self.defaults
             current_values = self.values
 
-            for key, new_value in values.items():
-                if key in defaults:
-                    if key in self.values:
-                        # Find the current value of the object
-                        current_value = current_values[key]
-                        default_value = defaults[key]
+            # A value that can't be converted raises ValueError, but the values that
+            # were already updated are kept, so the snapshot must still be taken. If the
+            # values can't make a snapshot (see ValueScaleSnapshot) the update is undone.
+            previous_values = dict(current_values)
+            try:
+                for key, new_value in values.items():
+                    if key in defaults:
+                        if key in self.values:
+                            # Find the current value of the object
+                            current_value = current_values[key]
+                            default_value = defaults[key]
                         
-                        # If the existing value is another settings object, recurse into it
-                        if isinstance(current_value, Settings):
-                            current_value.update(new_value)
-                        # Otherwise assign the new value, matching the type of the default value
-                        elif isinstance(current_value, float):
-                            self.values[key] = float(new_value)
-                        elif isinstance(current_value, int):
-                            self.values[key] = int(new_value)
-                        elif isinstance(current_value, str):
-                            self.values[key] = str(new_value)
-                        elif isinstance(current_value, bool):
-                            self.values[key] = bool(new_value in ['true', 'True'])
+                            # If the existing value is another settings object, recurse into it
+                            if isinstance(current_value, Settings):
+                                current_value.update(new_value)
+                            # Otherwise assign the new value, matching the type of the default value
+                            elif isinstance(current_value, float):
+                                self.values[key] = float(new_value)
+                            elif isinstance(current_value, int):
+                                self.values[key] = int(new_value)
+                            elif isinstance(current_value, str):
+                                self.values[key] = str(new_value)
+                            elif isinstance(current_value, bool):
+                                self.values[key] = bool(new_value in ['true', 'True'])
+                            elif isinstance(current_value, list):
+                                # Lists are sent as json by forms and query parameters
+                                if isinstance(new_value, str):
+                                    new_value = ujson.loads(new_value) if new_value.strip() else []
+                                if not isinstance(new_value, (list, tuple)):
+                                    raise ValueError('{} must be a list'.format(key))
+                                self.values[key] = list(new_value)
+                            else:
+                                self.values[key] = new_value
                         else:
                             self.values[key] = new_value
-                    else:
-                        self.values[key] = new_value
+
+            finally:
+                try:
+                    self._take_snapshot()
+                except ValueError:
+                    self.values = previous_values
+                    self._take_snapshot()
+                    raise
+
+    # Replaces the snapshot with one of the current values. Must be called with the lock held.
+    def _take_snapshot(self):
+        values = {k: (v.snapshot if isinstance(v, Settings) else v) for (k, v) in self.values.items()}
+        self.snapshot = self.snapshot_class(values, self.version)
                         
     # Updates the values of self from the defaults, and then tries to open a settings
     # difference file. If one is found its settings are applied on top of the defaults.
@@ -130,46 +202,88 @@ class Settings:
         self.update(self.defaults)
 
         if self.persist_path != None:
-            try:
-                f = open(self.persist_path)
-                delta = f.read()
-                f.close()
-                # Read any values that have been persisted and apply them on top of the defaults
-                values = ujson.loads(delta)
-                self.update(values)
-            except OSError:
-                print("Could not find settings file at " + self.persist_path)
+            # If there was a crash while the file was being replaced it may only
+            # be left under its temporary name (see persist())
+            for path in (self.persist_path, self.persist_path + '.tmp'):
+                try:
+                    f = open(path, 'rb')
+                    delta = f.read()
+                    f.close()
+                    # Read any values that have been persisted and apply them on top of the defaults
+                    values = ujson.loads(delta)
+                    self.update(values)
+                    self.persisted_hash = hashlib.sha256(delta).digest() if path == self.persist_path else None
+                    return
+                except (OSError, ValueError):
+                    pass
+            print("Could not find settings file at " + self.persist_path)
         
+# The snapshot of a ValueScale. The calibration curve is compiled into segments
+# when the settings are updated, so mapping a value only has to find its segment.
+#
+# The curve is made of the calibration points ([sensor, value] pairs measured
+# against a reference gauge) sorted by sensor value, or of the limits if there are
+# fewer than two points. Sensor values between or beyond the points are
+# interpolated or extrapolated from the nearest segment, but values outside
+# sensor_min ... sensor_max are still errors. Without a curve sensor_min and
+# sensor_max must be different, otherwise ValueError is raised.
+class ValueScaleSnapshot(SettingsSnapshot):
+    def __init__(self, values, version):
+        super().__init__(values, version)
+        self.sensor_range = self.sensor_max - self.sensor_min
+        self.value_range = self.value_max - self.value_min
+
+        points = self._curve_points()
+        self.breakpoints = []   # The sensor values that start the second and later segments
+        self.slopes = []        # The slope and offset of each segment
+        self.offsets = []
+        for i in range(len(points) - 1):
+            (sensor_start, value_start) = points[i]
+            (sensor_end, value_end) = points[i + 1]
+            slope = (value_end - value_start)/(sensor_end - sensor_start)
+            if i > 0:
+                self.breakpoints.append(sensor_start)
+            self.slopes.append(slope)
+            self.offsets.append(value_start - slope*sensor_start)
+
+    # Returns the points of the curve, sorted by sensor value. Of points with the
+    # same sensor value only the first is used, and anything that isn't a pair of
+    # numbers is ignored.
+    def _curve_points(self):
+        calibration = [point for point in self.calibration if isinstance(point, (list, tuple)) and len(point) == 2 and
+                       all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in point)]
+        points = []
+        for (sensor, value) in sorted(calibration, key = lambda point: point[0]):
+            if not points or sensor != points[-1][0]:
+                points.append((sensor, value))
+        if len(points) < 2:
+            if self.sensor_min == self.sensor_max:
+                raise ValueError('sensor_min and sensor_max must be different')
+            points = [(self.sensor_min, self.value_min), (self.sensor_max, self.value_max)]
+        return points
+
+    def map(self, raw_value):
+        if raw_value < self.sensor_min or raw_value > self.sensor_max:
+            return None
+
+        # Find the segment, which starts at the last breakpoint <= raw_value
+        breakpoints = self.breakpoints
+        low = 0
+        high = len(breakpoints)
+        while low < high:
+            middle = (low + high) // 2
+            if breakpoints[middle] <= raw_value:
+                low = middle + 1
+            else:
+                high = middle
+        return raw_value*self.slopes[low] + self.offsets[low]
+
 class ValueScale(Settings):
+    snapshot_class = ValueScaleSnapshot
+
     def __init__(self, defaults):
         super().__init__(defaults, None)
         
+    # The snapshot has consistent values, so no lock is needed
     def map(self, raw_value):
-        # Accessing the individual values are protected by the lock, but
-        # to ensure that they are all consistent wrap the entire operation
-        # in a lock to ensure an update doesn't change some of them
-        # concurrently
-        with self.lock:
-            sensor_min = self.sensor_min
-            sensor_max = self.sensor_max
-            value_min = self.value_min
-            sensor_range = self.sensor_range
-            value_range = self.value_range
-            
-            if raw_value < sensor_min or raw_value > sensor_max:
-                return None
-                
-            scaled = (raw_value - sensor_min)/sensor_range
-            return scaled*value_range + value_min
-                    
-    # Updates the values of self using a dictionary, and returns the values that are
-    # not the same as the defaults
-    def update(self, values):
-        # Aquire a lock to ensure that the values are updated atomically
-        # with performing the update
-        with self.lock:
-            super().update(values)
-
-            # Calculate the ranges from the limits
-            self.sensor_range = self.sensor_max - self.sensor_min
-            self.value_range = self.value_max - self.value_min
+        return self.snapshot.map(raw_value)
@@ -0,0 +1,77 @@
+import time
+import uasyncio as asyncio
+
+# SettingsPersister writes changes to the settings to flash in the background, so
+# that requests that change settings don't wait for the flash to be erased.
+#
+# Settings.write_delta() only asks for a write. The write happens once there have
+# been no more requests for delay milliseconds, so a burst of changes (such as
+# holding a button on the menu) is written once. The write is skipped if the
+# settings are the same as the ones on flash (see Settings.persist()). Any write
+# that is still waiting is done when the persister is stopped.
+class SettingsPersister:
+    def __init__(self, settings, delay):
+        self.settings = settings
+        self.delay = delay
+        self.requested_ticks = None     # ticks_ms() of the latest request that hasn't been written, or None
+        self.event = asyncio.Event()    # Set when a write is requested
+        self.run_task = None
+        settings.persister = self
+
+        self.requests = 0
+        self.writes = 0
+        self.unchanged = 0              # Writes that were skipped because nothing had changed
+        self.last_flush_ms = 0
+        self.max_flush_ms = 0
+
+    # Asks for the settings to be written after the delay
+    def request(self):
+        self.requests += 1
+        self.requested_ticks = time.ticks_ms()
+        self.event.set()
+
+    async def _run(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            # Every request moves the write back, until there is a quiet period
+            while self.requested_ticks is not None:
+                remaining = self.delay - time.ticks_diff(time.ticks_ms(), self.requested_ticks)
+                if remaining > 0:
+                    await asyncio.sleep_ms(remaining)
+                else:
+                    self.flush()
+
+    # Writes the settings now if a write has been requested
+    def flush(self):
+        if self.requested_ticks is None:
+            return
+        self.requested_ticks = None
+
+        start = time.ticks_ms()
+        if self.settings.persist():
+            self.writes += 1
+        else:
+            self.unchanged += 1
+        self.last_flush_ms = time.ticks_diff(time.ticks_ms(), start)
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+
+    def run(self):
+        self.run_task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.run_task is not None:
+            self.run_task.cancel()
+            self.run_task = None
+        self.flush()
+
+    @property
+    def stats_dictionary(self):
+        return {
+            'requests': self.requests,
+            'writes': self.writes,
+            'unchanged': self.unchanged,
+            'pending': self.requested_ticks is not None,
+            'last_flush_ms': self.last_flush_ms,
+            'max_flush_ms': self.max_flush_ms
+        }
@@ -0,0 +1,31 @@
+# The tests run the controller's modules with CPython on the host runtime (see
+# src/host/runtime.py), on a VirtualClock so that they control the time:
+#
+#    python3 -m pytest tests
+import os
+import sys
+
+import pytest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+from host import runtime
+from host.clock import VirtualClock
+
+EPOCH = 1700000000      # The time.time() of the start of every test
+
+runtime.install(host_clock = VirtualClock(EPOCH))
+
+# The clock, started again at EPOCH. Move it with clock.sleep(seconds).
+@pytest.fixture
+def clock():
+    runtime.clock.now = 0
+    runtime.clock.epoch = EPOCH
+    return runtime.clock
+
+# Runs a coroutine on the host event loop and returns its result
+@pytest.fixture
+def run():
+    return runtime.loop.run_until_complete
@@ -0,0 +1,118 @@
+import pytest
+
+from settings import ValueScale
+from sensor_sampler import SensorSampler
+
+def value_scale(calibration = ()):
+    return ValueScale({"value_min": 0, "value_max": 150, "sensor_min": 6554, "sensor_max": 58981, "calibration": list(calibration)})
+
+def test_linear_without_calibration():
+    scale = value_scale()
+    assert scale.map(6554) == pytest.approx(0)
+    assert scale.map(58981) == pytest.approx(150)
+    assert scale.map((6554 + 58981)/2) == pytest.approx(75)
+    assert scale.map(6553) is None
+    assert scale.map(58982) is None
+
+# A single point isn't a curve, so the limits are used
+def test_one_point_is_ignored():
+    assert value_scale([[30000, 100]]).map(30000) == value_scale().map(30000)
+
+def test_interpolates_between_points():
+    scale = value_scale([[40000, 120], [10000, 10], [20000, 40]])
+    assert scale.map(10000) == pytest.approx(10)
+    assert scale.map(15000) == pytest.approx(25)
+    assert scale.map(20000) == pytest.approx(40)
+    assert scale.map(30000) == pytest.approx(80)
+    assert scale.map(40000) == pytest.approx(120)
+
+# Outside the points the nearest segment is extrapolated, up to the sensor limits
+def test_extrapolates_from_end_segments():
+    scale = value_scale([[10000, 10], [20000, 40], [40000, 120]])
+    assert scale.map(8000) == pytest.approx(4)
+    assert scale.map(50000) == pytest.approx(160)
+    assert scale.map(6000) is None
+    assert scale.map(60000) is None
+
+# Of points with the same sensor value the first is used, and points that aren't a
+# pair of numbers are ignored
+def test_invalid_points_are_ignored():
+    scale = value_scale([[10000, 10], [10000, 99], [20000, 40], [30000], "x", [True, 5], [25000, None]])
+    assert scale.map(15000) == pytest.approx(25)
+    assert scale.map(30000) == pytest.approx(70)
+    assert scale.map(10000) == pytest.approx(10)
+
+def test_matches_linear_search():
+    points = [[7000, 1], [12000, 18], [19000, 35], [26000, 61], [41000, 97], [55000, 142]]
+    scale = value_scale(points)
+    for raw_value in range(6554, 58982, 97):
+        segment = 0
+        while segment + 2 < len(points) and points[segment + 1][0] <= raw_value:
+            segment += 1
+        ((sensor_start, value_start), (sensor_end, value_end)) = points[segment:segment + 2]
+        expected = value_start + (raw_value - sensor_start)*(value_end - value_start)/(sensor_end - sensor_start)
+        assert scale.map(raw_value) == pytest.approx(expected)
+
+def test_update_recompiles_curve():
+    scale = value_scale()
+    scale.update({"calibration": [[10000, 0], [50000, 200]]})
+    assert scale.map(30000) == pytest.approx(100)
+    scale.update({"calibration": "[]"})
+    assert scale.map(30000) == value_scale().map(30000)
+
+# A value that isn't a list is rejected, and the values that were already updated
+# are still in the snapshot
+def test_update_rejects_invalid_calibration():
+    scale = value_scale([[10000, 0], [50000, 200]])
+    with pytest.raises(ValueError):
+        scale.update({"value_max": 100, "calibration": 5})
+    assert scale.value_max == 100
+    assert scale.map(30000) == pytest.approx(100)
+
+# Without a curve the limits must be a range. An update that would leave them
+# equal is rejected, and the previous values stay in use.
+def test_update_rejects_empty_range():
+    scale = value_scale()
+    version = scale.snapshot.version
+    with pytest.raises(ValueError):
+        scale.update({"value_max": 100, "sensor_max": 6554})
+    assert (scale.sensor_max, scale.value_max) == (58981, 150)
+    assert scale.values["sensor_max"] == 58981
+    assert scale.map(58981) == pytest.approx(150)
+    assert scale.snapshot.version > version
+
+    # A curve doesn't need the range, but clearing the curve does
+    scale = value_scale([[10000, 0], [50000, 200]])
+    scale.update({"sensor_min": 30000, "sensor_max": 30000})
+    assert scale.map(30000) == pytest.approx(100)
+    with pytest.raises(ValueError):
+        scale.update({"calibration": []})
+    assert scale.map(30000) == pytest.approx(100)
+
+class ADC:
+    def __init__(self, values):
+        self.values = values
+        self.position = 0
+
+    def read_u16(self):
+        value = self.values[self.position % len(self.values)]
+        self.position += 1
+        return value
+
+class SamplerSettings:
+    def __init__(self, **values):
+        self.snapshot = type('Snapshot', (), values)
+
+# Calibration reads the unfiltered average of the samples, without moving the
+# filter or the statistics of the readings
+def test_read_raw_is_unfiltered():
+    settings = SamplerSettings(adc_samples = 4, adc_filter = 'ema', adc_ema_alpha = 0.1)
+    sampler = SensorSampler(ADC([1000, 3000]), settings, 8)
+    assert sampler.read() == 2000
+    sampler.adc = ADC([10000, 10002])
+    assert sampler.read() == pytest.approx(2800.1)
+    (average, count) = (sampler.average, sampler.count)
+
+    assert sampler.read_raw() == 10001
+    assert sampler.read_raw(3) == pytest.approx(10000 + 2/3)
+    assert (sampler.average, sampler.count) == (average, count)
@@ -0,0 +1,150 @@
+import random
+import struct
+
+import pytest
+
+from compressorlogs import StateLog, CompactStateLog, RollupLog, CompactRollupLog, COMPACT_UNKNOWN_STATE
+from linear_least_squares import linear_least_squares
+
+STATES = [b'Op_', b'OpU', b'___', b'O__', b'_pU']
+
+# Collects what a dump writes
+class Writer:
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+    async def drain(self):
+        pass
+
+    @property
+    def text(self):
+        return ''.join(self.data)
+
+    @property
+    def bytes(self):
+        return b''.join(data.encode() if isinstance(data, str) else bytes(data) for data in self.data)
+
+def make_logs(size_limit):
+    return (StateLog(0, False, size_limit = size_limit),
+            StateLog(0, False, size_limit = size_limit, columnar = True),
+            CompactStateLog(0, False, size_limit = size_limit))
+
+# Times that mostly advance by a few seconds, with gaps that don't fit in the
+# 16 bit time of a compact log. Times only go backwards if backwards is set.
+def state_logs(rng, count, backwards = False):
+    log_time = 1700000000
+    for i in range(count):
+        step = rng.random()
+        if step < 0.05:
+            log_time += rng.randint(70000, 200000)
+        elif backwards and step < 0.1:
+            log_time -= rng.randint(1, 100000)
+        else:
+            log_time += rng.randint(0, 30)
+        yield (log_time, rng.uniform(0, 150), rng.uniform(0, 150), rng.random(), rng.choice(STATES))
+
+def assert_close(log_tuple, expected):
+    assert log_tuple[0] == expected[0]
+    assert log_tuple[1] == pytest.approx(expected[1], abs = 0.0051)
+    assert log_tuple[2] == pytest.approx(expected[2], abs = 0.0051)
+    assert log_tuple[3] == pytest.approx(expected[3], abs = 0.0021)
+    assert log_tuple[4] == expected[4]
+
+@pytest.mark.parametrize('size_limit, count, backwards', [(40, 30, False), (40, 500, False), (37, 500, True)])
+def test_logs_match_state_log(size_limit, count, backwards):
+    (packed, columnar, compact) = make_logs(size_limit)
+    for log_tuple in state_logs(random.Random(count + size_limit), count, backwards):
+        for log in (packed, columnar, compact):
+            log.log(log_tuple)
+
+        assert columnar[0] == packed[0]
+        assert_close(compact[0], packed[0])
+
+    assert len(compact) == len(columnar) == len(packed) == min(size_limit, count)
+    for i in range(len(packed)):
+        assert columnar[i] == packed[i]
+        assert_close(compact[i], packed[i])
+        for field_index in range(5):
+            assert columnar.field(i, field_index) == packed[i][field_index]
+            assert compact.field(i, field_index) == compact[i][field_index]
+
+def test_queries_match_state_log(run):
+    (packed, columnar, compact) = make_logs(100)
+    logs = list(state_logs(random.Random(6), 250))
+    for log_tuple in logs:
+        for log in (packed, columnar, compact):
+            log.log(log_tuple)
+
+    times = [log_tuple[0] for log_tuple in logs[-100:]]
+    for (since, until) in [(None, None), (times[10], None), (None, times[80]), (times[20], times[60]), (times[-1] + 1, None), (0, times[0] - 1)]:
+        expected = packed.index_range(since, until)
+        assert columnar.index_range(since, until) == expected
+        assert compact.index_range(since, until) == expected
+        if expected[1] > 1:
+            assert columnar.linear_least_squares(1, since, until) == packed.linear_least_squares(1, since, until)
+            (index, count) = expected
+            data = [[compact[i][0], compact[i][1]] for i in range(index, index + count)]
+            assert compact.linear_least_squares(1, since, until) == pytest.approx(linear_least_squares(data) + (count,))
+
+    for since in (0, times[50]):
+        dumps = []
+        for log in (packed, columnar):
+            writer = Writer()
+            run(log.dump(writer, since))
+            dumps.append(writer.text)
+        assert dumps[0] == dumps[1]
+
+        writer = Writer()
+        run(packed.dump_binary(writer, since))
+        binary = writer.bytes
+        writer = Writer()
+        run(columnar.dump_binary(writer, since))
+        assert writer.bytes == binary
+
+# A compact log is copied (to flash and to binary dumps) in the StateLog format
+def test_compact_copy():
+    compact = CompactStateLog(0, False, size_limit = 20)
+    for log_tuple in state_logs(random.Random(7), 30):
+        compact.log(log_tuple)
+
+    buffer = bytearray(compact.stride*10)
+    compact._copy_logs(buffer, 5, 10)
+    for i in range(10):
+        record = struct.unpack_from(compact.struct_format, buffer, i*compact.stride)
+        assert record == pytest.approx(compact[14 - i], abs = 1e-5)
+
+# States that don't fit in the table of states are logged as COMPACT_UNKNOWN_STATE
+def test_state_table_overflow(capsys):
+    compact = CompactStateLog(0, False, size_limit = 300)
+    for i in range(300):
+        compact.log((1000 + i, 1.0, 2.0, 0.5, '{:03}'.format(i).encode()))
+
+    assert compact[299][4] == b'000'
+    assert compact[45][4] == b'254'
+    for i in range(45):
+        assert compact[i][4] == COMPACT_UNKNOWN_STATE
+    assert compact.states.unknown_count == 45
+    assert capsys.readouterr().out.count('ERROR') == 1
+
+def test_compact_rollup_log():
+    rng = random.Random(8)
+    rollup = RollupLog(60, 30)
+    compact = CompactRollupLog(60, 30)
+    for i in range(2000):
+        sample_time = 1700000000 + i*7
+        tank_pressure = rng.uniform(0, 150)
+        sample = (sample_time, tank_pressure, tank_pressure, tank_pressure, rng.uniform(0, 150), rng.random(), rng.choice(STATES))
+        rollup.add(*sample)
+        compact.add(*sample)
+
+    assert compact.storage_size < rollup.storage_size
+    assert len(compact) == len(rollup) == 30
+    for i in range(30):
+        expected = rollup[i]
+        log_tuple = compact[i]
+        assert (log_tuple[0], log_tuple[6]) == (expected[0], expected[6])
+        assert log_tuple[1:5] == pytest.approx(expected[1:5], abs = 0.0051)
+        assert log_tuple[5] == pytest.approx(expected[5], abs = 0.0021)
@@ -0,0 +1,65 @@
+import asyncio
+
+from server import ServerController
+
+class Settings:
+    def __init__(self):
+        self.http_keep_alive_timeout = 30
+        self.http_max_requests = 100
+        self.http_max_connections = 8
+        self.http_header_timeout = 2
+        self.http_body_timeout = 5
+        self.http_write_timeout = 10
+        self.http_max_headers = 32
+        self.http_max_header_length = 512
+
+# A client that sends data and then stays connected without sending more
+class Client:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+        self.written = []
+        self.closed = False
+
+    async def readinto(self, buffer):
+        if self.position == len(self.data):
+            await asyncio.sleep(3600)
+        count = min(len(buffer), len(self.data) - self.position)
+        buffer[0:count] = self.data[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def write(self, data):
+        self.written.append(data.encode() if isinstance(data, str) else bytes(data))
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+def serve(run, data):
+    server = ServerController(Settings())
+    server.running = True
+    client = Client(data)
+    run(server.serve_client(client, client))
+    assert client.closed
+    return (server, client)
+
+# A connection that never sends a request is only kept for the header timeout
+def test_first_request_timeout(run, clock):
+    (server, client) = serve(run, b'')
+    assert clock.monotonic() == 2
+    assert client.written == []
+    assert server.connection_stats['timeouts'] == 1
+    assert server.connection_count == 0
+
+# Once a request has been served the connection waits for the keep-alive timeout
+def test_keep_alive_timeout(run, clock):
+    (server, client) = serve(run, b'POST /unknown HTTP/1.1\r\n\r\n')
+    assert clock.monotonic() == 30
+    assert b''.join(client.written).startswith(b'HTTP/1.1 404 Not Found\r\n')
+    assert server.connection_stats['timeouts'] == 0
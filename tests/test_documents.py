@@ -0,0 +1,105 @@
+import pytest
+
+from server import ServerController, ResponseWriter
+
+class Settings:
+    def __init__(self, http_root):
+        self.http_root = http_root
+        self.http_keep_alive_timeout = 5
+        self.http_cache_max_age = 0
+
+# Stands in for the stream of a connection. The client goes away (drain() raises
+# OSError) after fail_after drains, if fail_after is set.
+class Stream:
+    def __init__(self, fail_after = None):
+        self.data = []
+        self.drains = 0
+        self.fail_after = fail_after
+
+    def write(self, data):
+        self.data.append(data.encode() if isinstance(data, str) else bytes(data))
+
+    async def drain(self):
+        self.drains += 1
+        if self.fail_after is not None and self.drains > self.fail_after:
+            raise OSError(104)
+
+    @property
+    def text(self):
+        return b''.join(self.data).decode()
+
+def make_server(tmp_path, files):
+    for (name, data) in files.items():
+        (tmp_path/name).write_bytes(data)
+    return ServerController(Settings(str(tmp_path) + '/'))
+
+# Responses to HTTP/1.0 requests aren't chunked, so the body is as it was written
+def make_writer(stream):
+    writer = ResponseWriter(stream, 5)
+    writer.start_response('HTTP/1.0', False)
+    return writer
+
+def test_template(run, tmp_path):
+    server = make_server(tmp_path, {'page.html': b'<p>{a}</p>{{x}}<p>{b}</p>'})
+    stream = Stream()
+    writer = make_writer(stream)
+    run(server.return_http_document(writer, 'page.html', [{'a': 1}, {'a': 2, 'b': 'two'}]))
+    run(writer.finish())
+    assert stream.text.startswith('HTTP/1.0 200 OK\r\n')
+    assert '<p>1</p>{x}<p>two</p>' in stream.text
+
+def test_missing_template_is_not_found(run, tmp_path):
+    server = make_server(tmp_path, {})
+    stream = Stream()
+    run(server.return_http_document(make_writer(stream), 'missing.html', [{}]))
+    assert stream.text.startswith('HTTP/1.0 404 Not Found\r\n')
+
+# Once the header has been sent an error isn't answered with a second response
+def test_template_client_gone(run, tmp_path):
+    server = make_server(tmp_path, {'page.html': b'{a}'.join([b'x'*600]*4)})
+    stream = Stream(fail_after = 2)
+    with pytest.raises(OSError):
+        run(server.return_http_document(make_writer(stream), 'page.html', [{'a': 1}]))
+    assert stream.text.count('HTTP/1.0') == 1
+    assert '404' not in stream.text
+
+def test_file(run, tmp_path):
+    data = bytes(range(256))*10
+    server = make_server(tmp_path, {'data.js': data, 'data.js.gz': b'compressed'})
+    stream = Stream()
+    run(server.return_http_document(make_writer(stream), 'data.js'))
+    response = b''.join(stream.data)
+    assert response.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert response.endswith(b'\r\n\r\n' + data)
+    assert b'Content-Length: 2560\r\n' in response
+
+    stream = Stream()
+    run(server.return_http_document(make_writer(stream), 'data.js', request_headers = {'Accept-Encoding': 'gzip, deflate'}))
+    assert 'Content-Encoding: gzip\r\n' in stream.text
+    assert stream.text.endswith('\r\n\r\ncompressed')
+
+# The etag of the file is answered with a 304 and no body
+def test_file_not_modified(run, tmp_path):
+    server = make_server(tmp_path, {'style.css': b'p {}'})
+    stream = Stream()
+    run(server.return_http_document(make_writer(stream), 'style.css'))
+    etag = [line for line in stream.text.split('\r\n') if line.startswith('ETag: ')][0][6:]
+
+    stream = Stream()
+    run(server.return_http_document(make_writer(stream), 'style.css', request_headers = {'If-None-Match': etag}))
+    assert stream.text.startswith('HTTP/1.0 304 Not Modified\r\n')
+    assert stream.text.endswith('\r\n\r\n')
+
+def test_missing_file_is_not_found(run, tmp_path):
+    server = make_server(tmp_path, {'other.js.gz': b''})
+    stream = Stream()
+    run(server.return_http_document(make_writer(stream), 'missing.js', request_headers = {'Accept-Encoding': 'gzip'}))
+    assert stream.text.startswith('HTTP/1.0 404 Not Found\r\n')
+
+def test_file_client_gone(run, tmp_path):
+    server = make_server(tmp_path, {'data.js': b'x'*5000})
+    stream = Stream(fail_after = 2)
+    with pytest.raises(OSError):
+        run(server.return_http_document(make_writer(stream), 'data.js'))
+    assert stream.text.count('HTTP/1.0') == 1
+    assert '404' not in stream.text
@@ -0,0 +1,83 @@
+import random
+import time
+
+import pytest
+
+from compressorlogs import EventLog, EVENT_RUN, EVENT_PURGE
+
+# Checks the incremental tallies against a scan of the whole log
+def check_tallies(log, durations):
+    now = time.time()
+    for duration in durations:
+        query_start = now - duration if now > duration else now
+        (runtime, first_log_time) = log._analyze_logs(query_start, now)
+        assert log.calculate_duty(duration) == pytest.approx(runtime/duration)
+    assert log.calculate_runtime() == log._analyze_logs(0, now)
+
+# Runs a random sequence of runs and purges, some of which are started while
+# another activity is still open, for long enough to wrap the ring
+@pytest.mark.parametrize('columnar', [False, True])
+def test_tallies_match_scan(clock, columnar):
+    rng = random.Random(1)
+    log = EventLog(thread_safe = False, size_limit = 8, columnar = columnar)
+    check_tallies(log, (60, 600))
+    for i in range(300):
+        clock.sleep(rng.randint(0, 90))
+        action = rng.random()
+        if action < 0.4:
+            log.log_start(EVENT_RUN if rng.random() < 0.8 else EVENT_PURGE)
+        elif action < 0.8:
+            log.log_stop()
+        check_tallies(log, (60, 600))
+
+# Changing the duty window rebuilds the window tally
+def test_duty_window_change(clock):
+    log = EventLog(thread_safe = False, size_limit = 8)
+    for i in range(5):
+        log.log_start(EVENT_RUN)
+        clock.sleep(30)
+        log.log_stop()
+        clock.sleep(90)
+    for duration in (100, 1000, 100, 200):
+        check_tallies(log, (duration,))
+
+def test_open_run_counts_until_now(clock):
+    log = EventLog(thread_safe = False)
+    log.log_start(EVENT_RUN)
+    clock.sleep(40)
+    assert log.calculate_duty(100) == pytest.approx(0.4)
+    assert log.calculate_runtime()[0] == 40
+    check_tallies(log, (20, 100))
+
+# log_start() stops an activity that is still open, so it isn't counted as
+# running forever, and the next log_stop() stops the new activity
+def test_log_start_stops_open_activity(clock):
+    log = EventLog(thread_safe = False)
+    log.log_start(EVENT_RUN)
+    clock.sleep(10)
+    log.log_start(EVENT_PURGE)
+    clock.sleep(5)
+    log.log_stop()
+
+    (start, stop, event) = log[1]
+    assert (stop - start, event) == (10, EVENT_RUN)
+    (start, stop, event) = log[0]
+    assert (stop - start, event) == (5, EVENT_PURGE)
+    assert log.calculate_runtime()[0] == 10
+    check_tallies(log, (100,))
+
+# The tallies are rebuilt from logs that are restored (see LogStore.load())
+def test_restored(clock):
+    log = EventLog(thread_safe = False)
+    for i in range(3):
+        log.log_start(EVENT_RUN)
+        clock.sleep(20)
+        log.log_stop()
+        clock.sleep(10)
+
+    restored_log = EventLog(thread_safe = False)
+    for i in range(log.count - 1, -1, -1):
+        restored_log.log(log[i])
+    restored_log.restored()
+    assert restored_log.calculate_runtime() == log.calculate_runtime()
+    check_tallies(restored_log, (50, 1000))
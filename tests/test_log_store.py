@@ -0,0 +1,99 @@
+import json
+
+from ringlog import RingLog
+from log_store import LogStore, load_stores
+
+from conftest import EPOCH
+
+# Collects what a dump writes
+class Writer:
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+    async def drain(self):
+        pass
+
+    # The times of the logs that were written, as they were written
+    @property
+    def times(self):
+        return [log['time'] for log in json.loads('[' + ''.join(self.data) + ']')]
+
+# Blocks of 4 logs in segments of 2 blocks, and 3 segments are kept, so the
+# oldest segment is replaced once 24 logs have been stored
+def make_store(tmp_path, name = 'test'):
+    log = RingLog('<Ll', ['time', 'value'], 10, ordered_index = 0)
+    return LogStore(log, str(tmp_path), name, 32, 2, 3)
+
+def log_times(store, times):
+    for log_time in times:
+        store.log.log((log_time, log_time % 1000))
+        store.update()
+    store.flush()
+
+def ring_times(log):
+    return [log[i][0] for i in range(log.count - 1, -1, -1)]
+
+def read_offsets(tmp_path, name = 'test'):
+    return json.loads((tmp_path/(name + '.json')).read_text())['offsets']
+
+def test_restore(clock, tmp_path):
+    times = list(range(EPOCH - 300, EPOCH, 10))
+    log_times(make_store(tmp_path), times)
+
+    store = make_store(tmp_path)
+    assert store.segments == [1, 2, 3]
+    load_stores([store])
+    assert ring_times(store.log) == times[-10:]
+    assert store.offsets == {}
+
+# After a restart that reset the clock the stored logs of all of the stores are
+# moved back together, to end just before the restart. The offsets are kept in
+# the json files, and only for the segments that still exist.
+def test_clock_reset(run, clock, tmp_path):
+    clock.sleep(5000)
+    log_times(make_store(tmp_path, 'a'), range(EPOCH + 4000, EPOCH + 5000, 100))
+    log_times(make_store(tmp_path, 'b'), range(EPOCH + 3000, EPOCH + 4500, 100))
+
+    clock.now = 0
+    (a, b) = (make_store(tmp_path, 'a'), make_store(tmp_path, 'b'))
+    load_stores([a, b])
+    assert ring_times(a.log) == list(range(EPOCH - 901, EPOCH, 100))
+    assert ring_times(b.log) == list(range(EPOCH - 1401, EPOCH - 500, 100))
+    assert read_offsets(tmp_path, 'a') == {'0': -4901, '1': -4901}
+    assert read_offsets(tmp_path, 'b') == {'0': -4901, '1': -4901}
+
+    # Logs after the restart start a new segment, which has no offset. Segment 0
+    # is replaced, so its offset isn't read back.
+    clock.sleep(100)
+    log_times(a, range(EPOCH + 10, EPOCH + 100, 10))
+    assert a.segments == [1, 2, 3]
+
+    clock.sleep(100)
+    a = make_store(tmp_path, 'a')
+    assert a.offsets == {1: -4901}
+    load_stores([a])
+    assert ring_times(a.log) == [EPOCH - 1] + list(range(EPOCH + 10, EPOCH + 100, 10))
+
+    writer = Writer()
+    run(a.dump(writer, 0, EPOCH + 1000))
+    assert writer.times == list(range(EPOCH + 90, EPOCH, -10)) + [EPOCH - 1, EPOCH - 101]
+
+# The history on flash continues a dump of the ring (see get_state_logs()), from
+# before the oldest log in memory and without repeating it
+def test_dump_continues_from_flash(run, clock, tmp_path):
+    times = list(range(EPOCH - 3000, EPOCH, 100))
+    store = make_store(tmp_path)
+    log_times(store, times)
+    log = store.log
+
+    for since in (1, times[3], times[15], times[25]):
+        writer = Writer()
+        written = run(log.dump(writer, since))
+        oldest_time = log[log.count - 1][0]
+        written = run(store.dump(writer, since, oldest_time, written))
+        expected = [log_time for log_time in reversed(times[8:]) if log_time >= since]
+        assert writer.times == expected
+        assert written == len(expected)
@@ -0,0 +1,101 @@
+import pytest
+
+from server import RequestReader, RequestError, Route, url_decode
+
+# Stands in for the stream of a connection, returning the data at most chunk_size
+# bytes at a time
+class Stream:
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.position = 0
+        self.chunk_size = chunk_size
+
+    async def readinto(self, buffer):
+        count = min(len(buffer), self.chunk_size, len(self.data) - self.position)
+        buffer[0:count] = self.data[self.position:self.position + count]
+        self.position += count
+        return count
+
+def handler(*args):
+    pass
+
+# Reads every request of data, as (method, path, parameters, protocol, headers, body)
+async def read_requests(reader, route):
+    requests = []
+    while await reader.wait_for_data():
+        (method, path, parameters, protocol) = await reader.read_request_line()
+        headers = await reader.read_headers(route, 32, 512)
+        length = int(headers.get('Content-Length', 0))
+        body = await reader.read_body(length) if length else None
+        requests.append((method, path, parameters, protocol, headers, body))
+    return requests
+
+CHUNK_SIZES = [1, 7, 4096]
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_request_line(run, chunk_size):
+    data = b'GET /state_logs?since=1700000000&span=3600&flag HTTP/1.1\r\nHost: pico\r\n\r\n'
+    reader = RequestReader(Stream(data, chunk_size))
+    requests = run(read_requests(reader, Route(handler)))
+    assert requests == [('GET', '/state_logs', {'since': '1700000000', 'span': '3600', 'flag': ''}, 'HTTP/1.1', {}, None)]
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_url_decoding(run, chunk_size):
+    data = b'GET /a%20b?name=a+b%2Bc&%C3%A9=%7e&&x= HTTP/1.0\n\n'
+    reader = RequestReader(Stream(data, chunk_size))
+    (request,) = run(read_requests(reader, Route(handler)))
+    assert request[:4] == ('GET', '/a b', {'name': 'a b+c', 'é': '~', 'x': ''}, 'HTTP/1.0')
+
+# Only the headers that the route asks for are kept, matched without regard to case
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_headers(run, chunk_size):
+    data = (b'GET /status HTTP/1.1\r\n'
+            b'if-none-match:  "12" \r\n'
+            b'X-Other: ignored\r\n'
+            b'CONNECTION:\tclose\r\n'
+            b'\r\n')
+    reader = RequestReader(Stream(data, chunk_size))
+    (request,) = run(read_requests(reader, Route(handler, headers = ('If-None-Match',))))
+    assert request[4] == {'If-None-Match': '"12"', 'Connection': 'close'}
+
+# Pipelined requests, with bodies, are read one after the other from the same buffer
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_pipelined_requests(run, chunk_size):
+    data = (b'POST /settings HTTP/1.1\r\nContent-Length: 11\r\n\r\n{"a": true}'
+            b'\r\n'
+            b'GET /status HTTP/1.1\r\n\r\n'
+            b'POST /settings HTTP/1.1\r\nContent-Length: 2000\r\n\r\n' + b'x'*2000)
+    reader = RequestReader(Stream(data, chunk_size), size = 256)
+    requests = run(read_requests(reader, Route(handler)))
+    assert [(method, path, body) for (method, path, parameters, protocol, headers, body) in requests] == [
+        ('POST', '/settings', b'{"a": true}'),
+        ('GET', '/status', None),
+        ('POST', '/settings', b'x'*2000)]
+
+@pytest.mark.parametrize('data, status', [
+    (b'GET\r\n\r\n', 400),
+    (b'GET /status HTTP/1.1\r\nbad header\r\n\r\n', 400),
+    (b'GET /status HTTP/1.1\r\nHost: pi', 400),
+    (b'GET /%4 HTTP/1.1\r\n\r\n', 400),
+    (b'GET /%zz HTTP/1.1\r\n\r\n', 400),
+    (b'GET /' + b'a'*300 + b' HTTP/1.1\r\n\r\n', 431),
+    (b'POST /settings HTTP/1.1\r\nContent-Length: 20\r\n\r\n{}', 400)
+])
+def test_errors(run, data, status):
+    reader = RequestReader(Stream(data, 7), size = 256)
+    with pytest.raises(RequestError) as error:
+        run(read_requests(reader, Route(handler)))
+    assert error.value.status == status
+
+def test_too_many_headers(run):
+    data = b'GET / HTTP/1.1\r\n' + b'X: 1\r\n'*33 + b'\r\n'
+    reader = RequestReader(Stream(data, 4096))
+    with pytest.raises(RequestError) as error:
+        run(read_requests(reader, Route(handler)))
+    assert error.value.status == 431
+
+def test_url_decode():
+    buffer = bytearray(b'xa+b%41%62cx')
+    assert url_decode(buffer, 1, len(buffer) - 1, True) == 'a bAbc'
+    assert url_decode(buffer, 1, len(buffer) - 1, False) == 'a+bAbc'
+    assert url_decode(buffer, 1, 2, True) == 'a'
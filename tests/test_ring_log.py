@@ -0,0 +1,100 @@
+import json
+import struct
+
+import pytest
+
+from ringlog import RingLog
+
+# Collects what a dump writes. Each drain after the first (which a dump does before
+# it looks at the log) adds logs_per_drain logs to the log, like the control loop
+# does while a slow client is being sent a dump.
+class Writer:
+    def __init__(self, log = None, logs_per_drain = 0):
+        self.data = []
+        self.log = log
+        self.logs_per_drain = logs_per_drain
+        self.drains = 0
+
+    def write(self, data):
+        self.data.append(data.encode() if isinstance(data, str) else bytes(data))
+
+    async def drain(self):
+        self.drains += 1
+        if self.drains > 1:
+            add_logs(self.log, self.logs_per_drain)
+
+    # The times of the logs of a json dump, as they were written
+    @property
+    def json_times(self):
+        return [log['time'] for log in json.loads('[' + b''.join(self.data).decode() + ']')]
+
+    # The records of a binary dump, as they were written
+    @property
+    def binary_records(self):
+        data = b''.join(self.data)
+        (header, data) = data.split(b'\n', 1)
+        description = json.loads(header)
+        stride = description['stride']
+        records = []
+        position = 0
+        while True:
+            (count,) = struct.unpack_from('<H', data, position)
+            position += 2
+            if count == 0:
+                break
+            for i in range(count):
+                records.append(struct.unpack_from(description['format'], data, position))
+                position += stride
+        assert position == len(data)
+        return records
+
+def add_logs(log, count):
+    for i in range(count):
+        log_time = log[0][0] + 10 if log.count else 1000
+        log.log((log_time, log_time % 997))
+
+def make_log(size_limit, count, columnar):
+    log = RingLog('<Ll', ['time', 'value'], size_limit, ordered_index = 0, columnar = columnar)
+    log.dump_block_size = 3
+    add_logs(log, count)
+    return log
+
+def ring(log):
+    return [log[i] for i in range(log.count)]
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_dump_wrapped(run, columnar):
+    log = make_log(10, 27, columnar)
+    logs = ring(log)
+    for since in (0, logs[4][0], logs[9][0], logs[0][0] + 1):
+        expected = [entry for entry in logs if entry[0] >= since]
+
+        writer = Writer()
+        assert run(log.dump(writer, since)) == len(expected)
+        assert writer.json_times == [entry[0] for entry in expected]
+
+        writer = Writer()
+        run(log.dump_binary(writer, since))
+        assert writer.binary_records == expected[::-1]
+
+# Logs that are added during a dump aren't sent, and the logs that were there when
+# the dump started are sent without gaps or repeats, until one that hasn't been sent
+# yet is overwritten. The json dump is most recent first, so it reaches the logs
+# that are overwritten first.
+@pytest.mark.parametrize('columnar', [False, True])
+@pytest.mark.parametrize('size_limit, count, logs_per_drain, json_count, binary_count', [
+    (40, 10, 1, 10, 10),    # The ring has room, so nothing is overwritten
+    (10, 25, 1, 8, 10),
+    (10, 25, 4, 6, 3),
+])
+def test_dump_while_logging(run, columnar, size_limit, count, logs_per_drain, json_count, binary_count):
+    log = make_log(size_limit, count, columnar)
+    logs = ring(log)
+    writer = Writer(log, logs_per_drain)
+    assert run(log.dump(writer, 0)) == json_count
+    assert writer.json_times == [entry[0] for entry in logs[:json_count]]
+
+    log = make_log(size_limit, count, columnar)
+    writer = Writer(log, logs_per_drain)
+    run(log.dump_binary(writer, 0))
+    assert writer.binary_records == logs[::-1][:binary_count]
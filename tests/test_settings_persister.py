@@ -0,0 +1,76 @@
+import asyncio
+import json
+
+from settings import Settings
+from settings_persister import SettingsPersister
+
+DEFAULTS = {'a': 1, 'b': 'x'}
+
+def read_json(path):
+    with open(path) as f:
+        return json.loads(f.read())
+
+# A burst of changes is written once, after delay milliseconds without changes,
+# and a request that doesn't change anything doesn't write the file
+def test_debounce(run, clock, tmp_path):
+    path = tmp_path/'settings.json'
+    settings = Settings(DEFAULTS, str(path))
+    persister = SettingsPersister(settings, 1000)
+
+    async def changes():
+        persister.run()
+        for value in (2, 3, 4):
+            settings.update({'a': value})
+            settings.write_delta()
+            await asyncio.sleep(0.6)
+            assert persister.writes == 0
+            assert not path.exists()
+        await asyncio.sleep(0.5)
+        assert persister.writes == 1
+        assert read_json(path) == {'a': 4}
+
+        settings.write_delta()
+        await asyncio.sleep(1.1)
+        assert (persister.writes, persister.unchanged) == (1, 1)
+
+        # Stopping writes a change that is still waiting
+        settings.update({'b': 'y'})
+        settings.write_delta()
+        persister.stop()
+        assert read_json(path) == {'a': 4, 'b': 'y'}
+
+    run(changes())
+    assert persister.stats_dictionary['requests'] == 5
+    assert persister.stats_dictionary['pending'] == False
+
+# The file isn't written again if it already has the settings, including when
+# they were read from it at boot
+def test_persist_skips_unchanged(tmp_path):
+    path = str(tmp_path/'settings.json')
+    settings = Settings(DEFAULTS, path)
+    settings.update({'a': 2})
+    assert settings.persist()
+    assert not settings.persist()
+
+    settings = Settings(DEFAULTS, path)
+    assert settings.a == 2
+    assert not settings.persist()
+    settings.update({'a': 3})
+    assert settings.persist()
+    assert read_json(path) == {'a': 3}
+
+# If the file was lost while it was being replaced the temporary file is read,
+# and the next write puts it back under its name
+def test_read_falls_back_to_temporary_file(tmp_path):
+    path = tmp_path/'settings.json'
+    (tmp_path/'settings.json.tmp').write_text('{"a": 5}')
+    path.write_text('{"a": 6')
+    settings = Settings(DEFAULTS, str(path))
+    assert settings.a == 5
+
+    path.unlink()
+    settings = Settings(DEFAULTS, str(path))
+    assert settings.a == 5
+    assert settings.persist()
+    assert read_json(path) == {'a': 5}
+    assert not (tmp_path/'settings.json.tmp').exists()
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+from compressorlogs import StateLog
+
+# Checks the sliding regression against linear_least_squares() over the logs in
+# the window
+def check_regression(log, now, start_time):
+    (m, b, n) = log.regression(now)
+    (expected_m, expected_b, expected_n) = log.linear_least_squares(1, start_time)
+    assert n == expected_n
+    assert m == pytest.approx(expected_m, rel = 1e-6, abs = 1e-9)
+    assert b == pytest.approx(expected_b, rel = 1e-6, abs = 1e-6)
+
+def log_pressures(log, rng, log_time, count):
+    for i in range(count):
+        log_time += rng.randint(1, 20)
+        log.log((log_time, rng.uniform(80, 120), rng.uniform(0, 100), rng.random(), b'Op_'))
+        yield log_time
+
+# Logs at irregular intervals, long enough for logs to leave the window and to be
+# evicted from the ring while they are still in it
+@pytest.mark.parametrize('size_limit', [10, 100])
+def test_regression_matches_least_squares(clock, size_limit):
+    rng = random.Random(2)
+    window = 120
+    log = StateLog(0, False, size_limit = size_limit, regression_window = window)
+    for log_time in log_pressures(log, rng, 1000, 500):
+        check_regression(log, log_time, log_time - window)
+
+# The window can be moved without logging
+def test_regression_advances_without_logs(clock):
+    rng = random.Random(3)
+    log = StateLog(0, False, size_limit = 50, regression_window = 100)
+    last_time = list(log_pressures(log, rng, 1000, 30))[-1]
+    for now in range(last_time, last_time + 120, 7):
+        check_regression(log, now, now - 100)
+    assert log.regression(last_time + 200) == (0, 0, 0)
+
+# track_regression() changes the window, and since starts it no earlier than a time
+def test_track_regression(clock):
+    rng = random.Random(4)
+    log = StateLog(0, False, size_limit = 100, regression_window = 100)
+    last_time = list(log_pressures(log, rng, 1000, 60))[-1]
+
+    log.track_regression(300)
+    check_regression(log, last_time, last_time - 300)
+    since = last_time - 150
+    log.track_regression(300, since)
+    check_regression(log, last_time, since)
+    log.track_regression(300, since - 50)
+    check_regression(log, last_time, since - 50)
+    log.track_regression(300)
+    check_regression(log, last_time, last_time - 300)
+
+    for log_time in log_pressures(log, rng, last_time, 40):
+        check_regression(log, log_time, log_time - 300)
+
+def test_regression_of_line_pressure(clock):
+    rng = random.Random(5)
+    log = StateLog(0, False, size_limit = 50, regression_window = 60, regression_index = 2)
+    for log_time in log_pressures(log, rng, 1000, 100):
+        (m, b, n) = log.regression(log_time)
+        (expected_m, expected_b, expected_n) = log.linear_least_squares(2, log_time - 60)
+        assert n == expected_n
+        assert (m, b) == pytest.approx((expected_m, expected_b), rel = 1e-6, abs = 1e-6)